@@ -5,22 +5,31 @@ This program implements a GUI for exploring and processing the data in a SPECS f
 '''
 
 import os
+import multiprocessing
+from contextlib import contextmanager
 #from traits.etsconfig.api import ETSConfig
 #ETSConfig.toolkit = 'qt4'
 import numpy as np
 from enable.api import ComponentEditor
-from traits.api import Str, Bool, Enum, List, Dict, Any, HTML, \
-    HasTraits, Instance, Button, on_trait_change
+from traits.api import Str, Bool, Int, Enum, List, Dict, Any, HTML, \
+    HasTraits, Instance, Property, Button, on_trait_change
 from traitsui.api import View, Group, HGroup, VGroup, HSplit, HTMLEditor, ToolBar, \
     Item, UItem, TreeEditor, Label, TreeNode, Menu, MenuBar, Action, Handler
 from traitsui.key_bindings import KeyBinding, KeyBindings
 from pyface.api import ImageResource, DirectoryDialog, OK, GUI, error
+from pyface.timer.api import Timer
 from fixes import fix_background_color
 from chaco.api import Plot, ArrayPlotData, PlotAxis, \
     add_default_axes, add_default_grids
 from chaco.tools.api import PanTool, ZoomTool
 from ui_helpers import get_file_from_dialog
 import specs
+import specs_cache
+import export
+from export import CHANNELS, COUNTS_BIT, scan_mode_lookup, selection_bit, channels_mask
+import normalisation
+import decimation
+from normalisation import get_name_body, get_name_num
 import wx
 from help import open_help_index
 
@@ -36,29 +45,14 @@ __email__ = "gruben@versi.edu.au"
 # grey. This fixes that.
 fix_background_color()
 APP_WIDTH = 800
+PARSE_PROCESSES = 1     # processes parsing files not yet cached; None for one per CPU
+FOLLOW_INTERVAL = 2000  # ms between checks of a followed file for new regions
+LOD_MIN_POINTS = 10000  # Series longer than this are drawn from their min/max envelope
+# The checkbox states of every region until its SelectorPanel is made
+DEFAULT_SELECTION = {'counts': True, 'channel_counts': True, 'extended_channels': False}
 title = "SinSPECt"
 app_icon = os.path.join('resources', 'app_icon.ico')
 
-# A lookup table with keys that match the possible specs.SPECSRegion.scan_mode values.
-scan_mode_lookup = lambda key: {
-    'FixedAnalyzerTransmission':{ 'axis' :'binding_axis',        # scan_mode axis to use
-                                  'label':'Binding energy (eV)', # plot region x-axis label
-                                  'orientation':'reversed',      # plot region x-axis orientation
-                                },
-    'ConstantFinalState'       :{ 'axis' :'excitation_axis',
-                                  'label':'Excitation energy (eV)',
-                                  'orientation':'normal',
-                                },
-    'FixedEnergies'            :{ 'axis' :'time_axis',
-                                  'label':'Time (s)',
-                                  'orientation':'normal',
-                                },
-    }.get(key,                  { 'axis' :'kinetic_axis',
-                                  'label':'Kinetic energy (eV)',
-                                  'orientation':'normal',
-                                },
-    ) # last one is the default case
-
 
 # SpRegion, SpGroup and SpFile are Traited versions of SPECS xml file classes
 # that represent nodes in the TreeEditor widget
@@ -74,7 +68,13 @@ class SpRegion(HasTraits):
     name = Str('<unknown>')
     region = Instance(specs.SPECSRegion)    # The reference to the contained region object
     group = Instance('SpGroup')             # A reference to the containing group
-    selection = Instance('SelectorPanel')   # A string argument here allows a forward reference
+    # The SelectorPanel is only made when first needed, as most regions of a large file
+    # are never looked at. A string argument here allows a forward reference
+    selection = Property(Instance('SelectorPanel'))
+    _selection = Instance('SelectorPanel')
+    # The export.Region that stands in for this one until the SelectorPanel is made,
+    # kept so that the normalisation cache entries made for it can be reused
+    _export_region = Instance(export.Region)
 
     def __init__(self, name, region, group, **traits):
         ''' name is a string with the name of the region
@@ -83,33 +83,65 @@ class SpRegion(HasTraits):
         super(SpRegion, self).__init__(**traits)    # HasTraits.__init__(self, **traits)
         self.name = name
         self.label_name = '* {}'.format(name) # initialise label to this
-        self.zero_fill_empty_channels(region)
+        if self._is_empty(region):
+            # channel is empty. Just change its label for the moment
+            self.label_name = '  {} (empty)'.format(self.name)
         self.region = region
         self.group = group
         # Add a reference within the specs.SPECSRegion object in case we want access to its
         # Traited SpRegion owner
         self.region.owner = self
-        self.selection = SelectorPanel(self)
-        # Instantiation of the SelectorPanel creates it with self.selection.counts==False
-        # Setting self.selection.counts=True now triggers a trait change event which
-        # triggers creation of the related plot series
-        # self.selection.counts = True
+
+    def _get_selection(self):
+        ''' Make the SelectorPanel the first time it is asked for. '''
+        if self._selection is None:
+            # The region's arrays may not have been decoded yet, so defer filling them
+            # until they are
+            self.region.add_payload_hook(self.zero_fill_empty_channels)
+            self._selection = SelectorPanel(self)
+            self._export_region = None
+        return self._selection
+
+    def is_selected(self):
+        ''' Return the state of the counts checkbox, which flags the region for export,
+        without making the SelectorPanel if it hasn't been. '''
+        if self._selection is None:
+            return DEFAULT_SELECTION['counts']
+        return self._selection.counts
+
+    def for_export(self):
+        ''' Return the region to export: this one once its SelectorPanel has been made,
+        otherwise an export.Region standing in for it with the default selection, which
+        is much cheaper to make and is made only once. '''
+        if self._selection is not None:
+            return self
+        if self._export_region is None:
+            self._export_region = export.Region(self.name, self.region)
+        return self._export_region
 
     def zero_fill_empty_channels(self, region):
         ''' Sometimes the underlying specs.SPECSRegion object contains None to
         indicate that no channel data is available. Here we replace any None channels
         with a zero-filled array in the underlying object
         '''
-        CHANNELS = 9
-        c = region.channel_counts
-        if c is None:
-            region.channel_counts = np.zeros((region.counts.size, CHANNELS))
-        elif c.size == 0:
-            # channel is empty. Just change its label for the moment
-            self.label_name = '  {} (empty)'.format(self.name)
-        c = region.extended_channels
-        if c is None:
-            region.extended_channels = np.zeros((region.counts.size, CHANNELS))
+        export.zero_fill_empty_channels(region)
+
+    @staticmethod
+    def _is_empty(region):
+        ''' Return True iff the specs.SPECSRegion region has no channel data. This is
+        decided from the region metadata so the channel arrays are not decoded.
+        '''
+        return region.values_per_curve * len(region.detector_channel_offsets) == 0
+
+    def get_channel_counts_len(self):
+        ''' Return the number of channel_counts columns, without decoding them. '''
+        return len(self.region.detector_channel_offsets)
+
+    def get_extended_channels_len(self):
+        ''' Return the number of extended_channels columns, without decoding them.
+        Regions with no extended channels are zero-filled with CHANNELS columns.
+        '''
+        return self.region.num_extended_channels or CHANNELS
 
     def get_x_axis(self):
         ''' Return x-axis data based on the scan_mode metadata '''
@@ -131,18 +163,16 @@ class SpRegion(HasTraits):
         s = self.selection
 
         # see whether a region is empty
-        if s.region.region.channel_counts.size == 0:
+        if self._is_empty(s.region.region):
             empty_indicator = ' (empty)'
         else:
             empty_indicator = ''
 
-        # get state of counts checkbox
-        counts_state = s.get_trait_states()['counts']
-        # Get sets of all the T & F channel_counts and extended_channels states,
-        # i.e. end up with a set {}, {T}, {F}, or {T,F}
-        channel_counts_states = s.get_channel_counts_states().values()
+        # get state of counts checkbox and whether all the channel_counts are selected
+        counts_state = s.selection_mask & COUNTS_BIT
+        all_channel_counts = s.selection_mask & s.channel_counts_mask == s.channel_counts_mask
         if counts_state:
-            if False not in channel_counts_states:
+            if all_channel_counts:
                 state = '*'
             else:
                 state = '+'
@@ -157,12 +187,7 @@ class SpRegion(HasTraits):
     def normalise_self(self, ys):
         ''' Return a vector of ys normalised against the y-values in region indexed by
         the tree_panel.extended_channel_ref drop-down selector. '''
-        normalisation_ref = tree_panel.extended_channel_ref
-        ys = ys.copy()
-        if normalisation_ref != 'None':
-            # normalisation_ref is in the range 1-9
-            ys /= self.region.extended_channels[:, normalisation_ref - 1]
-        return ys
+        return normalisation.normalise_self(self, ys, tree_panel.extended_channel_ref)
 
     def _x_ranges_match(self, region, rtol=1e-6):
         ''' Verify that x-range of this region matches the region passed as a parameter
@@ -170,39 +195,25 @@ class SpRegion(HasTraits):
         tolerance rtol of the smallest division,
         i.e. for n+1 samples within they should match within (x_max-x_min)/n*rtol
         '''
-        xs = self.get_x_axis()
-        xs_ref = region.get_x_axis()
-        if np.allclose([xs[0], xs[-1]], [xs_ref[0], xs_ref[-1]],
-                       atol = (xs[-1]-xs[0]) / (xs.size-1) * rtol) and (xs.size==xs_ref.size):
-            return True
-        return False
+        return normalisation.x_ranges_match(self, region, rtol)
 
     def _e_r(self):
         ''' Computes the e_r term described in the SinSPECt Sphinx docs. '''
-        r = self.selection.dbl_norm_ref
-        return self.region.extended_channels[:, r-1]
+        return normalisation.e_r(self)
 
     def _MR(self, R, s):
         ''' Computes the M^R term described in the SinSPECt Sphinx docs.
         R is the reference region.
         s is the value from the Enum {'Counts', 1..9} of the drop-down menu selection.
         '''
-        if s == 'Counts':
-            # M^R = C^R
-            mr = R.selection.compute_counts()
-        else:
-            # s in {1..9}: M^R = e^R_s
-            mr = R.region.extended_channels[:, s-1]
-        return mr
+        return normalisation.MR(R, s)
 
     def double_normalisation_denominator(self, R, s):
         ''' Computes the denominator term M^R/e^R_r described in the SinSPECt Sphinx docs.
         R is the reference region.
         s is the value from the Enum {'Counts', 1..9} of the drop-down menu selection.
         '''
-        mr = self._MR(R, s)
-        e = R.region.extended_channels[:, R.selection.dbl_norm_ref-1]
-        return mr / e
+        return normalisation.double_normalisation_denominator(R, s)
 
     def double_normalise_channel(self, series_name):
         ''' Computes the double-normalised channel counts c''_i or
@@ -212,39 +223,16 @@ class SpRegion(HasTraits):
         Raises ValueError if the x-ranges of this region and the normalisation reference
         do not match.
         '''
-        # Get the normalisation reference region from the tree panel 
-        R = tree_panel.norm_ref
-
-        # verify that our x-range matches that of the reference region
-        if not self._x_ranges_match(R):
-            raise ValueError
-
-        series_name_body = get_name_body(series_name)
-        series_name_num = get_name_num(series_name)
-        c_or_e_i = self.region.__getattribute__(series_name_body)[:,series_name_num-1]
-        numer = c_or_e_i / self._e_r()
-
-        s = R.selection.dbl_norm_ref_numerator
-        denom = self.double_normalisation_denominator(R, s)
-
-        return numer / denom
+        # Get the normalisation reference region from the tree panel
+        return normalisation.double_normalise_channel(self, tree_panel.norm_ref, series_name)
 
     def double_normalise_counts(self):
         ''' Computes the double-normalised counts C'' for this region.
         See the SinSPECt Sphinx docs for a definition.
         Raises ValueError if the x-ranges do not match.
         '''
-        # Get the normalisation reference region from the tree panel 
-        R = tree_panel.norm_ref
-
-        # verify that our x-range matches that of the reference region
-        if not self._x_ranges_match(R):
-            raise ValueError
-
-        s = R.selection.dbl_norm_ref_numerator
-        numer = self.selection.compute_counts() / self._e_r()
-        denom = self.double_normalisation_denominator(R, s)
-        return numer / denom
+        # Get the normalisation reference region from the tree panel
+        return normalisation.double_normalise_counts(self, tree_panel.norm_ref)
 
 
 class SpGroup(HasTraits):
@@ -257,6 +245,7 @@ class SpFile(HasTraits):
     ''' The file node in the TreeEditor '''
     name = Str('<unknown>')
     specs_groups = List(SpGroup)     # container for the subordinate groups
+    follower = Instance(specs.SPECSFollower)    # Set while the file is being followed
 
     def _uniquify_names(self, names):
         ''' names is a list of strings. This generator function ensures all strings in
@@ -264,18 +253,19 @@ class SpFile(HasTraits):
         is an incrementing number. e.g. if names is ['a', 'b', 'c', 'a', 'b', 'a'] this
         yields ['a', 'b', 'c', 'a-1', 'b-1', 'a-2']
         '''
-        freqs = {}
-        for name in names:
-            freqs[name] = freqs.get(name, 0) + 1
-            if freqs[name] > 1:
-                yield '{}-{}'.format(name, freqs[name]-1)
-            else:
-                yield name
+        return export.uniquify_names(names)
 
-    def open(self, filename):
-        ''' Create all objects corresponding to the tree '''
-        s = specs.SPECS(filename)
+    def open(self, filename, processes=PARSE_PROCESSES, follow=False):
+        ''' Create all objects corresponding to the tree. If processes is other than 1,
+        a file not yet in the cache is parsed by that many processes (see specs.SPECS).
+        If follow is True the file may still be being written and is followed instead;
+        see follow() '''
         self.name = filename
+        if follow:
+            self.follow()
+            return self
+        # Files seen before are read from the cache, others are parsed and added to it
+        s = specs_cache.open_specs(filename, lazy=(processes == 1), processes=processes)
         group_names = [g.name for g in s.groups]
         uniquify_group_gen = self._uniquify_names(group_names)
         for group in s.groups:
@@ -291,6 +281,41 @@ class SpFile(HasTraits):
             self.specs_groups.append(specs_group)
         return self
 
+    def follow(self):
+        ''' Start following the file, which may still be being acquired, adding the
+        regions read so far that are not already in the tree. Call update() to add
+        regions completed later. Returns the list of SpRegions added '''
+        self.follower = specs.SPECSFollower(self.name, lazy=True)
+        return self.update()
+
+    def update(self):
+        ''' Add the regions completed since the last update of a followed file to the
+        tree, without touching the existing nodes. If the file was rewritten rather than
+        appended to, the tree is rebuilt. Returns the list of SpRegions added '''
+        restarts = self.follower.restarts
+        self.follower.poll()
+        if self.follower.restarts != restarts:
+            self.specs_groups = []
+        added = []
+        groups = self.follower.groups
+        for i, group in enumerate(groups):
+            if i < len(self.specs_groups):
+                specs_group = self.specs_groups[i]
+            else:
+                # The last of the uniquified names so far is that of the new group
+                group_names = [g.name for g in groups[:i+1]]
+                name = list(self._uniquify_names(group_names))[-1]
+                specs_group = SpGroup(name=name, specs_regions=[])
+                self.specs_groups.append(specs_group)
+            region_names = [r.name for r in group.regions]
+            uniquified_names = list(self._uniquify_names(region_names))
+            for j in range(len(specs_group.specs_regions), len(group.regions)):
+                sp_region = SpRegion(name=uniquified_names[j], region=group.regions[j],
+                                     group=specs_group)
+                specs_group.specs_regions.append(sp_region)
+                added.append(sp_region)
+        return added
+
 
 class TreePanel(HasTraits):
     ''' The tree widget '''
@@ -314,6 +339,11 @@ class TreePanel(HasTraits):
     norm_ref = Instance(SpRegion)
     cb_header = Bool(True)
     delimiter = Enum('tab','space','comma')('tab')
+    export_format = Enum('xy','hdf5')('xy')
+    cb_follow = Bool(False)
+    follow_timer = Any()
+    # Normalised series, reused while the normalisation settings are unchanged
+    normalisation_cache = Instance(normalisation.NormalisationCache, ())
 
     def _bt_open_file_changed(self):
         ''' Event handler
@@ -331,13 +361,16 @@ class TreePanel(HasTraits):
         # short-circuit any event caused by the exception handler (*) in this method
         if self.file_path == '':
             return
+        self._stop_following()
         plot_panel.remove_all_plots()
         self._clear_dbl_nrm_ref_label()
 
         self.name = self.file_path
         try:
             GUI.set_busy()                      # set hourglass         @UndefinedVariable
-            self.specs_file = SpFile().open(self.file_path)
+            self.specs_file = SpFile().open(self.file_path, follow=self.cb_follow)
+            if self.cb_follow:
+                self._start_following()
         except:
             # throw up an error message dialog
             error_dialog_message = 'Unexpected error reading file ' + self.file_path
@@ -349,6 +382,54 @@ class TreePanel(HasTraits):
             self.file_path = ''
         GUI.set_busy(False)                     # reset hourglass       @UndefinedVariable
 
+    def _cb_follow_changed(self, new):
+        ''' Trait event handler
+        Start or stop following the open file as the Follow file checkbox is toggled
+        '''
+        if self.specs_file is None:
+            return
+        if new:
+            try:
+                self.specs_file.follow()
+            except Exception:
+                error(None, 'Unexpected error reading file ' + self.specs_file.name)
+                return
+            self._start_following()
+        else:
+            self._stop_following()
+
+    def _start_following(self):
+        self.follow_timer = Timer(FOLLOW_INTERVAL, self._follow_file)
+
+    def _stop_following(self):
+        if self.follow_timer is not None:
+            self.follow_timer.Stop()
+            self.follow_timer = None
+        if self.specs_file is not None:
+            self.specs_file.follower = None
+
+    def _follow_file(self):
+        ''' Timer callback
+        Add any regions completed since the last check to the tree. New regions are
+        only appended, so existing plots and selections are left alone unless the file
+        was rewritten, in which case the tree is rebuilt and the plots cleared
+        '''
+        follower = self.specs_file.follower
+        restarts = follower.restarts
+        try:
+            self.specs_file.update()
+        except IOError:
+            # The acquisition software may briefly have the file locked; try again later
+            return
+        except Exception:
+            self._stop_following()
+            self.cb_follow = False
+            error(None, 'Unexpected error following file ' + self.specs_file.name)
+            return
+        if follower.restarts != restarts:
+            plot_panel.remove_all_plots()
+            self._clear_dbl_nrm_ref_label()
+
     def _clear_dbl_nrm_ref_label(self):
         ''' The double-normalisation reference starts off set to None, indicating that
         double normalisation should not be done. Call this to reset to that initial state.
@@ -375,168 +456,33 @@ class TreePanel(HasTraits):
         ''' A wrapper method for single and double normalisation that delegates to the
         normalisation method desired according to the GUI state.
         '''
-        mode = self.get_normalisation_mode()
-        if mode == 'self':
-            if (get_name_body(series_name) != 'extended_channels') or \
-               (get_name_num(series_name) != tree_panel.extended_channel_ref):
-                ys = region.normalise_self(ys)
-        elif (mode == 'double') and (region.region.scan_mode == 'ConstantFinalState'):
-            if series_name=='counts':
-                ys = region.double_normalise_counts()
-            else:
-                if (get_name_body(series_name) != 'extended_channels') or \
-                   (get_name_num(series_name) != region.selection.dbl_norm_ref):
-                    ys = region.double_normalise_channel(series_name)
-        return ys
+        return self.normalisation_cache.normalise(region, ys, series_name,
+                                                  self.get_normalisation_mode(),
+                                                  tree_panel.extended_channel_ref,
+                                                  self.norm_ref)
 
     def _get_counts_label_for_region(self, r):
         ''' Builds a string of the form '1+2+4' where the summands correspond to the
         selected channel_counts trait states
         '''
-        cc_dict = r.selection.get_channel_counts_states()
-        # make a string indicating the channel_counts columns summed to
-        # obtain the counts column
-        counts_label = '+'.join([str(get_name_num(i))
-                                 for i in sorted(cc_dict) if cc_dict[i]])
-        return counts_label
-
-    def _get_double_normalisation_channels(self):
-        ''' Return the normalisation reference region and the numerator and
-        denominator selections of that region '''
-        R = tree_panel.norm_ref
-        s = R.selection.dbl_norm_ref_numerator
-        d = R.selection.dbl_norm_ref
-        return R, s, d
+        return export.counts_label(r)
 
     def _export_region(self, r, dirname):
         ''' Exports region r into the directory dirname. The directory is created as
         needed. Returns a flag normalisation_errors if errors occurred. If True, the error
         message will be contained in the associated err_msg.
         '''
-        # variable a holds the columnar count data. Start with the x-axis
-        # then append counts, channel_counts and extended_channels as
-        # appropriate.
-
-        err_msg = ''
-        normalisation_errors = False
-        h = ''
-        delimiter = {'space':' ', 'comma':',', 'tab':'\t'}[self.delimiter]
-        a = [r.get_x_axis()]            # x-axis data
-
-        normalisation_ref = tree_panel.extended_channel_ref
-        normalisation_ok = True         # Reset region-specific error flag
-        try:
-            # counts data
-            ys = self.normalise(r, r.region.counts, series_name='counts')
-            a.append(ys)
-
-            counts_label = self._get_counts_label_for_region(r)
-
-            # First header line
-            h += '#"'
-            mode = self.get_normalisation_mode()
-            # Now we have the normalisation mode according to the GUI setting. Override
-            # this if it says double-normalisation and the axis type does not support this
-            if mode == 'double' and r.region.scan_mode != 'ConstantFinalState':
-                mode = 'none'
-            if mode == 'self':
-                h += 'Normalised to extended channel {}, '\
-                    .format(normalisation_ref)
-            elif mode == 'double':
-                R, s, d = self._get_double_normalisation_channels()
-                if s == 'Counts':
-                    s = 'Counts {}'.format(self._get_counts_label_for_region(R))
-                h += 'Double normalised {} to {}:{}/{}, '\
-                    .format(r.selection.dbl_norm_ref, R.name, s, d)
-
-            h += 'Analyzer mode:{}'.format(r.region.scan_mode)
-            h += ', Dwell time:{}'.format(r.region.dwell_time)
-            h += ', Pass energy:{}'.format(r.region.pass_energy)
-            h += ', Lens mode:{}'.format(r.region.analyzer_lens)
-            if r.region.scan_mode=='FixedAnalyzerTransmission':
-                h += ', Excitation energy:{}'.format(r.region.excitation_energy)
-            elif r.region.scan_mode=='ConstantFinalState':
-                h += ', Kinetic energy:{}'.format(r.region.kinetic_energy)
-            h += '"\n'
-
-            # Second header line
-            h += '#'
-            h += '"{}"'.format(scan_mode_lookup(r.region.scan_mode)['label'])
-            h += '{}"Counts {}"'.format(delimiter, counts_label)
-
-            # channel_counts_n data
-            for name in sorted(r.selection.get_channel_counts_states()):
-                channel_num = get_name_num(name)
-                ys = r.region.channel_counts[:,channel_num-1]
-                ys = self.normalise(r, ys, series_name=name)
-                a.append(ys)
-                h += '{}"Channel {} counts"'.format(delimiter, channel_num)
-
-            # extended_channels_n data
-            for name in sorted(r.selection.get_extended_channels_states()):
-                channel_num = get_name_num(name)
-                ys = r.region.extended_channels[:,channel_num-1]
-                ys = self.normalise(r, ys, series_name=name)
-                a.append(ys)
-                h += '{}"Extended channel {}"'.format(delimiter, channel_num)
-
-            # optionally append double-normalisation reference data
-            if mode == 'double':
-                R, s, d = self._get_double_normalisation_channels()
-                ys = r.double_normalisation_denominator(R, s)
-                a.append(ys)
-                if s == 'Counts':
-                    s = 'Counts {}'.format(self._get_counts_label_for_region(R))
-                h += '{}"{}:{}/{}"'.format(delimiter, R.name, s, d)
-
-            # Deal with any errors created in normalising data
-            a = np.array(a)
-            mask = np.isinf(a) | np.isnan(a)
-            a[mask] = -1
-            if True in mask:
-                normalisation_ok = False
-                normalisation_errors = True
-                err_msg = 'Errors generated while normalising have been set to -1'
-
-        except FloatingPointError:
-            normalisation_ok = False
-            normalisation_errors = True
-            err_msg = 'Unexpected floating point errors normalising to Extended channel {}'.format(
-                normalisation_ref)
-        except ValueError:
-            normalisation_ok = False
-            normalisation_errors = True
-            R, s, d = self._get_double_normalisation_channels()
-            err_msg = 'Energy ranges differ in double normalisation reference {}:{}/{}'.format(R.name, s, d)
-
-        # Write output
-        try:
-            os.mkdir(dirname)   # Try creating directory
-        except OSError:
-            # Something exists already, or it can't be written
-            # Maybe give a nice message here
-            pass
-
-        if normalisation_ok:
-            filename = os.path.join(dirname, r.name+'.xy')
-        else:
-            filename = os.path.join(dirname, 'ERRORS_{}.xy'.format(r.name))
-        with open(filename, 'w') as f:
-            if err_msg != '':
-                # Additional header line indicating there were errors
-                print >> f, '# ERRORS:', err_msg
-            if self.cb_header:
-                # Output header
-                print >> f, h
-            # Output data
-            a = np.array(a).transpose()
-            np.savetxt(f, a, fmt='%1.8g', delimiter=delimiter)
-
-            print filename, 'written'
-        return normalisation_errors, err_msg    # err_msg contains any error message if one occurred
+        return export.export_region(r, dirname, self.get_normalisation_mode(),
+                                    tree_panel.extended_channel_ref, self.norm_ref,
+                                    self.delimiter, self.cb_header,
+                                    self.normalisation_cache)
 
     def _file_save(self, path):
         ''' Saves all regions set for export into a directory hierarchy rooted at path '''
+        if self.export_format == 'hdf5':
+            self._file_save_hdf5(path)
+            return
+
         # Export all regions in all groups
         there_were_errors = False            # Reset error flag
         for g in self.specs_file.specs_groups:
@@ -546,15 +492,32 @@ class TreePanel(HasTraits):
                 # Column data contains the following in left-to-right order:
                 # x-axis, counts, channel_counts_n and extended_channels_n
 
-                if r.selection.counts:
+                if r.is_selected():
                     dir_path = os.path.join(path, g.name)
-                    region_errors, err_msg = self._export_region(r, dir_path)
+                    region_errors, err_msg = self._export_region(r.for_export(), dir_path)
                     if region_errors:
                         there_were_errors = True
                         error_dialog_message = err_msg
         if there_were_errors:
             error(None, error_dialog_message)   # throw up an error message dialog
 
+    def _file_save_hdf5(self, path):
+        ''' Saves all regions set for export into one HDF5 file in the directory path,
+        named after the SPECS file '''
+        if export.h5py is None:
+            error(None, 'HDF5 export needs the h5py package, which is not installed')
+            return
+        groups = [(g.name, [r.for_export() for r in g.specs_regions if r.is_selected()])
+                  for g in self.specs_file.specs_groups]
+        stem = os.path.splitext(os.path.basename(self.specs_file.name))[0]
+        filename = os.path.join(path, stem + '.h5')
+        errors = export.export_hdf5(filename, groups, self.get_normalisation_mode(),
+                                    tree_panel.extended_channel_ref, self.norm_ref,
+                                    cache=self.normalisation_cache)
+        print filename, 'written'
+        if errors:
+            error(None, errors[-1][1])          # throw up an error message dialog
+
     def _bt_export_file_changed(self):
         ''' Button event handler
         Called when the user clicks the Export... button
@@ -592,11 +555,13 @@ class TreePanel(HasTraits):
         associated with the referenced region into the current tree selection
         '''
         if self.ref is not None:
-            trait_dict = self.ref.selection.get_trait_states()
+            source = self.ref.selection
             for r in tree_panel.node_selection:
                 if isinstance(r, SpRegion):
-                    # paste all counts, channel_counts_ and extended_channels_ states
-                    r.selection.set(**trait_dict)
+                    # paste all counts, channel_counts_ and extended_channels_ states,
+                    # leaving any checkboxes the source doesn't have as they are
+                    r.selection.set_selection_mask(source.selection_mask,
+                                                   source.checkboxes_mask)
 
     def _bt_set_reference_changed(self):
         ''' Sets the current tree node object as the source for normalisation. '''
@@ -633,15 +598,15 @@ class TreePanel(HasTraits):
         main_app.selector_panel = self.selection
 
         lookup = scan_mode_lookup(self.region.scan_mode)
-        # Remove current plots from the plot window foreground layer
-        plot_panel.remove_all_plots(draw_layer='foreground')
-        # Add any checked counts and channels to the plot window foreground layer
-        plot_panel.set_x_orientation(lookup['orientation']) # set increasing or decreasing
-        self.selection.plot_checkbox_states()
-        # update the x-axis label
-        plot_panel.set_x_label(lookup['label'])
-        # Reset the view limits
-        plot_panel.reset_view()
+        with plot_panel.batch_redraw():
+            plot_panel.set_x_orientation(lookup['orientation']) # set increasing or decreasing
+            # Replace the plots in the plot window foreground layer with the checked
+            # counts and channels, updating those of series already shown in place
+            self.selection.plot_checkbox_states()
+            # update the x-axis label
+            plot_panel.set_x_label(lookup['label'])
+            # Reset the view limits
+            plot_panel.reset_view()
 
     def _group_dclick(self):
         ''' Double-clicking a node cycles through selection states of subordinate regions
@@ -649,15 +614,16 @@ class TreePanel(HasTraits):
         '''
         try:
             GUI.set_busy()                      # set hourglass         @UndefinedVariable
-            region_state = {r.selection.counts for r in self.specs_regions}
-            if True in region_state:
-                # at least one of the regions is enabled, disable all
-                for r in self.specs_regions:
-                    r.selection.region_cycle(all_off=True)
-            else:
-                # enable all counts
-                for r in self.specs_regions:
-                    r.selection.region_cycle(counts_only=True)
+            with plot_panel.batch_redraw():
+                region_state = {r.is_selected() for r in self.specs_regions}
+                if True in region_state:
+                    # at least one of the regions is enabled, disable all
+                    for r in self.specs_regions:
+                        r.selection.region_cycle(all_off=True)
+                else:
+                    # enable all counts
+                    for r in self.specs_regions:
+                        r.selection.region_cycle(counts_only=True)
         except:
             pass
         GUI.set_busy(False)                     # reset hourglass       @UndefinedVariable
@@ -674,12 +640,13 @@ class TreePanel(HasTraits):
         ''' Cycle the region selection states of a region or all regions in a group '''
         try:
             GUI.set_busy()                      # set hourglass         @UndefinedVariable
-            for n in self.node_selection:
-                if isinstance(n, SpRegion):
-                    n.selection.region_cycle()
-                elif isinstance(n, SpGroup):
-                    for r in n.specs_regions:
-                        r.selection.region_cycle()
+            with plot_panel.batch_redraw():
+                for n in self.node_selection:
+                    if isinstance(n, SpRegion):
+                        n.selection.region_cycle()
+                    elif isinstance(n, SpGroup):
+                        for r in n.specs_regions:
+                            r.selection.region_cycle()
         except:
             pass
         GUI.set_busy(False)                     # reset hourglass       @UndefinedVariable
@@ -690,14 +657,15 @@ class TreePanel(HasTraits):
         '''
         try:
             GUI.set_busy()                      # set hourglass         @UndefinedVariable
-            for n in selection:
-                if isinstance(n, SpRegion):
-                    n.selection.counts = \
-                        not n.selection.counts if set_state=='toggle' else set_state
-                elif isinstance(n, SpGroup):
-                    for r in n.specs_regions:
-                        r.selection.counts = \
-                            not r.selection.counts if set_state=='toggle' else set_state
+            with plot_panel.batch_redraw():
+                for n in selection:
+                    if isinstance(n, SpRegion):
+                        n.selection.counts = \
+                            not n.selection.counts if set_state=='toggle' else set_state
+                    elif isinstance(n, SpGroup):
+                        for r in n.specs_regions:
+                            r.selection.counts = \
+                                not r.selection.counts if set_state=='toggle' else set_state
         except:
             pass
         GUI.set_busy(False)                     # reset hourglass       @UndefinedVariable
@@ -857,13 +825,20 @@ class TreePanel(HasTraits):
                         ),
                         VGroup(
                             HGroup(
-                                Item('cb_header', label='Include header'),
-                                Item('delimiter'),
+                                Item('cb_header', label='Include header',
+                                     enabled_when="object.export_format == 'xy'"),
+                                Item('delimiter',
+                                     enabled_when="object.export_format == 'xy'"),
+                                Item('export_format', label='Format'),
                             ),
                             enabled_when = 'object._has_data()',
                             label = 'Data export settings',
                             show_border = True,
                         ),
+                        HGroup(
+                            Item('cb_follow', label='Follow file',
+                                 tooltip='Add regions to the tree as they are acquired'),
+                        ),
                         UItem(
                             name = 'specs_file',
                             editor = tree_editor,
@@ -880,6 +855,12 @@ class PlotPanel(HasTraits):
     plot_data = Instance(ArrayPlotData)
     plot = Instance(Plot)
     LAYERS = ['background', 'foreground', 'highlight']
+    renderers = Dict            # {draw_layer: {name: renderer}} for the live plots
+    series = Dict               # {renderer name: series name} of the live plots
+    pyramids = Dict             # {plot data name: decimation.MinMaxPyramid} of long series
+    _lod_view = Any()           # The (low, high, width) their envelopes were drawn for
+    _redraw_depth = Int(0)      # Depth of nested batch_redraw() blocks
+    _redraw_pending = Bool(False)
 
     def __init__(self, **traits):
         class MyPlotClass(Plot):
@@ -906,23 +887,75 @@ class PlotPanel(HasTraits):
         plot = self.add_plot('tool_plot', [0,1], [0,1], bgcolor='white', color='transparent')
         self.value_mapper, self.index_mapper = self._setup_plot_tools(plot)
 
-    def add_plot(self, name, xs, ys, draw_layer='foreground', **lineplot_args):
+        # Redraw the envelopes of long series whenever the view is zoomed, panned or
+        # resized
+        self.plot.index_range.on_trait_change(self._update_envelopes, 'updated')
+        self.plot.on_trait_change(self._update_envelopes, 'bounds')
+
+    def add_plot(self, name, xs, ys, draw_layer='foreground', series=None,
+                 **lineplot_args):
         ''' Call to add a line plot with data in the xs and ys 1D arrays.
         The plot is referred to by the name string, which is uniquely built from the
-        region and channel id.
+        region and channel id, and series is the name of the series it shows, e.g.
+        'counts', which defaults to name. If the plot already exists its data are
+        updated in place and lineplot_args applied to it, keeping its renderer.
         '''
         assert(draw_layer in self.LAYERS)
-        name = '_'.join([draw_layer, name])
-        self.plot_data.set_data(name+'_xs', xs)
-        self.plot_data.set_data(name+'_ys', ys)
-        renderer = self.plot.plot((name+'_xs', name+'_ys'),
-                                   name=name, type='line',
-                                   **lineplot_args)[0]
-        renderer.set(draw_layer=draw_layer)
+        layer = self.renderers.setdefault(draw_layer, {})
+        renderer = layer.get(name)
+        if renderer is None:
+            full_name = self._new_plot_name(draw_layer, name)
+            self._set_plot_data(full_name, xs, ys)
+            renderer = self.plot.plot((full_name+'_xs', full_name+'_ys'),
+                                       name=full_name, type='line',
+                                       **lineplot_args)[0]
+            renderer.set(draw_layer=draw_layer)
+            layer[name] = renderer
+        else:
+            self._set_plot_data(renderer.name, xs, ys)
+            if lineplot_args:
+                renderer.set(**lineplot_args)
+        self.series[renderer.name] = series or name
 
-        self.plot.request_redraw()
+        self.request_redraw()
         return self.plot
 
+    def _new_plot_name(self, draw_layer, name):
+        ''' The name of the chaco plot, and the prefix of the names of its data, for a
+        new plot name in draw_layer. This is draw_layer_name unless a renderer that has
+        moved on to another plot (see set_plots) still has that name.
+        '''
+        full_name = base = '_'.join([draw_layer, name])
+        n = 1
+        while full_name in self.plot.plots:
+            full_name = '{}_{}'.format(base, n)
+            n += 1
+        return full_name
+
+    def set_plots(self, plots, draw_layer='foreground'):
+        ''' Make the plots in draw_layer those in plots, a list of
+        (name, series, xs, ys, lineplot_args) tuples as for add_plot. A plot already there
+        that isn't in plots passes its renderer on to a new plot of the same series, whose
+        data replace its own in place, so only the renderers of series that appear or
+        disappear are added or removed.
+        '''
+        assert(draw_layer in self.LAYERS)
+        layer = self.renderers.setdefault(draw_layer, {})
+        names = set(name for name, series, xs, ys, lineplot_args in plots)
+        spare = {}
+        for name in layer.keys():
+            if name not in names and name != 'tool_plot':
+                renderer = layer.pop(name)
+                spare.setdefault(self.series[renderer.name], []).append(renderer)
+        with self.batch_redraw():
+            for name, series, xs, ys, lineplot_args in plots:
+                if name not in layer and spare.get(series):
+                    layer[name] = spare[series].pop()
+                self.add_plot(name, xs, ys, draw_layer, series, **lineplot_args)
+            for renderers in spare.values():
+                for renderer in renderers:
+                    self._delete_renderer(renderer)
+
     def remove_plot(self, name, draw_layer='foreground'):
         ''' Remove any plot referred to by the name id string (except tool_plot).
         '''
@@ -930,18 +963,29 @@ class PlotPanel(HasTraits):
         if name == 'tool_plot':
             # Never remove this one since the chaco tools are attached to it 
             return
-        if name.split('_')[0] not in self.LAYERS:
-            name = '_'.join([draw_layer, name])
-        try:
-            self.plot_data.del_data(name+'_xs')
-            self.plot_data.del_data(name+'_ys')
-            self.plot.delplot(name)
-            # Invalidate the datasources as chaco maintains a cache:
+        if name.split('_')[0] in self.LAYERS:
+            draw_layer, name = name.split('_', 1)
+        self._delete_plot(draw_layer, name)
+
+    def _delete_plot(self, draw_layer, name):
+        ''' Delete the plot name from draw_layer, if it is there. '''
+        renderer = self.renderers.get(draw_layer, {}).pop(name, None)
+        if renderer is not None:
+            self._delete_renderer(renderer)
+
+    def _delete_renderer(self, renderer):
+        ''' Delete renderer, which is no longer in the registry, and its data. '''
+        full_name = renderer.name
+        self.pyramids.pop(full_name, None)
+        self.series.pop(full_name, None)
+        self.plot.delplot(full_name)
+        for data_name in (full_name+'_xs', full_name+'_ys'):
+            self.plot_data.del_data(data_name)
+            # chaco caches a datasource for each data name, which would otherwise be
+            # reused for new data of the same name; drop just this plot's:
             # See http://thread.gmane.org/gmane.comp.python.chaco.user/658/focus=656
-            self.plot.datasources.clear()
-        except KeyError:
-            pass
-        self.plot.request_redraw()
+            self.plot.datasources.pop(data_name, None)
+        self.request_redraw()
 
     def update_plot_data(self, name, data, x_or_y='y', draw_layer='foreground', **lineplot_args):
         ''' Call this to update the x or y data for an existing line plot. Specify whether
@@ -949,10 +993,49 @@ class PlotPanel(HasTraits):
         should match those of the corresponding data (e.g. the x-data if x_or_y=='y')
         '''
         assert(draw_layer in self.LAYERS)
-        name = '_'.join([draw_layer, name])
-        xy_suffix = {'x':'_xs', 'y':'_ys'}[x_or_y]
-        self.plot_data.set_data(name+xy_suffix, data)
-        self.plot.request_redraw()
+        name = self.renderers[draw_layer][name].name
+        pyramid = self.pyramids.get(name)
+        if pyramid is not None:
+            if x_or_y == 'x':
+                self._set_plot_data(name, data, pyramid.ys)
+            else:
+                self._set_plot_data(name, pyramid.xs, data)
+        else:
+            xy_suffix = {'x':'_xs', 'y':'_ys'}[x_or_y]
+            self.plot_data.set_data(name+xy_suffix, data)
+        self.request_redraw()
+
+    def _set_plot_data(self, name, xs, ys):
+        ''' Give the plot data named name the values xs and ys or, if they are longer
+        than LOD_MIN_POINTS, their min/max envelope over the current view.
+        '''
+        if len(ys) > LOD_MIN_POINTS:
+            pyramid = self.pyramids[name] = decimation.MinMaxPyramid(xs, ys)
+            xs, ys = pyramid.envelope(*self._get_lod_view())
+        else:
+            self.pyramids.pop(name, None)
+        self.plot_data.set_data(name+'_xs', xs)
+        self.plot_data.set_data(name+'_ys', ys)
+
+    def _get_lod_view(self):
+        ''' The x-range and pixel width the envelopes of long series are drawn for. '''
+        index_range = self.plot.index_range
+        return index_range.low, index_range.high, max(int(self.plot.width), 100)
+
+    def _update_envelopes(self):
+        ''' Redraw the envelopes of the long series for the current view. This is
+        called when the view changes, and, as changing the data can update the view,
+        does nothing if it is the same as when they were last drawn.
+        '''
+        view = self._get_lod_view()
+        if view == self._lod_view or not self.pyramids:
+            return
+        self._lod_view = view
+        for name, pyramid in self.pyramids.items():
+            xs, ys = pyramid.envelope(*view)
+            self.plot_data.set_data(name+'_xs', xs)
+            self.plot_data.set_data(name+'_ys', ys)
+        self.request_redraw()
 
     def remove_all_plots(self, draw_layer=None):
         ''' When draw_layer is None, removes all plots from all layers (except 'tool_plot'
@@ -960,9 +1043,31 @@ class PlotPanel(HasTraits):
         draw_layer which is assumed to one of the values in the LAYERS list.
         '''
         assert(draw_layer in (self.LAYERS + [None]))
-        for p in plot_panel.plot.plots.keys():
-            if (draw_layer is None) or (p.split('_')[0] == draw_layer):
-                plot_panel.remove_plot(p)
+        with self.batch_redraw():
+            for layer in (self.LAYERS if draw_layer is None else [draw_layer]):
+                for name in self.renderers.get(layer, {}).keys():
+                    self._delete_plot(layer, name)
+
+    @contextmanager
+    def batch_redraw(self):
+        ''' Context for making many changes to the plots, within which the plot is
+        redrawn only once, when the outermost block ends.
+        '''
+        self._redraw_depth += 1
+        try:
+            yield
+        finally:
+            self._redraw_depth -= 1
+            if self._redraw_depth == 0 and self._redraw_pending:
+                self._redraw_pending = False
+                self.plot.request_redraw()
+
+    def request_redraw(self):
+        ''' Ask for the plot to be redrawn, once any batch_redraw() has ended. '''
+        if self._redraw_depth:
+            self._redraw_pending = True
+        else:
+            self.plot.request_redraw()
 
     def get_plot(self, name, draw_layer=None):
         ''' Get a plot reference from the name by prepending the draw_layer string if
@@ -970,7 +1075,7 @@ class PlotPanel(HasTraits):
         '''
         assert(draw_layer in (self.LAYERS + [None]))
         if draw_layer is not None:
-            name = '_'.join([draw_layer, name])
+            return self.renderers[draw_layer][name]
         return self.plot.plots[name][0]
 
     def set_plot_attributes(self, name, draw_layer='foreground', **attributes):
@@ -978,27 +1083,29 @@ class PlotPanel(HasTraits):
         referred to by the name string.
         '''
         assert(draw_layer in self.LAYERS)
-        name = '_'.join([draw_layer, name])
         try:
-            for key, value in attributes.iteritems():
-                setattr(self.plot.plots[name][0], key, value)
+            renderer = self.renderers[draw_layer][name]
         except KeyError:
-            pass
+            return
+        for key, value in attributes.iteritems():
+            setattr(renderer, key, value)
 
     def set_x_label(self, label):
         ''' Set the axis label to the label string '''
         self.plot.x_axis.title = label
 
     def set_x_orientation(self, orientation):
-        ''' Sets the x-axis orientation to increasing or decreasing. This should be
-        called before any plots are added as any existing visible plots won't be
-        automatically updated.
+        ''' Sets the x-axis orientation to increasing or decreasing, for new plots and
+        for those of the foreground layer that set_plots may keep.
         '''
         assert(orientation in ['normal', 'reversed'])
         if orientation == 'normal':
             self.plot.default_origin = 'bottom left'
         else:
             self.plot.default_origin = 'bottom right'
+        for name, renderer in self.renderers.get('foreground', {}).items():
+            if name != 'tool_plot':
+                renderer.origin = self.plot.default_origin
 
     def _setup_plot_tools(self, plot):
         ''' Sets up the background, and several tools on a plot '''
@@ -1031,28 +1138,6 @@ class PlotPanel(HasTraits):
                     )
 
 
-def get_name_body(series_name):
-    ''' Get first part of name
-    e.g. get_name_body('foo_bar_baz') returns foo_bar
-    '''
-    return '_'.join(series_name.split('_')[:2])
-
-def get_name_num(series_name):
-    ''' Get last part of name.
-    e.g. get_name_num('foo_bar_baz') returns baz
-    '''
-    return int(series_name.split('_')[-1])
-
-def is_bool_trait(obj, t):
-    ''' Return true iff t evaluates to a bool when accessed as an attribute,
-    such as a Bool trait 
-    '''
-    try:
-        return type(obj.__getattribute__(t)) is bool
-    except AttributeError:
-        return False
-
-
 class SelectorPanel(HasTraits):
     '''
     A panel of checkboxes reflecting the channels within the specs region used for
@@ -1089,6 +1174,16 @@ class SelectorPanel(HasTraits):
     text_divider = '/'
     text_reflabel = 'ref:'
     toggle_to_force_refresh = Bool(False)   # Used by the refresh_dbl_norm_ref() method 
+    # The checkbox states as a bitmask, see export.selection_bit(), kept in step with
+    # the checkbox traits
+    selection_mask = Int(0)
+    checkboxes = List               # (trait name, bit) of each checkbox, counts last
+    channel_counts_mask = Int(0)    # The bits of the channel_counts_n checkboxes
+    extended_channels_mask = Int(0) # The bits of the extended_channels_n checkboxes
+    checkboxes_mask = Int(0)        # The bits of all the checkboxes
+    _batch_depth = Int(0)           # Depth of nested batch_update() blocks
+    _batch_start = Int(0)           # selection_mask when the outermost one began
+    _batch_replot = List            # Series to plot afresh when it ends
 
     def __init__(self, region=None, **traits):
         super(SelectorPanel, self).__init__(**traits)   # HasTraits.__init__(self, **traits)
@@ -1097,23 +1192,34 @@ class SelectorPanel(HasTraits):
         self.region = region
 
         # create a trait for the counts checkbox
-        self.add_trait('counts', Bool(True))
+        self.add_trait('counts', Bool(DEFAULT_SELECTION['counts']))
 
         # create traits for each channel_counts_n checkbox
-        if region.region.channel_counts is not None:
-            channel_counts_len = region.region.channel_counts.shape[1]
-            for i in range(channel_counts_len):
-                self.add_trait('channel_counts_{}'.format(i+1), Bool(True))
-            # use self._instance_traits() to list these traits
+        channel_counts_len = region.get_channel_counts_len()
+        for i in range(channel_counts_len):
+            self.add_trait('channel_counts_{}'.format(i+1),
+                           Bool(DEFAULT_SELECTION['channel_counts']))
+        # self.checkboxes lists these traits, with their bits in selection_mask
 
         # create traits for each extended_channels_n checkbox
-        if region.region.extended_channels is not None:
-            extended_channels_len = region.region.extended_channels.shape[1]
-            for i in range(extended_channels_len):
-                self.add_trait('extended_channels_{}'.format(i+1), Bool)
+        extended_channels_len = region.get_extended_channels_len()
+        for i in range(extended_channels_len):
+            self.add_trait('extended_channels_{}'.format(i+1),
+                           Bool(DEFAULT_SELECTION['extended_channels']))
         # Now we've created all the Bool/checkbox traits default_traits_view() can
         # create a view for them.
 
+        names = ['channel_counts_{}'.format(i+1) for i in range(channel_counts_len)] + \
+                ['extended_channels_{}'.format(i+1) for i in range(extended_channels_len)] + \
+                ['counts']
+        self.checkboxes = [(name, selection_bit(name)) for name in names]
+        self.channel_counts_mask = channels_mask('channel_counts', channel_counts_len)
+        self.extended_channels_mask = channels_mask('extended_channels',
+                                                    extended_channels_len)
+        self.checkboxes_mask = sum(bit for name, bit in self.checkboxes)
+        self.selection_mask = sum(bit for name, bit in self.checkboxes
+                                  if self.__getattribute__(name))
+
         self.cycle_state = 'counts_on'
 
     def _norm_reference_set(self):
@@ -1152,7 +1258,7 @@ class SelectorPanel(HasTraits):
             return group
 
         items = []
-        if 'counts' in self._instance_traits():
+        if self.checkboxes:
             group1 = HGroup()
             group1.content = []
 
@@ -1236,6 +1342,9 @@ class SelectorPanel(HasTraits):
         ''' Trait event handler
         The counts checkbox was toggled
         '''
+        self._set_bit(trait, new)
+        if self._batch_depth:
+            return
         if new:
             self._add_plot(self.region, trait)
         else:
@@ -1243,44 +1352,116 @@ class SelectorPanel(HasTraits):
         self.region.update_label()
 
     def refresh_counts(self):
-        ''' Refresh counts computation and plot series by toggling one of the
-        channel_counts_ series to cause a _channel_counts_x_changed() trait change event.
+        ''' Refresh counts computation and plot series. '''
+        with self.batch_update():
+            self._batch_replot.append('counts')
+
+    def _set_bit(self, trait, new):
+        ''' Set the bit of the checkbox trait in selection_mask to new. '''
+        if new:
+            self.selection_mask |= selection_bit(trait)
+        else:
+            self.selection_mask &= ~selection_bit(trait)
+
+    def set_selection_mask(self, mask, available=~0):
+        ''' Set the checkboxes to the states in the selection bitmask mask, as one
+        batch_update(). Only the checkboxes with bits in the bitmask available are set;
+        the bits of checkboxes this panel doesn't have are ignored.
+        '''
+        changed = (mask ^ self.selection_mask) & available
+        with self.batch_update():
+            self.trait_set(**{name: bool(mask & bit) for name, bit in self.checkboxes
+                              if changed & bit})
+
+    @contextmanager
+    def batch_update(self):
+        ''' Context for changing many checkboxes at once. The checkbox trait handlers
+        do nothing within it; instead, when the outermost block ends, the checkbox states
+        are compared with those when it began and only the differences are applied: the
+        plots of the series turned off are removed and those turned on added, counts is
+        recomputed once if any channel_counts_n changed and the tree label is updated.
+        Series named in _batch_replot are plotted afresh even if they didn't change.
         '''
-        self.channel_counts_1 = not self.channel_counts_1 
-        self.channel_counts_1 = not self.channel_counts_1 
+        if self._batch_depth == 0:
+            self._batch_start = self.selection_mask
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                with plot_panel.batch_redraw():
+                    self._apply_batch(self._batch_start, self.selection_mask)
+
+    def _apply_batch(self, before, after):
+        ''' Bring the counts, plots and tree label up to date with the change of
+        selection_mask from before to after, at the end of a batch_update(). '''
+        replot = set(self._batch_replot)
+        self._batch_replot = []
+        toggled = (before ^ after) & self.channel_counts_mask
+        if toggled and not toggled & (toggled - 1):
+            # Just one channel changed
+            trait = 'channel_counts_{}'.format(toggled.bit_length() - 1)
+            self._update_counts(trait, after & toggled)
+        elif toggled or 'counts' in replot:
+            self.region.region.counts = self.compute_counts()
+        if toggled:
+            replot.add('counts')
+        if not replot and after == before:
+            return
+
+        # Plot counts last, on top of the channels, as when toggled on its own. Series
+        # that stay on are replotted in place.
+        for trait, bit in self.checkboxes:
+            if before & bit and not after & bit:
+                self._remove_plot(self.region, trait)
+            elif after & bit and (not before & bit or trait in replot):
+                self._add_plot(self.region, trait)
+        self.region.update_label()
 
     def compute_counts(self):
         ''' compute counts
         channel_counts is an n-column (n=9) x m-row array
         Make a mask corresponding to the checkbox state then sum the corresponding columns
         '''
-        cc_dict = self.get_channel_counts_states()
-        mask = np.array([cc_dict[i] for i in sorted(cc_dict)])
-        counts = self.region.region.channel_counts[:,mask].sum(axis=1)
-        return counts
+        return normalisation.compute_counts(self.region.region.channel_counts,
+                                            self.get_channel_counts_states())
 
     @on_trait_change('channel_counts_+')
     def _channel_counts_x_changed(self, container, trait, new):
         ''' Trait event handler
         A channel_counts_n checkbox was toggled
         '''
-        # add or remove the channel counts plot from screen
+        self._set_bit(trait, new)
+        if self._batch_depth:
+            return
+        with plot_panel.batch_redraw():
+            # add or remove the channel counts plot from screen
+            if new:
+                self._add_plot(self.region, trait)
+            else:
+                self._remove_plot(self.region, trait)
+
+            self._update_counts(trait, new)
+            self._counts_data_changed()
+
+    def _update_counts(self, trait, new):
+        ''' Add the column of channel trait to counts if it was selected or subtract it
+        if it was deselected, instead of summing all the selected columns again. The
+        channel counts are sums of whole numbers of counts, so this is exact.
+        '''
+        column = self.region.region.channel_counts[:, get_name_num(trait)-1]
         if new:
-            self._add_plot(self.region, trait)
+            self.region.region.counts = self.region.region.counts + column
         else:
-            self._remove_plot(self.region, trait)
-
-        self.region.region.counts = self.compute_counts()
+            self.region.region.counts = self.region.region.counts - column
 
-        # update the counts series plot data
-        # This is done by toggling the counts plot off and on again if it is currently on
-        # I tried this by directly updating the counts y-data which should trigger a chaco
-        # update, but there seems to be a bug in chaco that makes updating the 
-        # series flaky - it doesn't always update the plot. This way works by triggering
-        # the _counts_changed() event
+    def _counts_data_changed(self):
+        ''' Update the counts plot and the tree label after counts has changed. '''
+        # update the counts series plot data in place. New arrays are always given to
+        # the plot, as chaco doesn't notice arrays changed in place.
         if self.counts:
-            self.counts = False
-            self.counts = True
+            self._add_plot(self.region, 'counts')
 
         # update the tree label to indicate the selection
         self.region.update_label()
@@ -1290,6 +1471,9 @@ class SelectorPanel(HasTraits):
         ''' Trait event handler
         An extended_channels_n checkbox was toggled
         '''
+        self._set_bit(trait, new)
+        if self._batch_depth:
+            return
         if new:
             self._add_plot(self.region, trait)
         else:
@@ -1311,8 +1495,15 @@ class SelectorPanel(HasTraits):
 
     def _add_plot(self, region, series_name):
         ''' Adds a plot to the chaco plot widget. '''
+        name, series_name, xs, ys, line_attributes = self._plot_args(region, series_name)
+        plot_panel.add_plot(name, xs, ys, series=series_name, **line_attributes)
+
+    def _plot_args(self, region, series_name):
+        ''' Return the (name, series_name, xs, ys, line_attributes) of the plot of
+        series_name, as PlotPanel.set_plots takes them.
+        '''
         name = self._name_plot(region, series_name)
-        xs = self.region.get_x_axis()
+        xs = np.asarray(self.region.get_x_axis())
         if series_name == 'counts':
             series_name_body = 'counts'
             ys = self.region.region.counts
@@ -1337,7 +1528,7 @@ class SelectorPanel(HasTraits):
             'channel_counts'    : {'color':'blue' , 'width':1.5},
             'extended_channels' : {'color':'red'  , 'width':1.5},
             }[series_name_body]
-        plot_panel.add_plot(name, xs, ys, **line_attributes)
+        return name, series_name, xs, ys, line_attributes
 
     def _remove_plot(self, region, series_name):
         ''' Call plot widget to remove it and delete the reference here. '''
@@ -1345,125 +1536,102 @@ class SelectorPanel(HasTraits):
         plot_panel.remove_plot(name)
 
     def _refresh_current_view(self):
-        ''' Toggle off and on all boolean/checkbox traits in the current selection.
+        ''' Replot all the series checked in the current selection, recomputing counts.
         This is intended to be called when the normalisation reference channel is updated
         to force replotting and recalculation of the data. '''
-        trait_dict = self.get_trait_states()
-        true_traits = [i for i in trait_dict if trait_dict[i]]
-        params_to_reset_traits = {i:False for i in true_traits}
-        params_to_set_traits = {i:True for i in true_traits}
-        # toggle off then on
-        self.set(**params_to_reset_traits)
-        self.set(**params_to_set_traits)
+        mask = self.selection_mask
+        with self.batch_update():
+            self._batch_replot.extend(name for name, bit in self.checkboxes if mask & bit)
 
     def plot_checkbox_states(self):
-        ''' Add plots to the default (foreground) layer reflecting the checkbox states.
+        ''' Make the plots of the default (foreground) layer those of the checkbox
+        states, reusing the renderers of any series already plotted there.
         '''
-        trait_dict = self.get_trait_states()
-        for trait, val in trait_dict.iteritems():
-            if val:
-                # counts, channel_counts_+, extended_channels_+
-                self._add_plot(self.region, trait)
+        mask = self.selection_mask
+        # counts, channel_counts_+, extended_channels_+
+        plot_panel.set_plots([self._plot_args(self.region, trait)
+                              for trait, bit in self.checkboxes if mask & bit])
 
     def get_trait_states(self):
         ''' Return a dictionary of all trait_name:value entries with associated
         checkboxes in this selector panel.
         '''
-        # I don't know how to evaluate the trait values directly from _instance_traits()
-        # so I use it to get the names then use __getattribute__() to evaluate them.
-        trait_dict = {i: self.__getattribute__(i)
-                      for i in self._instance_traits()
-                      if is_bool_trait(self, i)}
-        return trait_dict
+        return self._states(~0)
 
     def get_channel_counts_states(self):
         ''' Return a dictionary of trait_name:value entries associated with the
         channel_counts_ checkboxes in the selector panel.
         '''
-        trait_dict = {i: self.__getattribute__(i)
-                      for i in self._instance_traits()
-                      if get_name_body(i)=='channel_counts'}
-        return trait_dict
+        return self._states(self.channel_counts_mask)
 
     def get_extended_channels_states(self):
         ''' Return a dictionary of trait_name:value entries associated with the
         extended_channels_ checkboxes in the selector panel.
         '''
-        trait_dict = {i: self.__getattribute__(i)
-                      for i in self._instance_traits()
-                      if get_name_body(i)=='extended_channels'}
-        return trait_dict
+        return self._states(self.extended_channels_mask)
+
+    def _states(self, bits):
+        ''' Return a dictionary of trait_name:value entries for the checkboxes whose bits
+        are in bits. '''
+        mask = self.selection_mask
+        return {name: bool(mask & bit) for name, bit in self.checkboxes if bits & bit}
 
     def region_cycle(self, all_off=False, counts_only=False):
         ''' Cycle the state of the selected channels.
         '''
+        mask = self.selection_mask
+        channel_counts = self.channel_counts_mask
         if all_off:
-            self.trait_set(**{i: False for i in self._instance_traits()
-                              if is_bool_trait(self, i)})
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if get_name_body(i)=='channel_counts'})
-            self.counts = False
+            self.set_selection_mask(channel_counts)
             self.cycle_state = 'channels_on'
             return
 
         if counts_only:
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if get_name_body(i)=='channel_counts'})
-            self.counts = True
+            self.set_selection_mask(mask | channel_counts | COUNTS_BIT)
             self.cycle_state = 'counts_on'
             return
 
         if self.cycle_state == 'counts_on':
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if get_name_body(i)=='channel_counts'})
-            self.counts = False
+            self.set_selection_mask((mask | channel_counts) & ~COUNTS_BIT)
             self.cycle_state = 'channels_on'
         elif self.cycle_state == 'channels_on':
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if is_bool_trait(self, i)})
-            self.counts = True
+            self.set_selection_mask(channel_counts | self.extended_channels_mask |
+                                    COUNTS_BIT)
             self.cycle_state = 'all_on'
         elif self.cycle_state == 'all_on':
-            self.trait_set(**{i: False for i in self._instance_traits()
-                              if is_bool_trait(self, i)})
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if get_name_body(i)=='channel_counts'})
-            self.counts = True
+            self.set_selection_mask(channel_counts | COUNTS_BIT)
             self.cycle_state = 'counts_on'
 
     def _bt_cycle_channel_counts_changed(self):
         ''' Toggle the state of the counts channels.
         '''
-        channel_counts_states = self.get_channel_counts_states().values()
-        if (False in channel_counts_states) and (True in channel_counts_states):
+        channel_counts = self.channel_counts_mask
+        states = self.selection_mask & channel_counts
+        if states and states != channel_counts:
             self.cycle_channel_counts_state = 'all_off'
 
         if self.cycle_channel_counts_state == 'all_on':
-            self.trait_set(**{i: False for i in self._instance_traits()
-                              if get_name_body(i)=='channel_counts'})
+            self.set_selection_mask(self.selection_mask & ~channel_counts)
             self.cycle_channel_counts_state = 'all_off'
         else:
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if get_name_body(i)=='channel_counts'})
+            self.set_selection_mask(self.selection_mask | channel_counts)
             self.cycle_channel_counts_state = 'all_on'
 
     def _bt_cycle_extended_channels_changed(self):
         ''' Toggle the state of the counts channels.
         '''
-        extended_channels_states = self.get_extended_channels_states().values()
-        if (False in extended_channels_states) and (True in extended_channels_states):
+        extended_channels = self.extended_channels_mask
+        states = self.selection_mask & extended_channels
+        if states and states != extended_channels:
             self.cycle_extended_channels_state = 'all_off'
 
         if self.cycle_extended_channels_state == 'all_on':
-            self.trait_set(**{i: False for i in self._instance_traits()
-                              if get_name_body(i)=='extended_channels'})
+            self.set_selection_mask(self.selection_mask & ~extended_channels)
             self.cycle_extended_channels_state = 'all_off'
         else:
-            self.trait_set(**{i: True for i in self._instance_traits()
-                              if get_name_body(i)=='extended_channels'})
+            self.set_selection_mask(self.selection_mask | extended_channels)
             self.cycle_extended_channels_state = 'all_on'
 
-
 # The application menu bar
 menubar = MenuBar(
     Menu(
@@ -1604,6 +1772,8 @@ class MainApp(HasTraits):
 
 
 if __name__ == "__main__":
+    # Needed for the parsing process pool in a frozen Windows executable
+    multiprocessing.freeze_support()
     exec(open('version.py').read())    # get __version__ variable
 
     np.seterr(divide='ignore', invalid='ignore')
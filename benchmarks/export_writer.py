@@ -0,0 +1,62 @@
+'''
+Benchmark of the .xy column writer used by export.write_region(), export.write_columns(),
+against np.savetxt, which it replaced. Run from anywhere with
+
+    python benchmarks/export_writer.py [points] [columns] [repeats]
+
+The default of 50000 points by 19 columns is a survey scan exported with counts, nine
+channels and nine extended channels. The outputs are also checked to be identical.
+'''
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import export
+
+
+def savetxt(f, a, delimiter):
+    np.savetxt(f, a, fmt='%1.8g', delimiter=delimiter)
+
+
+def best_time(writer, a, filename, repeats):
+    ''' Return the best of repeats times to write a to filename with writer. '''
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        with open(filename, 'w') as f:
+            writer(f, a, '\t')
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(points=50000, columns=19, repeats=5):
+    rng = np.random.RandomState(0)
+    a = np.empty((points, columns))
+    a[:, 0] = np.linspace(280., 320., points)                       # x-axis
+    a[:, 1:] = rng.poisson(1000, (points, columns-1)) * rng.rand(columns-1)
+
+    fd, filename = tempfile.mkstemp(suffix='.xy')
+    os.close(fd)
+    try:
+        t_savetxt = best_time(savetxt, a, filename, repeats)
+        with open(filename) as f:
+            expected = f.read()
+        t_columns = best_time(export.write_columns, a, filename, repeats)
+        with open(filename) as f:
+            identical = f.read() == expected
+    finally:
+        os.remove(filename)
+
+    print '{} points x {} columns, best of {}'.format(points, columns, repeats)
+    print 'np.savetxt             {:8.3f} s'.format(t_savetxt)
+    print 'export.write_columns   {:8.3f} s   ({:.1f}x)'.format(t_columns, t_savetxt/t_columns)
+    print 'identical output:', identical
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,86 @@
+'''
+Min/max decimation of long series for plotting.
+
+A line plot can't show more detail than there are pixels across it, so a series much
+longer than that is drawn from its min/max envelope instead: the view is split into
+about one bin per pixel and only the samples holding the minimum and maximum of each
+bin are drawn, which traces the same outline as the full series. The bins come from a
+pyramid of levels precomputed once per series, so the envelope of any view is found
+without looking at every sample in it.
+'''
+
+import numpy as np
+
+
+class MinMaxPyramid(object):
+    ''' The min/max pyramid of the series ys sampled at xs, which must be monotonic
+    (increasing or decreasing) for it to be decimated. Construct with:
+
+        pyramid = decimation.MinMaxPyramid(xs, ys)
+
+    then call pyramid.envelope(low, high, width) to get the samples to draw for the
+    x-range low to high across width pixels.
+    Level k of the pyramid holds, for each bin of 2**(k+1) consecutive samples, the
+    indices of the samples with the least and greatest values.
+    '''
+    def __init__(self, xs, ys):
+        self.xs = np.asarray(xs)
+        self.ys = np.asarray(ys)
+        n = len(self.ys)
+        self.levels = []
+
+        steps = np.diff(self.xs)
+        self._decreasing = not (steps >= 0).all()
+        if not self._decreasing:
+            self._keys = self.xs
+        elif (steps <= 0).all():
+            # search decreasing axes as increasing ones
+            self._keys = -self.xs
+        else:
+            # Not monotonic, so never decimated
+            self._keys = None
+            return
+
+        # The first, last, least and greatest samples are always drawn so the plot's
+        # data ranges are those of the full series whatever the view
+        self.extremes = np.unique([0, n-1, self.ys.argmin(), self.ys.argmax()]) \
+                        if n else np.zeros(0, dtype=int)
+
+        lo = hi = np.arange(n)
+        while len(lo) > 1:
+            if len(lo) % 2:
+                lo = np.append(lo, lo[-1])
+                hi = np.append(hi, hi[-1])
+            a, b = lo[0::2], lo[1::2]
+            lo = np.where(self.ys[b] < self.ys[a], b, a)
+            a, b = hi[0::2], hi[1::2]
+            hi = np.where(self.ys[b] > self.ys[a], b, a)
+            self.levels.append((lo, hi))
+
+    def envelope(self, low, high, width):
+        ''' Return (xs, ys) to draw the series over the x-range low to high, width
+        pixels wide. If the range holds no more than two samples per pixel these are all
+        its samples, otherwise the min/max envelope of about one bin per pixel. The
+        samples either side of the range and the extremes of the series are included.
+        '''
+        if self._keys is None or not len(self.ys):
+            return self.xs, self.ys
+        if self._decreasing:
+            low, high = -high, -low
+        n = len(self.ys)
+        first = max(np.searchsorted(self._keys, low, 'right') - 1, 0)
+        last = min(np.searchsorted(self._keys, high, 'left'), n - 1)
+        count = last - first + 1
+        width = max(int(width), 1)
+
+        if count <= 2 * width:
+            indices = np.arange(first, last + 1)
+        else:
+            # The finest level with no more bins in the range than pixels
+            k = int(np.ceil(np.log2(count / float(width))))
+            k = min(max(k, 1), len(self.levels))
+            lo, hi = self.levels[k - 1]
+            bins = slice(first >> k, (last >> k) + 1)
+            indices = np.concatenate([lo[bins], hi[bins], [first, last]])
+        indices = np.union1d(indices, self.extremes)
+        return self.xs[indices], self.ys[indices]
@@ -0,0 +1,735 @@
+'''
+Export of SPECS regions to columnar .xy files, shared by the GUI and the command line.
+This module doesn't depend on wx, chaco or enable, so files can be exported without a
+display:
+
+    python export.py -o OUTDIR [options] FILE [FILE ...]
+
+FILE may be an .xml file, a directory of them or a glob pattern. Each file is
+exported into OUTDIR/<file name without extension>/<group name>/<region name>.xy,
+exactly as the GUI's Export... button writes it into the chosen directory.
+With --format hdf5 each file is instead exported into one HDF5 file,
+OUTDIR/<file name without extension>.h5 (see export_hdf5()). This needs h5py.
+Run with --help for the options.
+'''
+
+import os
+import sys
+import glob
+import argparse
+import itertools
+import multiprocessing
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None                 # HDF5 export is unavailable
+import specs
+import specs_cache
+from normalisation import compute_counts, get_name_body, get_name_num, NormalisationCache
+
+CHANNELS = 9    # number of channeltron and extended channels in a region
+DELIMITERS = {'space':' ', 'comma':',', 'tab':'\t'}
+
+# A lookup table with keys that match the possible specs.SPECSRegion.scan_mode values.
+scan_mode_lookup = lambda key: {
+    'FixedAnalyzerTransmission':{ 'axis' :'binding_axis',        # scan_mode axis to use
+                                  'label':'Binding energy (eV)', # plot region x-axis label
+                                  'orientation':'reversed',      # plot region x-axis orientation
+                                },
+    'ConstantFinalState'       :{ 'axis' :'excitation_axis',
+                                  'label':'Excitation energy (eV)',
+                                  'orientation':'normal',
+                                },
+    'FixedEnergies'            :{ 'axis' :'time_axis',
+                                  'label':'Time (s)',
+                                  'orientation':'normal',
+                                },
+    }.get(key,                  { 'axis' :'kinetic_axis',
+                                  'label':'Kinetic energy (eV)',
+                                  'orientation':'normal',
+                                },
+    ) # last one is the default case
+
+
+def uniquify_names(names):
+    ''' names is a list of strings. This generator function ensures all strings in
+    the names list are unique by appending -n to the name if it is repeated, where n
+    is an incrementing number. e.g. if names is ['a', 'b', 'c', 'a', 'b', 'a'] this
+    yields ['a', 'b', 'c', 'a-1', 'b-1', 'a-2']
+    '''
+    freqs = {}
+    for name in names:
+        freqs[name] = freqs.get(name, 0) + 1
+        if freqs[name] > 1:
+            yield '{}-{}'.format(name, freqs[name]-1)
+        else:
+            yield name
+
+
+def zero_fill_empty_channels(region):
+    ''' Sometimes the underlying specs.SPECSRegion object contains None to
+    indicate that no channel data is available. Here we replace any None channels
+    with a zero-filled array in the underlying object
+    '''
+    c = region.channel_counts
+    if c is None:
+        region.channel_counts = np.zeros((region.counts.size, CHANNELS))
+    c = region.extended_channels
+    if c is None:
+        region.extended_channels = np.zeros((region.counts.size, CHANNELS))
+
+
+# The checkbox states of a region can be held in one integer, a selection bitmask, with
+# bit 0 for counts, bits 1-9 for channel_counts_1-9 and bits 10-18 for
+# extended_channels_1-9
+COUNTS_BIT = 1
+
+def selection_bit(series_name):
+    ''' Return the bit of a selection bitmask for the checkbox of series_name, which is
+    'counts', 'channel_counts_n' or 'extended_channels_n'.
+    '''
+    if series_name == 'counts':
+        return COUNTS_BIT
+    return 1 << (_bit_offset(get_name_body(series_name)) + get_name_num(series_name))
+
+def channels_mask(series_name_body, count):
+    ''' Return the selection bitmask with the bits of channels 1 to count set, for
+    series_name_body 'channel_counts' or 'extended_channels'.
+    '''
+    return ((1 << count) - 1) << (_bit_offset(series_name_body) + 1)
+
+def _bit_offset(series_name_body):
+    return 0 if series_name_body == 'channel_counts' else CHANNELS
+
+
+class Selection(object):
+    ''' The state of an app.SelectorPanel that matters for export, without the GUI.
+    channels is a list of the channel_counts numbers (from 1) summed to make the
+    counts, or None for all of them.
+    '''
+    def __init__(self, region, channels=None, dbl_norm_ref=3, dbl_norm_ref_numerator=2):
+        self.region = region
+        self.dbl_norm_ref = dbl_norm_ref
+        self.dbl_norm_ref_numerator = dbl_norm_ref_numerator
+        self.channel_counts_states = {
+            'channel_counts_{}'.format(i+1): channels is None or i+1 in channels
+            for i in range(len(region.region.detector_channel_offsets))}
+        self.extended_channels_states = {
+            'extended_channels_{}'.format(i+1): False
+            for i in range(region.region.num_extended_channels or CHANNELS)}
+
+    def get_channel_counts_states(self):
+        return dict(self.channel_counts_states)
+
+    def get_extended_channels_states(self):
+        return dict(self.extended_channels_states)
+
+    def compute_counts(self):
+        return compute_counts(self.region.region.channel_counts,
+                              self.channel_counts_states)
+
+
+class Region(object):
+    ''' A region for export without the GUI, standing in for app.SpRegion.
+    region is a specs.SPECSRegion and name its unique name. The remaining keyword
+    arguments set up its Selection.
+    '''
+    def __init__(self, name, region, **selection):
+        self.name = name
+        self.region = region
+        self.selection = Selection(self, **selection)
+        region.add_payload_hook(zero_fill_empty_channels)
+        if selection.get('channels') is not None:
+            # As in the GUI, the counts are the sum of the selected channels
+            region.add_payload_hook(self._compute_counts)
+
+    def _compute_counts(self, region):
+        region.counts = self.selection.compute_counts()
+
+    def get_x_axis(self):
+        ''' Return x-axis data based on the scan_mode metadata '''
+        r = self.region
+        return getattr(r, scan_mode_lookup(r.scan_mode)['axis'])
+
+
+def counts_label(r):
+    ''' Builds a string of the form '1+2+4' where the summands correspond to the
+    selected channel_counts states of region r
+    '''
+    cc_dict = r.selection.get_channel_counts_states()
+    # make a string indicating the channel_counts columns summed to
+    # obtain the counts column
+    return '+'.join([str(get_name_num(i)) for i in sorted(cc_dict) if cc_dict[i]])
+
+
+def normalisation_description(r, mode, normalisation_ref='None', R=None):
+    ''' Describe the normalisation of region r as in the first header line of its
+    export, or return '' if it isn't normalised. Double normalisation only applies to
+    ConstantFinalState regions.
+    '''
+    if mode == 'self':
+        return 'Normalised to extended channel {}'.format(normalisation_ref)
+    if mode == 'double' and r.region.scan_mode == 'ConstantFinalState':
+        s, d = R.selection.dbl_norm_ref_numerator, R.selection.dbl_norm_ref
+        if s == 'Counts':
+            s = 'Counts {}'.format(counts_label(R))
+        return 'Double normalised {} to {}:{}/{}'.format(r.selection.dbl_norm_ref,
+                                                         R.name, s, d)
+    return ''
+
+
+# A region ready to be written by write_region(): the directory and file to write, the
+# error message ('' if none), the header lines (None for no header), the data columns
+# and the delimiter character
+PreparedRegion = namedtuple('PreparedRegion',
+                            'dirname filename err_msg header data delimiter')
+
+
+def export_region(r, dirname, mode='none', normalisation_ref='None', R=None,
+                  delimiter='tab', header=True, cache=None):
+    ''' Exports region r into the directory dirname. The directory is created as
+    needed. mode is the normalisation mode: 'none', 'self' normalising to extended
+    channel normalisation_ref, or 'double' with R the normalisation reference region.
+    delimiter is one of the DELIMITERS keys and header sets whether to write the
+    header lines. cache is a normalisation.NormalisationCache to reuse normalised
+    series from, if given. Returns a flag normalisation_errors if errors occurred. If
+    True, the error message will be contained in the associated err_msg.
+    '''
+    p = prepare_region(r, dirname, mode, normalisation_ref, R, delimiter, header, cache)
+    write_region(p)
+    print p.filename, 'written'
+    return p.err_msg != '', p.err_msg   # err_msg contains any error message if one occurred
+
+
+def prepare_region(r, dirname, mode='none', normalisation_ref='None', R=None,
+                   delimiter='tab', header=True, cache=None):
+    ''' Does the work of export_region() short of writing the file, returning a
+    PreparedRegion. This is the part that can be done in another process.
+    '''
+    if cache is None:
+        cache = NormalisationCache()
+    # variable a holds the columnar count data. Start with the x-axis
+    # then append counts, channel_counts and extended_channels as
+    # appropriate.
+
+    err_msg = ''
+    h = ''
+    delimiter = DELIMITERS[delimiter]
+
+    # Decode the data of lazily read regions first, so that malformed data is reported
+    # as such rather than as an error normalising it
+    try:
+        r.region.load_payload()
+        if mode == 'double' and R is not None:
+            R.region.load_payload()
+    except ValueError as e:
+        err_msg = 'Error reading the region data: {}'.format(e)
+        filename = os.path.join(dirname, 'ERRORS_{}.xy'.format(r.name))
+        return PreparedRegion(dirname, filename, err_msg, None, [], delimiter)
+
+    a = [np.asarray(r.get_x_axis())]    # x-axis data
+
+    normalisation_ok = True         # Reset region-specific error flag
+    try:
+        # counts data, with the channel matrices normalised all at once
+        counts, channel_counts, extended_channels = \
+            cache.normalise_region(r, mode, normalisation_ref, R)
+        a.append(counts)
+
+        label = counts_label(r)
+
+        # First header line
+        h += '#"'
+        # Override the normalisation mode if it says double-normalisation and the axis
+        # type does not support this
+        if mode == 'double' and r.region.scan_mode != 'ConstantFinalState':
+            mode = 'none'
+        description = normalisation_description(r, mode, normalisation_ref, R)
+        if description:
+            h += description + ', '
+
+        h += 'Analyzer mode:{}'.format(r.region.scan_mode)
+        h += ', Dwell time:{}'.format(r.region.dwell_time)
+        h += ', Pass energy:{}'.format(r.region.pass_energy)
+        h += ', Lens mode:{}'.format(r.region.analyzer_lens)
+        if r.region.scan_mode=='FixedAnalyzerTransmission':
+            h += ', Excitation energy:{}'.format(r.region.excitation_energy)
+        elif r.region.scan_mode=='ConstantFinalState':
+            h += ', Kinetic energy:{}'.format(r.region.kinetic_energy)
+        h += '"\n'
+
+        # Second header line
+        h += '#'
+        h += '"{}"'.format(scan_mode_lookup(r.region.scan_mode)['label'])
+        h += '{}"Counts {}"'.format(delimiter, label)
+
+        # channel_counts_n data
+        for name in sorted(r.selection.get_channel_counts_states()):
+            channel_num = get_name_num(name)
+            a.append(channel_counts[:,channel_num-1])
+            h += '{}"Channel {} counts"'.format(delimiter, channel_num)
+
+        # extended_channels_n data
+        for name in sorted(r.selection.get_extended_channels_states()):
+            channel_num = get_name_num(name)
+            a.append(extended_channels[:,channel_num-1])
+            h += '{}"Extended channel {}"'.format(delimiter, channel_num)
+
+        # optionally append double-normalisation reference data
+        if mode == 'double':
+            s, d = R.selection.dbl_norm_ref_numerator, R.selection.dbl_norm_ref
+            ys = cache.denominator(R)
+            a.append(ys)
+            if s == 'Counts':
+                s = 'Counts {}'.format(counts_label(R))
+            h += '{}"{}:{}/{}"'.format(delimiter, R.name, s, d)
+
+        # Deal with any errors created in normalising data
+        a = np.array(a)
+        mask = np.isinf(a) | np.isnan(a)
+        a[mask] = -1
+        if True in mask:
+            normalisation_ok = False
+            err_msg = 'Errors generated while normalising have been set to -1'
+
+    except FloatingPointError:
+        normalisation_ok = False
+        err_msg = 'Unexpected floating point errors normalising to Extended channel {}'.format(
+            normalisation_ref)
+    except ValueError as e:
+        normalisation_ok = False
+        if mode == 'double' and R is not None:
+            s, d = R.selection.dbl_norm_ref_numerator, R.selection.dbl_norm_ref
+            err_msg = 'Energy ranges differ in double normalisation reference {}:{}/{}'.format(R.name, s, d)
+        else:
+            err_msg = 'Unexpected error exporting: {}'.format(e)
+
+    if normalisation_ok:
+        filename = os.path.join(dirname, r.name+'.xy')
+    else:
+        filename = os.path.join(dirname, 'ERRORS_{}.xy'.format(r.name))
+    return PreparedRegion(dirname, filename, err_msg, h if header else None, a, delimiter)
+
+
+def write_region(p):
+    ''' Write the PreparedRegion p, creating its directory as needed. '''
+    try:
+        os.mkdir(p.dirname)   # Try creating directory
+    except OSError:
+        # Something exists already, or it can't be written
+        # Maybe give a nice message here
+        pass
+
+    with open(p.filename, 'w') as f:
+        if p.err_msg != '':
+            # Additional header line indicating there were errors
+            print >> f, '# ERRORS:', p.err_msg
+        if p.header is not None:
+            # Output header
+            print >> f, p.header
+        # Output data
+        a = np.array(p.data).transpose()
+        write_columns(f, a, p.delimiter)
+
+
+def write_columns(f, a, delimiter, fmt='%1.8g', rows=4096):
+    ''' Write the rows of the 2D array a to the open file f, one per line with the
+    columns separated by delimiter. The output is the same as from
+    np.savetxt(f, a, fmt=fmt, delimiter=delimiter), but rather than formatting one row
+    at a time, blocks of up to rows rows are formatted in a single operation.
+    '''
+    a = np.asarray(a)
+    if a.ndim == 1:
+        # As for np.savetxt, a 1D array is written as a column
+        a = a[:, np.newaxis]
+    line = delimiter.join([fmt] * a.shape[1]) + '\n'
+    for start in xrange(0, len(a), rows):
+        block = a[start:start+rows]
+        f.write((line * len(block)) % tuple(block.ravel().tolist()))
+
+
+def export_hdf5(filename, groups, mode='none', normalisation_ref='None', R=None,
+                compression='gzip', compression_opts=4, chunk_rows=4096, cache=None):
+    ''' Export regions into the HDF5 file filename, laid out along the lines of NeXus:
+
+        /<group>                    NX_class NXcollection
+        /<group>/<region>           NX_class NXdata, with the region's metadata,
+                                    normalisation and any errors as attributes
+            <x axis>                e.g. binding_axis, with its label as long_name
+            counts
+            channel_counts          points x channels
+            extended_channels       points x extended channels
+            double_normalisation_denominator     with double normalisation only
+
+    groups is a list of (group name, [region, ...]) pairs as returned by open_regions().
+    mode, normalisation_ref and R are as for export_region() and the data are those
+    that would be exported to .xy files, so the same errors are set to -1. Datasets
+    are chunked by chunk_rows rows and compressed as given by compression and
+    compression_opts, so parts of them can be read without reading them all.
+    cache is a normalisation.NormalisationCache to reuse normalised series from.
+    '/' in names is replaced by '_'.
+    Returns a list of (region, err_msg) for the regions with normalisation errors.
+    Raises ImportError if h5py isn't available.
+    '''
+    if h5py is None:
+        raise ImportError('HDF5 export needs h5py')
+
+    def create_dataset(parent, name, data):
+        data = np.asarray(data, dtype=float)
+        if data.size:
+            chunks = (min(len(data), chunk_rows),) + data.shape[1:]
+            return parent.create_dataset(name, data=data, chunks=chunks, shuffle=True,
+                                         compression=compression,
+                                         compression_opts=compression_opts)
+        return parent.create_dataset(name, data=data)
+
+    if cache is None:
+        cache = NormalisationCache()
+    errors = []
+    with h5py.File(filename, 'w') as f:
+        f.attrs['NX_class'] = 'NXroot'
+        f.attrs['creator'] = 'SinSPECt'
+        for group_name, regions in groups:
+            hgroup = f.create_group(group_name.replace('/', '_'))
+            hgroup.attrs['NX_class'] = 'NXcollection'
+            hgroup.attrs['name'] = group_name
+            for r in regions:
+                p = prepare_region(r, '', mode, normalisation_ref, R, cache=cache)
+                if p.err_msg != '':
+                    errors.append((r, p.err_msg))
+                data = np.array(p.data)
+                n = len(r.selection.get_channel_counts_states())
+                m = len(r.selection.get_extended_channels_states())
+                lookup = scan_mode_lookup(r.region.scan_mode)
+
+                hregion = hgroup.create_group(r.name.replace('/', '_'))
+                hregion.attrs['NX_class'] = 'NXdata'
+                hregion.attrs['signal'] = 'counts'
+                hregion.attrs['axes'] = lookup['axis']
+                hregion.attrs['name'] = r.name
+                hregion.attrs['counts_channels'] = counts_label(r)
+                for attr in ['scan_mode', 'dwell_time', 'pass_energy', 'analyzer_lens',
+                             'excitation_energy', 'kinetic_energy',
+                             'effective_workfunction', 'values_per_curve',
+                             'num_cycles']:
+                    # Older files don't have all of these, and HDF5 can't store None
+                    value = getattr(r.region, attr, None)
+                    if value is not None:
+                        hregion.attrs[attr] = value
+                hregion.attrs['normalisation'] = \
+                    normalisation_description(r, mode, normalisation_ref, R) or 'None'
+                if p.err_msg != '':
+                    hregion.attrs['errors'] = p.err_msg
+
+                # The columns are as for the .xy file, though they may be incomplete if
+                # there were errors normalising them, or missing if the data couldn't be
+                # read
+                if len(data) > 0:
+                    create_dataset(hregion, lookup['axis'], data[0]).attrs['long_name'] = \
+                        lookup['label']
+                if len(data) > 1:
+                    create_dataset(hregion, 'counts', data[1])
+                if len(data) > 2:
+                    create_dataset(hregion, 'channel_counts', data[2:2+n].T)
+                if len(data) > 2+n:
+                    create_dataset(hregion, 'extended_channels', data[2+n:2+n+m].T)
+                if len(data) > 2+n+m:
+                    create_dataset(hregion, 'double_normalisation_denominator',
+                                   data[2+n+m])
+    return errors
+
+
+def open_regions(filename, channels=None, dbl_norm_ref=3, reference=None,
+                 dbl_norm_ref_numerator=2, reference_dbl_norm_ref=3, cache=True,
+                 cache_dir=specs.CACHE_DIR):
+    ''' Open filename and return a list of (group name, [Region, ...]) pairs with the
+    unique names the GUI would give them, and the reference Region named by reference,
+    either 'group/region' or the name of the first region called 'region'. The
+    reference is None if reference is None.
+    channels selects the channels summed into the counts of every region. Regions have
+    the double normalisation reference dbl_norm_ref, except for the reference region
+    which has reference_dbl_norm_ref and dbl_norm_ref_numerator.
+    The file is read through the cache in cache_dir unless cache is False.
+    Raises KeyError if the reference region isn't found.
+    '''
+    if cache:
+        s = specs_cache.open_specs(filename, lazy=True, cache_dir=cache_dir)
+    else:
+        s = specs.SPECS(filename, lazy=True)
+
+    if reference is not None and '/' in reference:
+        reference_group, reference = reference.split('/', 1)
+    else:
+        reference_group = None
+
+    groups = []
+    R = None
+    uniquify_group_gen = uniquify_names([g.name for g in s.groups])
+    for group in s.groups:
+        group_name = uniquify_group_gen.next()
+        uniquify_region_gen = uniquify_names([r.name for r in group.regions])
+        regions = []
+        for region in group.regions:
+            name = uniquify_region_gen.next()
+            is_reference = (R is None and name == reference and
+                            reference_group in (None, group_name))
+            if is_reference:
+                r = Region(name, region, channels=channels,
+                           dbl_norm_ref=reference_dbl_norm_ref,
+                           dbl_norm_ref_numerator=dbl_norm_ref_numerator)
+                R = r
+            else:
+                r = Region(name, region, channels=channels, dbl_norm_ref=dbl_norm_ref)
+            regions.append(r)
+        groups.append((group_name, regions))
+
+    if reference is not None and R is None:
+        raise KeyError(reference)
+    return groups, R
+
+
+def expand_paths(paths):
+    ''' Return the .xml files named by paths, which may be files, directories or glob
+    patterns, in sorted order within each path and without repeats.
+    '''
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, '*.xml')))
+        elif os.path.exists(path):
+            matches = [path]
+        else:
+            matches = sorted(glob.glob(path))
+        for filename in matches:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+
+def export_files(filenames, outdir, export_options, open_options=None, processes=1,
+                 writers=2, progress=None, format='xy'):
+    ''' Export many files, each into outdir/<file name without extension>/, or with
+    format 'hdf5' into outdir/<file name without extension>.h5 (see export_hdf5(); the
+    HDF5 files are written by the worker processes and delimiter and header are
+    ignored).
+    Files are opened (see open_regions(), which takes open_options) and their regions
+    normalised (see export_region(), which takes export_options) by a pool of processes
+    worker processes, or in this process if processes is 1; None means one per CPU. The
+    files are then written by a pool of writers threads, with at most a few regions per
+    writer waiting to be written at any time.
+    If given, progress(done, total, filename, regions) is called as each file's regions
+    are handed to the writers, in the order of filenames.
+    Returns a list of (filename, region name, err_msg) for each file that couldn't be
+    read, with None for the region name, and each region with normalisation errors.
+    It is in the order of filenames and regions whatever the number of workers, and
+    the same files are written.
+    '''
+    tasks = [(filename, outdir, open_options or {}, export_options, format)
+             for filename in filenames]
+    if processes == 1:
+        pool = None
+        results = itertools.imap(_prepare_file, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_prepare_file, tasks)
+
+    writer_pool = ThreadPool(writers)
+    slots = threading.BoundedSemaphore(4 * writers)
+    pending = []
+    errors = []
+    try:
+        for done, (filename, prepared, err_msg) in enumerate(results, 1):
+            if err_msg is not None:
+                errors.append((filename, None, err_msg))
+            for p, name, region_err_msg in prepared:
+                if region_err_msg != '':
+                    errors.append((filename, name, region_err_msg))
+                if p is None:
+                    continue
+                # Wait for a free slot, so the prepared regions don't pile up in memory
+                slots.acquire()
+                pending.append(writer_pool.apply_async(_write_region_slot, (p, slots)))
+            if progress is not None:
+                progress(done, len(filenames), filename, len(prepared))
+        if pool is not None:
+            pool.close()
+        for result in pending:
+            result.get()        # re-raises any error writing the file
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        writer_pool.close()
+        writer_pool.join()
+    return errors
+
+
+def _prepare_file(args):
+    ''' Worker for export_files(): open a file and prepare all its regions, returning
+    (filename, [(PreparedRegion, region name, region err_msg), ...], err_msg) with
+    err_msg None unless the file couldn't be read. For HDF5 the file is written here
+    and the PreparedRegions are None.
+    '''
+    filename, outdir, open_options, export_options, format = args
+    # Set here as well as in main(), as worker processes may not inherit it. With one
+    # process this runs in the caller, whose error state is left as it was.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return _prepare_regions(filename, outdir, open_options, export_options, format)
+
+
+def _prepare_regions(filename, outdir, open_options, export_options, format):
+    ''' The work of _prepare_file(). '''
+    try:
+        groups, R = open_regions(filename, **open_options)
+    except KeyError as e:
+        return filename, [], 'no region {}'.format(e.args[0])
+    except Exception as e:
+        return filename, [], 'error reading file: {}'.format(e)
+
+    path = os.path.join(outdir, os.path.splitext(os.path.basename(filename))[0])
+    if format == 'hdf5':
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        options = dict((k, v) for k, v in export_options.iteritems()
+                       if k in ('mode', 'normalisation_ref'))
+        errors = dict(export_hdf5(path + '.h5', groups, R=R, **options))
+        return filename, [(None, r.name, errors.get(r, ''))
+                          for group_name, regions in groups for r in regions], None
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    prepared = []
+    # Shared by the regions, so the reference's denominator is computed once
+    cache = NormalisationCache()
+    for group_name, regions in groups:
+        for r in regions:
+            p = prepare_region(r, os.path.join(path, group_name), R=R, cache=cache,
+                               **export_options)
+            prepared.append((p, r.name, p.err_msg))
+    return filename, prepared, None
+
+
+def _write_region_slot(p, slots):
+    ''' Writer for export_files(): write p and release its slot. '''
+    try:
+        write_region(p)
+    finally:
+        slots.release()
+
+
+def add_export_arguments(parser):
+    ''' Add the options selecting what is exported and how to the argparse parser
+    parser. See export_options_from_args().
+    '''
+    channel_choices = range(1, CHANNELS+1)
+    parser.add_argument('-c', '--channels', default=None,
+                        help='comma-separated channel numbers summed to make the '
+                             'counts, e.g. 1,2,4 (default: all)')
+    parser.add_argument('-n', '--normalise', choices=['none', 'self', 'double'],
+                        default='none', help='normalisation mode (default: none)')
+    parser.add_argument('-e', '--extended-channel', type=int, choices=channel_choices,
+                        help='extended channel to normalise to with --normalise self')
+    parser.add_argument('-r', '--reference',
+                        help='double normalisation reference region, as group/region or '
+                             'region, using the names shown in the SinSPECt tree')
+    parser.add_argument('--numerator', default='2',
+                        choices=['Counts'] + [str(i) for i in channel_choices],
+                        help='numerator of the reference region (default: 2)')
+    parser.add_argument('--denominator', type=int, default=3, choices=channel_choices,
+                        help='denominator extended channel of the reference region '
+                             '(default: 3)')
+    parser.add_argument('--dbl-norm-ref', type=int, default=3, choices=channel_choices,
+                        help='extended channel each region is double normalised by '
+                             '(default: 3)')
+    parser.add_argument('-d', '--delimiter', choices=sorted(DELIMITERS), default='tab',
+                        help='column delimiter (default: tab)')
+    parser.add_argument('--no-header', dest='header', action='store_false',
+                        help="don't write the header lines")
+    parser.add_argument('-f', '--format', choices=['xy', 'hdf5'], default='xy',
+                        help='xy for a directory of .xy files per file, or hdf5 for '
+                             'one .h5 file per file (default: xy)')
+
+
+def export_options_from_args(parser, args):
+    ''' Check the options added by add_export_arguments() in args, as parsed by parser,
+    exiting through parser.error() if they are inconsistent. Returns the
+    (export_options, open_options) to pass to export_files().
+    '''
+    if args.normalise == 'self' and args.extended_channel is None:
+        parser.error('--normalise self needs --extended-channel')
+    if args.normalise == 'double' and args.reference is None:
+        parser.error('--normalise double needs --reference')
+    channels = None
+    if args.channels is not None:
+        try:
+            channels = [int(c) for c in args.channels.split(',')]
+        except ValueError:
+            parser.error('--channels must be comma-separated channel numbers')
+    numerator = args.numerator if args.numerator == 'Counts' else int(args.numerator)
+    if args.format == 'hdf5' and h5py is None:
+        parser.error('--format hdf5 needs h5py, which is not installed')
+
+    export_options = {'mode': args.normalise,
+                      'normalisation_ref': args.extended_channel or 'None',
+                      'delimiter': args.delimiter, 'header': args.header}
+    open_options = {'channels': channels, 'dbl_norm_ref': args.dbl_norm_ref,
+                    'reference': args.reference if args.normalise == 'double' else None,
+                    'dbl_norm_ref_numerator': numerator,
+                    'reference_dbl_norm_ref': args.denominator}
+    return export_options, open_options
+
+
+def main(argv=None):
+    ''' Command line entry point. Returns the exit status: 1 if any file could not be
+    read or any region had normalisation errors.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Export the regions of SPECSLab .xml files to .xy files, as the '
+                    'SinSPECt Export... button does.')
+    parser.add_argument('paths', nargs='+', metavar='FILE',
+                        help='an .xml file, directory of .xml files or glob pattern')
+    parser.add_argument('-o', '--outdir', default='.',
+                        help='directory to export into (default: current directory)')
+    add_export_arguments(parser)
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help="don't read or add to the cache of parsed files")
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help='number of processes reading files, 0 for one per CPU '
+                             '(default: 1)')
+    parser.add_argument('-w', '--writers', type=int, default=2,
+                        help='number of threads writing files (default: 2)')
+    args = parser.parse_args(argv)
+
+    export_options, open_options = export_options_from_args(parser, args)
+    open_options['cache'] = args.cache
+    filenames = expand_paths(args.paths)
+    if not filenames:
+        parser.error('no files found')
+
+    # As in the GUI, normalisation errors are reported by writing ERRORS_ files
+    np.seterr(divide='ignore', invalid='ignore')
+
+    def progress(done, total, filename, regions):
+        print '[{}/{}] {}: {} regions'.format(done, total, filename, regions)
+
+    errors = export_files(filenames, args.outdir, export_options, open_options,
+                          processes=args.processes or None, writers=args.writers,
+                          progress=progress, format=args.format)
+    for filename, name, err_msg in errors:
+        if name is None:
+            print >> sys.stderr, '{}: {}'.format(filename, err_msg)
+        else:
+            print >> sys.stderr, '{}: {}: {}'.format(filename, name, err_msg)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    # Needed for the process pool in a frozen Windows executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
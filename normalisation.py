@@ -0,0 +1,286 @@
+'''
+Normalisation of region data, shared by the GUI and the headless exporter.
+
+Regions here are objects like app.SpRegion: they have a name, a region attribute
+holding the specs.SPECSRegion, a get_x_axis() method and a selection attribute with
+compute_counts(), get_channel_counts_states(), dbl_norm_ref and dbl_norm_ref_numerator,
+as app.SelectorPanel has. None of this module depends on wx or the Traits UI.
+See the SinSPECt Sphinx docs for the definitions of the terms computed here.
+'''
+
+import weakref
+import numpy as np
+
+
+def get_name_body(series_name):
+    ''' Get first part of name
+    e.g. get_name_body('foo_bar_baz') returns foo_bar
+    '''
+    return '_'.join(series_name.split('_')[:2])
+
+def get_name_num(series_name):
+    ''' Get last part of name.
+    e.g. get_name_num('foo_bar_baz') returns baz
+    '''
+    return int(series_name.split('_')[-1])
+
+
+def compute_counts(channel_counts, cc_dict):
+    ''' compute counts
+    channel_counts is an n-column (n=9) x m-row array and cc_dict a dictionary of
+    channel_counts_n:state entries. Make a mask corresponding to the states then sum
+    the corresponding columns
+    '''
+    mask = np.array([cc_dict[i] for i in sorted(cc_dict)])
+    return channel_counts[:,mask].sum(axis=1)
+
+def x_ranges_match(r, R, rtol=1e-6):
+    ''' Verify that x-range of region r matches region R by checking that the start
+    and end points of xs in both regions are within tolerance rtol of the smallest
+    division, i.e. for n+1 samples within they should match within (x_max-x_min)/n*rtol
+    '''
+    xs = r.get_x_axis()
+    xs_ref = R.get_x_axis()
+    if np.allclose([xs[0], xs[-1]], [xs_ref[0], xs_ref[-1]],
+                   atol = (xs[-1]-xs[0]) / (xs.size-1) * rtol) and (xs.size==xs_ref.size):
+        return True
+    return False
+
+def normalise_self(r, ys, normalisation_ref):
+    ''' Return a vector of ys normalised against the y-values in extended channel
+    normalisation_ref (1-9, or 'None' for no normalisation) of region r. '''
+    ys = ys.copy()
+    if normalisation_ref != 'None':
+        ys /= r.region.extended_channels[:, normalisation_ref - 1]
+    return ys
+
+def e_r(r):
+    ''' Computes the e_r term. '''
+    return r.region.extended_channels[:, r.selection.dbl_norm_ref-1]
+
+def MR(R, s):
+    ''' Computes the M^R term.
+    R is the reference region.
+    s is the value from the Enum {'Counts', 1..9} of the drop-down menu selection.
+    '''
+    if s == 'Counts':
+        # M^R = C^R
+        mr = R.selection.compute_counts()
+    else:
+        # s in {1..9}: M^R = e^R_s
+        mr = R.region.extended_channels[:, s-1]
+    return mr
+
+def double_normalisation_denominator(R, s):
+    ''' Computes the denominator term M^R/e^R_r.
+    R is the reference region.
+    s is the value from the Enum {'Counts', 1..9} of the drop-down menu selection.
+    '''
+    mr = MR(R, s)
+    e = R.region.extended_channels[:, R.selection.dbl_norm_ref-1]
+    return mr / e
+
+def double_normalise_channel(r, R, series_name, denominator=None):
+    ''' Computes the double-normalised channel counts c''_i or extended channel counts
+    e''_i for the channel or extended channel named series_name within region r, with R
+    the normalisation reference region. denominator is the M^R/e^R_r term of R if
+    already known.
+    Raises ValueError if the x-ranges of r and R do not match.
+    '''
+    # verify that our x-range matches that of the reference region
+    if not x_ranges_match(r, R):
+        raise ValueError
+
+    series_name_body = get_name_body(series_name)
+    series_name_num = get_name_num(series_name)
+    c_or_e_i = r.region.__getattribute__(series_name_body)[:,series_name_num-1]
+    numer = c_or_e_i / e_r(r)
+
+    if denominator is None:
+        s = R.selection.dbl_norm_ref_numerator
+        denominator = double_normalisation_denominator(R, s)
+
+    return numer / denominator
+
+def double_normalise_counts(r, R, denominator=None):
+    ''' Computes the double-normalised counts C'' for region r, with R the
+    normalisation reference region. denominator is the M^R/e^R_r term of R if already
+    known.
+    Raises ValueError if the x-ranges do not match.
+    '''
+    # verify that our x-range matches that of the reference region
+    if not x_ranges_match(r, R):
+        raise ValueError
+
+    numer = r.selection.compute_counts() / e_r(r)
+    if denominator is None:
+        s = R.selection.dbl_norm_ref_numerator
+        denominator = double_normalisation_denominator(R, s)
+    return numer / denominator
+
+def normalise(r, ys, series_name, mode, normalisation_ref='None', R=None,
+              denominator=None):
+    ''' Normalise the ys of the series series_name of region r according to mode, one of
+    'none', 'self' or 'double'. For 'self' normalisation_ref is the extended channel
+    normalised to, for 'double' R is the normalisation reference region and denominator
+    its M^R/e^R_r term, if already known.
+    '''
+    if mode == 'self':
+        if (get_name_body(series_name) != 'extended_channels') or \
+           (get_name_num(series_name) != normalisation_ref):
+            ys = normalise_self(r, ys, normalisation_ref)
+    elif (mode == 'double') and (r.region.scan_mode == 'ConstantFinalState'):
+        if series_name=='counts':
+            ys = double_normalise_counts(r, R, denominator)
+        else:
+            if (get_name_body(series_name) != 'extended_channels') or \
+               (get_name_num(series_name) != r.selection.dbl_norm_ref):
+                ys = double_normalise_channel(r, R, series_name, denominator)
+    return ys
+
+def normalise_channels(r, mode, normalisation_ref='None', R=None, denominator=None):
+    ''' Normalise all the channel_counts and extended_channels of region r at once,
+    returning the normalised (channel_counts, extended_channels) matrices. Column n-1 of
+    each is identical to what normalise() returns for the series channel_counts_n or
+    extended_channels_n, but the x-ranges are checked and the denominator computed once
+    for the region instead of once per series. The reference channel, which normalise()
+    leaves as it is, is restored after the division by a column mask.
+    The matrices returned may be those of the region, so must not be modified.
+    Raises ValueError if double normalising and the x-ranges of r and R do not match.
+    '''
+    channel_counts = r.region.channel_counts
+    extended_channels = r.region.extended_channels
+    if mode == 'self':
+        if normalisation_ref == 'None':
+            return channel_counts, extended_channels
+        ref = normalisation_ref
+        e = extended_channels[:, ref-1][:, np.newaxis]
+        normalised = [channel_counts / e, extended_channels / e]
+    elif (mode == 'double') and (r.region.scan_mode == 'ConstantFinalState'):
+        if not x_ranges_match(r, R):
+            raise ValueError
+        if denominator is None:
+            s = R.selection.dbl_norm_ref_numerator
+            denominator = double_normalisation_denominator(R, s)
+        ref = r.selection.dbl_norm_ref
+        e = e_r(r)[:, np.newaxis]
+        denominator = denominator[:, np.newaxis]
+        normalised = [m / e / denominator for m in (channel_counts, extended_channels)]
+    else:
+        return channel_counts, extended_channels
+
+    excluded = np.arange(extended_channels.shape[1]) == ref - 1
+    normalised[1][:, excluded] = extended_channels[:, excluded]
+    return tuple(normalised)
+
+def normalise_region(r, mode, normalisation_ref='None', R=None, denominator=None):
+    ''' Normalise all the series of region r according to mode, as normalise() does
+    one series at a time, returning the normalised (counts, channel_counts,
+    extended_channels). See normalise_channels().
+    '''
+    if (mode == 'double') and (r.region.scan_mode == 'ConstantFinalState') and \
+       (denominator is None):
+        denominator = double_normalisation_denominator(R, R.selection.dbl_norm_ref_numerator)
+    counts = normalise(r, r.region.counts, 'counts', mode, normalisation_ref, R,
+                       denominator)
+    return (counts,) + normalise_channels(r, mode, normalisation_ref, R, denominator)
+
+
+class NormalisationCache(object):
+    ''' Remembers normalised series so they aren't recomputed each time a series is
+    plotted or exported. normalise(), normalise_region() and denominator() take the
+    same arguments and return the same results as the functions of the same names in
+    this module.
+
+    Each region keeps the latest normalised counts and the latest normalised
+    channel_counts and extended_channels matrices, from normalise_channels(), so
+    normalising one channel normalises them all. Each is kept together with the inputs
+    it was computed from: the normalisation mode and normalisation_ref, the
+    reference region R, its numerator and denominator channels, the region's own
+    dbl_norm_ref and, for counts, the channels selected in the region (and in R if its
+    numerator is 'Counts'). A result is reused while these are unchanged and replaced
+    when any changes, so the cache never needs clearing. Regions are held weakly, so
+    their results go with them.
+    The region data are assumed not to change, ys must be the values of the series
+    named and the results returned must not be modified.
+    '''
+    def __init__(self):
+        # r: {'counts' or 'channels': (inputs, result), series_name: (matrices, ys)}
+        self._series = weakref.WeakKeyDictionary()
+        self._denominators = weakref.WeakKeyDictionary()   # R: (inputs, denominator)
+
+    def normalise(self, r, ys, series_name, mode, normalisation_ref='None', R=None):
+        ''' Return normalise(r, ys, series_name, mode, normalisation_ref, R), computing
+        it only if it isn't cached. '''
+        if not _is_normalised(r, mode):
+            return ys
+        if series_name == 'counts':
+            return self._get(r, 'counts', mode, normalisation_ref, R, ys)
+        matrices = self._get(r, 'channels', mode, normalisation_ref, R)
+        # Keep the column too, so the same series is returned while it is unchanged
+        parts = self._series[r]
+        cached = parts.get(series_name)
+        if cached is None or cached[0] is not matrices:
+            channel_counts, extended_channels = matrices
+            if get_name_body(series_name) == 'channel_counts':
+                ys = channel_counts[:, get_name_num(series_name)-1]
+            else:
+                ys = extended_channels[:, get_name_num(series_name)-1]
+            cached = parts[series_name] = (matrices, ys)
+        return cached[1]
+
+    def normalise_region(self, r, mode, normalisation_ref='None', R=None):
+        ''' Return normalise_region(r, mode, normalisation_ref, R), computing only the
+        parts that aren't cached. '''
+        if not _is_normalised(r, mode):
+            return normalise_region(r, mode)
+        counts = self._get(r, 'counts', mode, normalisation_ref, R, r.region.counts)
+        return (counts,) + self._get(r, 'channels', mode, normalisation_ref, R)
+
+    def _get(self, r, part, mode, normalisation_ref, R, counts=None):
+        # Return the cached part 'counts' or 'channels' of region r, if its inputs are
+        # unchanged, else compute and cache it
+        channels = _channel_mask(r) if part == 'counts' else None
+        if mode == 'self':
+            inputs = ('self', normalisation_ref, channels)
+        else:
+            # R is referred to weakly, as R may be r itself
+            inputs = ('double', weakref.ref(R), _denominator_inputs(R),
+                      r.selection.dbl_norm_ref, channels)
+
+        parts = self._series.setdefault(r, {})
+        cached = parts.get(part)
+        if cached is not None and cached[0] == inputs:
+            return cached[1]
+        denominator = self.denominator(R) if mode == 'double' else None
+        if part == 'counts':
+            result = normalise(r, counts, 'counts', mode, normalisation_ref, R, denominator)
+        else:
+            result = normalise_channels(r, mode, normalisation_ref, R, denominator)
+        parts[part] = (inputs, result)
+        return result
+
+    def denominator(self, R):
+        ''' Return the double_normalisation_denominator(R, s) of reference region R,
+        for its numerator s, computing it only if it isn't cached. '''
+        inputs = _denominator_inputs(R)
+        cached = self._denominators.get(R)
+        if cached is not None and cached[0] == inputs:
+            return cached[1]
+        denominator = double_normalisation_denominator(R, R.selection.dbl_norm_ref_numerator)
+        self._denominators[R] = (inputs, denominator)
+        return denominator
+
+def _is_normalised(r, mode):
+    ''' Whether normalise() changes the series of region r in mode. '''
+    return (mode == 'self') or \
+           ((mode == 'double') and (r.region.scan_mode == 'ConstantFinalState'))
+
+def _channel_mask(r):
+    ''' The channels selected in region r, as a hashable value. '''
+    return tuple(sorted(r.selection.get_channel_counts_states().iteritems()))
+
+def _denominator_inputs(R):
+    ''' What the double normalisation denominator of reference region R depends on. '''
+    s = R.selection.dbl_norm_ref_numerator
+    return (s, R.selection.dbl_norm_ref, _channel_mask(R) if s == 'Counts' else None)
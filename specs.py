@@ -62,15 +62,28 @@
 from __future__ import division
 import xml.etree.ElementTree        # required by py2exe
 import xml.etree.cElementTree as ET
-from StringIO import StringIO
-from numpy import array, linspace, arange, zeros, ceil, amax, amin, argmax, argmin, abs
-from numpy import polyfit, polyval, seterr, trunc, mean
+import xml.parsers.expat as expat
+import codecs
+import hashlib
+import json
+import multiprocessing
+import os
+from numpy import array, fromstring, linspace, arange, zeros, ones, ceil, amax, amin, argmax, argmin, abs
+from numpy import polyfit, polyval, seterr, trunc, mean, newaxis, maximum, where
+from numpy import ndarray, broadcast_to, errstate, inf, isfinite
 from numpy.linalg import norm
 from scipy.interpolate import interp1d
 
 DEBUG = False
 OPTION = 2
 
+# Where region indexes of SPECS files are kept between sessions.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.sinspect', 'cache')
+
+# Bound on the rounding errors of the pre-edge fit gradients found from running sums,
+# relative to the largest gradient.
+PREEDGE_RTOL = 1e-7
+
 # We do not allow divide by zeros at all: raise an error if it happens.
 seterr(divide='raise')
 
@@ -86,102 +99,334 @@ class SPECS(object):
 
         specs_obj = specs.SPECS(my_xml_file)
 
+    The file is parsed incrementally: each RegionData struct is turned into a
+    SPECSRegion as soon as its closing tag has been read and its subtree is then
+    cleared, so peak memory is bounded by the largest region rather than by the
+    whole document.
+
+    With lazy=True the regions are constructed lazily (see SPECSRegion): only their
+    metadata is parsed while the file is read, so opening a file costs little more
+    than the XML parse itself.
+
+    With processes other than 1 the regions are instead parsed in parallel by a pool
+    of that many worker processes (None for one per CPU), each reading the byte range
+    given for its region by the file's SPECSIndex. Groups and regions come out in
+    the same order as when parsing serially. processes is ignored when lazy is set,
+    as there is then little to parse up front.
+
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, processes=1):
         """ Constructor, takes the xml file path. """
-        
-        tree = ET.ElementTree()
-        
+
+        self.xmlroot = None
+        self.xmlversion = None
+        self.groups = []
+        self.lazy = lazy
+
+        if processes != 1 and not lazy:
+            self._parallel_parse(filename, processes)
+            return
+
         try:
-            # SPECSLab files are encoded using cp1252 but are not declared as such
-            # so we reencode the cp1252 as utf-8, the xml default, before parsing.
-            contents = open(filename, 'r').read().decode("cp1252").encode("utf-8")
-            self.xmlroot = tree.parse(StringIO(contents))
+            with open(filename, 'rb') as f:
+                self._iterparse(_cp1252_stream(f))
         except NameError:
             print "SPECS init error: could not open this file as an xml tree."
             return None
 
-        # The version impacts on properties of the document so we need to read it
-        # here.
-        self.xmlversion = self.xmlroot.get('version')
-
-        # For convenience, store groups as a list and provide a member function
-        # to access by name - same for regions.
-        self.groups = []
-        for group in list(self.xmlroot[0]):
-            # All the subelements will be individual groups (called a RegionGroup in
-            # SPECS parlance) but we must check in case the file format changes.
-            if group.get('type_name') == "RegionGroup":
-                self.groups.append(SPECSGroup(group))
+    def _iterparse(self, stream):
+        """ Walk the document with iterparse, building regions and groups as their
+        elements close.
+
+        The layout we rely on is the same as for the tree-based parser: the root
+        element holds a sequence of RegionGroup structs and the second child of each
+        group is the sequence of its RegionData structs.
+
+        """
+
+        path = []       # the chain of currently open elements, root first
+        regions = []    # regions of the group currently being read
+        for event, elem in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if self.xmlroot is None:
+                    # The version impacts on properties of the document so we need to
+                    # read it here.
+                    self.xmlroot = elem
+                    self.xmlversion = elem.get('version')
+                path.append(elem)
+                continue
+
+            path.pop()
+            depth = len(path)
+            if depth == 4 and elem.get('type_name') == "RegionData":
+                group = path[2]
+                if (path[1] is self.xmlroot[0] and
+                        group.get('type_name') == "RegionGroup" and
+                        len(group) > 1 and path[3] is group[1]):
+                    regions.append(SPECSRegion(elem, lazy=self.lazy))
+                    elem.clear()
+            elif depth == 2 and path[1] is self.xmlroot[0]:
+                # All the subelements will be individual groups (called a RegionGroup
+                # in SPECS parlance) but we must check in case the file format changes.
+                if elem.get('type_name') == "RegionGroup":
+                    self.groups.append(SPECSGroup(elem, regions))
+                regions = []
+                elem.clear()
+
+    def _parallel_parse(self, filename, processes):
+        """ Parse the regions listed in the file's index across a process pool. The
+        regions are returned from the workers pickled, which for their numpy arrays
+        is a single copy of the raw data.
+
+        """
+
+        index = SPECSIndex(filename)
+        self.xmlversion = index.xmlversion
+        tasks = [(filename, region['start'], region['end'])
+                 for group in index.groups for region in group['regions']]
+        pool = multiprocessing.Pool(processes)
+        try:
+            regions = iter(pool.map(_parse_region_range, tasks, chunksize=1))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        for group in index.groups:
+            self.groups.append(SPECSGroup(
+                None, [regions.next() for region in group['regions']],
+                name=_element_text(group['name'])))
 
 
 class SPECSGroup(object):
     """ Encapsulates a "RegionGroup" struct from the SPECS XML format. """
 
-    def __init__(self, xmlgroup):
+    def __init__(self, xmlgroup, regions=None, name=None):
+        """ If regions is given it is taken to be the already-parsed list of
+        SPECSRegion objects for this group, otherwise they are parsed from xmlgroup.
+        xmlgroup may be None if both regions and name are given.
+
+        """
 
-        self.name = xmlgroup[0].text
+        self.name = xmlgroup[0].text if xmlgroup is not None else name
 
         if DEBUG:
             print "======================= ", self.name, " ========================"
 
+        if regions is not None:
+            self.regions = regions
+            return
+
         self.regions = []
         for region in list(xmlgroup[1]):
             if region.get('type_name') == "RegionData":
                 self.regions.append(SPECSRegion(region))
 
 
+class LinearAxis(object):
+    """ An evenly spaced axis of length values, from start in steps of step, or with
+    origin given the values origin less those, as the binding energy axis is the
+    excitation energy less the kinetic energy axis.
+
+    Only the three numbers are kept. The first and last values and the length are
+    known from them, so the ranges of two axes can be compared without making either
+    one; the values themselves are made, as numpy.linspace(start, stop, length), the
+    first time the axis is used as an array and are then kept. Indexing and len()
+    work as for the array.
+
+    """
+
+    def __init__(self, start, step, length, origin=None):
+        self.start = start
+        self.step = step
+        self.length = length
+        self.origin = origin
+        self._values = None
+
+    def __getstate__(self):
+        # The values are remade rather than pickled
+        return (self.start, self.step, self.length, self.origin)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return 'LinearAxis(%r, %r, %r, origin=%r)' % (self.start, self.step,
+                                                      self.length, self.origin)
+
+    @property
+    def stop(self):
+        """ The last value of the axis before any origin is applied. """
+        if self.length > 1:
+            return self.start + (self.length - 1) * self.step
+        return self.start
+
+    @property
+    def first(self):
+        if self.origin is None:
+            return self.start
+        return self.origin - self.start
+
+    @property
+    def last(self):
+        if self.origin is None:
+            return self.stop
+        return self.origin - self.stop
+
+    @property
+    def values(self):
+        if self._values is None:
+            values = linspace(self.start, self.stop, self.length)
+            if self.origin is not None:
+                values = self.origin - values
+            self._values = values
+        return self._values
+
+    @property
+    def size(self):
+        return self.length
+
+    @property
+    def shape(self):
+        return (self.length,)
+
+    def __len__(self):
+        return self.length
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.values
+        return self.values.astype(dtype)
+
+    def __getitem__(self, key):
+        # The ends are known without making the values
+        if isinstance(key, (int, long)) and self.length:
+            if key in (0, -self.length):
+                return self.first
+            if key in (-1, self.length - 1):
+                return self.last
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class _Payload(object):
+    """ Descriptor for a SPECSRegion attribute holding part of the numeric payload.
+    Accessing or assigning it first decodes the payload of a lazily constructed
+    region.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = '_' + name
+
+    def __get__(self, region, owner):
+        if region is None:
+            return self
+        if region._pending_payload is not None:
+            region.load_payload()
+        try:
+            return region.__dict__[self.key]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, region, value):
+        if region._pending_payload is not None:
+            region.load_payload()
+        region.__dict__[self.key] = value
+
+
 class SPECSRegion(object):
-    """ Encapsulates a "RegionData" struct from the SPECS XML format. """
+    """ Encapsulates a "RegionData" struct from the SPECS XML format.
 
-    def __init__(self, xmlregion):
+    Constructed with lazy=True, only the metadata (name, comment, the RegionDef
+    fields, axes and detector calibration) is parsed up front. Only the text of the
+    payload sequences is kept and it is decoded, and memoised, the first time one of
+    the payload attributes below is accessed.
 
-        self.name = xmlregion[0].text
-        self.num_cycles = int(xmlregion[7].attrib['length'])
+    """
 
-        self.raw_counts = []
-        self.scaling_factors = []
-        self.extended_channels = []
+    raw_counts = _Payload('raw_counts')
+    transmission = _Payload('transmission')
+    counts = _Payload('counts')
+    channel_counts = _Payload('channel_counts')
+    extended_channels = _Payload('extended_channels')
+    alignment_mask = _Payload('alignment_mask')
+
+    # The attributes read from the metadata, some of which may be missing
+    METADATA = ('name', 'comment', 'num_cycles', 'scaling_factors', 'scan_mode',
+                'dwell_time', 'analyzer_lens', 'scan_delta', 'excitation_energy',
+                'pass_energy', 'kinetic_energy', 'values_per_curve',
+                'effective_workfunction', 'kinetic_axis', 'binding_axis',
+                'excitation_axis', 'time_axis', 'mcd_head', 'mcd_tail',
+                'detector_channel_shifts', 'detector_channel_positions',
+                'detector_channel_gains', 'detector_channel_offsets',
+                'num_extended_channels')
+    PAYLOAD = ('raw_counts', 'transmission', 'counts', 'channel_counts',
+               'extended_channels', 'alignment_mask')
+
+    def __init__(self, xmlregion, lazy=False):
+
+        self._pending_payload = None
+        self._payload_hooks = []
+
+        self._parse_metadata(xmlregion)
+        if lazy:
+            self._pending_payload = self._find_payload(xmlregion)
+        else:
+            self._parse_payload(self._find_payload(xmlregion))
 
-        # First grab the counts for this region: this is the most important part.
-        # The counts can't be used directly as they incorporate all nine channels
-        # in a single array and need to be chopped and aligned first.
-        # Improvement from v1: we search directly for the named sequence rather
-        # than iterating generally.
-        for elem in xmlregion.findall(".//sequence[@type_name='CountsSeq']"):
-            self.raw_counts.append(
-                array([int(x) for x in elem[0].text.split()]))
+    def load_payload(self):
+        """ Decode the numeric payload of a lazily constructed region, if that has not
+        happened yet, and call any hooks registered with add_payload_hook.
 
-        # Scaling factors for the counts.
-        # for elem in xmlregion.findall(".//sequence[@name='scaling_factors']"):
-        #     self.scaling_factors.append(
-        #         array([float(x) for x in elem[0].text.split()]))
+        """
+        payload, self._pending_payload = self._pending_payload, None
+        if payload is None:
+            return
+        try:
+            self._parse_payload(payload)
+        except:
+            # Leave it pending, so using the region raises the same error again
+            self._pending_payload = payload
+            raise
+        for hook in self._payload_hooks:
+            hook(self)
+        self._payload_hooks = []
+
+    def parsed_state(self):
+        """ Return the attributes read from the file, keyed as in __dict__: the metadata
+        and either the decoded payload or, while it is pending, the payload text under
+        _pending_payload. Attributes added by users of the region are left out.
+
+        """
+        if self._pending_payload is None:
+            keys = self.METADATA + tuple('_' + name for name in self.PAYLOAD)
+        else:
+            keys = self.METADATA + ('_pending_payload',)
+        return dict((key, self.__dict__[key]) for key in keys if key in self.__dict__)
 
-        # Look for Extended Channels in a YCurveSeq set.
-        for ycs in xmlregion.findall(".//sequence[@type_name='YCurveSeq']"):
-            for ycurve in ycs:
-                if "Extended Channel" in ycurve[0].text:
-                    for channel in ycurve.iter('sequence'):
-                        if channel.attrib['name'] == "data":
-                            tmp = array(
-                                [float(x) for x in channel[0].text.split()])
-                            self.extended_channels.append(tmp)
+    def add_payload_hook(self, hook):
+        """ Register hook to be called with this region as its argument once the
+        payload has been decoded. It is called straight away if that already
+        happened.
 
-        # Grab the transmission function. This is *not* to be trusted but SPECS
-        # might implicitly use it for display within the SPECS program itself so
-        # we need to read it.
-        trans = xmlregion.find(".//sequence[@name='transmission']")
-        if trans is not None and len(trans) > 0:
-            try:
-                self.transmission = array(
-                    [float(x) for x in trans[0].text.split()])
-            except ValueError:
-                # SPECS sometimes says the transmission is "Infinity", obviously not a
-                # useful number so we explicitly set the transmission to be None here.
-                self.transmission = None
+        """
+        if self._pending_payload is None:
+            hook(self)
         else:
-            self.transmission = None
+            self._payload_hooks.append(hook)
+
+    def _parse_metadata(self, xmlregion):
+        """ Read everything except the counts, extended channels and transmission. """
+
+        self.name = xmlregion[0].text
+        self.num_cycles = int(xmlregion[7].attrib['length'])
+        self.scaling_factors = []
 
         # Iterate over all the elements in the RegionDef struct.
         # Note: should ONLY BE ONE of these, so use find rather than findall.
@@ -207,20 +452,18 @@ class SPECSRegion(object):
                 self.effective_workfunction = float(elem.text)
 
         # The kinetic energy and binding energy axes:
-        ke_upper = self.kinetic_energy + (self.values_per_curve -
-                                          1) * self.scan_delta
-        self.kinetic_axis = linspace(
-            self.kinetic_energy, ke_upper, self.values_per_curve)
-        self.binding_axis = self.excitation_energy - self.kinetic_axis
+        self.kinetic_axis = LinearAxis(
+            self.kinetic_energy, self.scan_delta, self.values_per_curve)
+        self.binding_axis = LinearAxis(
+            self.kinetic_energy, self.scan_delta, self.values_per_curve,
+            origin=self.excitation_energy)
 
         # Excitation axis (for NEXAFS)
-        exc_upper = self.excitation_energy + (
-            self.values_per_curve - 1) * self.scan_delta
-        self.excitation_axis = linspace(
-            self.excitation_energy, exc_upper, self.values_per_curve)
+        self.excitation_axis = LinearAxis(
+            self.excitation_energy, self.scan_delta, self.values_per_curve)
 
         # Time axis
-        self.time_axis = arange(self.values_per_curve) * self.dwell_time
+        self.time_axis = LinearAxis(0.0, self.dwell_time, self.values_per_curve)
 
         # MCD head and tail are the extra elements added to the beginning and
         # end of the scan.
@@ -256,14 +499,94 @@ class SPECSRegion(object):
         self.detector_channel_offsets = self.pass_energy * \
             self.detector_channel_shifts
 
-        num_detectors = len(self.detector_channel_offsets)
-
         # Now, we need to know the analyzer mode, because how we add the channeltron data
         # together depends on whether we are sweeping the kinetic energy in the analyzer or
         # not.
         scanmode = xmlregion.find(".//struct[@type_name='ScanMode']")
         self.scan_mode = scanmode[0].text
 
+        # Count the extended channel curves without decoding them, so the shape of the
+        # extended_channels array is known before the payload is read.
+        self.num_extended_channels = 0
+        for ycs in xmlregion.findall(".//sequence[@type_name='YCurveSeq']"):
+            for ycurve in ycs:
+                if "Extended Channel" in ycurve[0].text:
+                    for channel in ycurve.iter('sequence'):
+                        if channel.attrib['name'] == "data":
+                            self.num_extended_channels += 1
+
+        # Extract the comment from the parameter list.
+        for elem in xmlregion[9].iter("struct"):
+            if elem[0].text == "Comment":
+                self.comment = elem[1].text
+
+    def _find_payload(self, xmlregion):
+        """ Pick the text of the counts, extended channel and transmission sequences
+        out of the RegionData element, without decoding it. Returns a tuple of a list
+        of the counts sequences, a list of the extended channel sequences and the
+        transmission sequence (or None), each given as a (text, length) pair.
+
+        """
+
+        # First grab the counts for this region: this is the most important part.
+        # The counts can't be used directly as they incorporate all nine channels
+        # in a single array and need to be chopped and aligned first.
+        # Improvement from v1: we search directly for the named sequence rather
+        # than iterating generally.
+        counts = []
+        for elem in xmlregion.findall(".//sequence[@type_name='CountsSeq']"):
+            counts.append(_sequence_text(elem))
+
+        # Scaling factors for the counts.
+        # for elem in xmlregion.findall(".//sequence[@name='scaling_factors']"):
+        #     self.scaling_factors.append(
+        #         array([float(x) for x in elem[0].text.split()]))
+
+        # Look for Extended Channels in a YCurveSeq set.
+        extended_channels = []
+        for ycs in xmlregion.findall(".//sequence[@type_name='YCurveSeq']"):
+            for ycurve in ycs:
+                if "Extended Channel" in ycurve[0].text:
+                    for channel in ycurve.iter('sequence'):
+                        if channel.attrib['name'] == "data":
+                            extended_channels.append(_sequence_text(channel))
+
+        # Grab the transmission function. This is *not* to be trusted but SPECS
+        # might implicitly use it for display within the SPECS program itself so
+        # we need to read it.
+        trans = xmlregion.find(".//sequence[@name='transmission']")
+        if trans is not None and len(trans) > 0:
+            transmission = _sequence_text(trans)
+        else:
+            transmission = None
+
+        return counts, extended_channels, transmission
+
+    def _parse_payload(self, payload):
+        """ Decode the counts, extended channels and transmission found by
+        _find_payload, then align the channeltron data.
+
+        """
+
+        counts, extended_channels, transmission = payload
+
+        self.raw_counts = [_decode_sequence(text, length, int)
+                           for text, length in counts]
+        self.extended_channels = [_decode_sequence(text, length, float)
+                                  for text, length in extended_channels]
+
+        self.transmission = None
+        if transmission is not None:
+            try:
+                self.transmission = _decode_sequence(
+                    transmission[0], transmission[1], float)
+            except ValueError:
+                # SPECS sometimes says the transmission is "Infinity", obviously not a
+                # useful number so we explicitly set the transmission to be None here.
+                self.transmission = None
+
+        num_detectors = len(self.detector_channel_offsets)
+
         # Calculate so and si (based on the SPECS document "Acquiring Data with
         # Multidetector systems"). Don't really need si or t.
         try:
@@ -292,27 +615,18 @@ class SPECSRegion(object):
         self.channel_counts = zeros(
             (self.values_per_curve, len(self.detector_channel_offsets)))
 
-        for c in self.raw_counts:
-            tmp_channels = []
-            for i in range(num_detectors):
-                tmp_channels.append(c[i::9])
-            # IMPORTANT: If FixedAnalyzerTransmission or FixedRetardingRatio, we need to use
-            # the nearest-neighbour method to align the channeltron energies. I have only
-            # implemented the method for FixedAnalyzerTransission at the moment - the FRR
-            # implementation is different and rather more difficult and no one ever uses it.
-            if self.scan_mode != "FixedAnalyzerTransmission":
+        # IMPORTANT: If FixedAnalyzerTransmission or FixedRetardingRatio, we need to use
+        # the nearest-neighbour method to align the channeltron energies. I have only
+        # implemented the method for FixedAnalyzerTransission at the moment - the FRR
+        # implementation is different and rather more difficult and no one ever uses it.
+        if self.scan_mode != "FixedAnalyzerTransmission":
+            for c in self.raw_counts:
                 for i in range(num_detectors):
-                    self.counts += array(tmp_channels[i])
-                    self.channel_counts[:, i] += array(tmp_channels[i])
-            else:
-                for i in range(self.values_per_curve):
-                    for j in range(num_detectors):
-                        try:
-                            self.counts[i] += tmp_channels[j][i + idxs[j]]
-                            self.channel_counts[
-                                i, j] += tmp_channels[j][i + idxs[j]]
-                        except IndexError:
-                            print "SPECSRegion: Darn, an index error unpacking the channeltron data. This was not supposed to happen!"
+                    self.counts += c[i::9]
+                    self.channel_counts[:, i] += c[i::9]
+            self.alignment_mask = ones(self.channel_counts.shape, dtype=bool)
+        else:
+            self._align_channels(idxs)
 
         # Trim the extended channels if they are present. There should not be any
         # calibration issue here - SPECS just treats the extended channels as if
@@ -342,10 +656,322 @@ class SPECSRegion(object):
         else:
             self.extended_channels = None
 
-        # Extract the comment from the parameter list.
-        for elem in xmlregion[9].iter("struct"):
-            if elem[0].text == "Comment":
-                self.comment = elem[1].text
+    def _align_channels(self, idxs):
+        """ Add the raw counts of every cycle into self.counts and self.channel_counts
+        using the nearest-neighbour method: the value for energy index i in channel j
+        is sample i + idxs[j] of that channel's data, where the channel data is every
+        9th raw value starting at position j.
+
+        All cycles of the same length are gathered in one go. Samples that fall
+        outside a channel's data are left out of the sums and flagged False in
+        self.alignment_mask, which has the same shape as self.channel_counts.
+
+        """
+
+        num_detectors = len(idxs)
+        channels = arange(num_detectors)
+        positions = arange(self.values_per_curve)[:, newaxis] + array(idxs, dtype=int)
+        self.alignment_mask = ones(positions.shape, dtype=bool)
+
+        by_length = {}
+        for c in self.raw_counts:
+            by_length.setdefault(len(c), []).append(c)
+
+        for length in sorted(by_length):
+            channel_lengths = maximum((length - channels + 8) // 9, 0)
+            # Negative positions count back from the end of the channel data, as in
+            # ordinary python indexing.
+            valid = (positions < channel_lengths) & (positions >= -channel_lengths)
+            wrapped = where(positions < 0, positions + channel_lengths, positions)
+            self.alignment_mask &= valid
+            if not valid.any():
+                continue
+            raw_positions = where(valid, channels + 9 * wrapped, 0)
+            gathered = array(by_length[length])[:, raw_positions].sum(axis=0)
+            gathered[~valid] = 0
+            self.channel_counts += gathered
+            self.counts += gathered.sum(axis=1)
+
+        if DEBUG and not self.alignment_mask.all():
+            print "SPECSRegion: %d channeltron values fell outside the raw data." % \
+                (~self.alignment_mask).sum()
+
+
+class SPECSIndex(object):
+    """ A byte-offset index of the groups and regions in a SPECSLab .xml file, which
+    allows single regions to be read without parsing the rest of the file. Construct
+    with:
+
+        index = specs.SPECSIndex(my_xml_file)
+        region = index.read_region(group, region)
+
+    index.groups is a list of dicts with keys 'name', 'start', 'end' and 'regions',
+    the last being a list of dicts with keys 'name', 'start' and 'end'. start and end
+    delimit the bytes of the RegionGroup or RegionData struct in the file.
+
+    The file is scanned once and the index saved in cache_dir, keyed by the file's
+    size and modification time, so later constructions just load it. Pass
+    cache_dir=None to neither load nor save an index.
+
+    """
+
+    def __init__(self, filename, cache_dir=CACHE_DIR):
+
+        self.filename = filename
+        stat = os.stat(filename)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.xmlversion = None
+        self.groups = []
+
+        if cache_dir is None:
+            self.path = None
+        else:
+            path = os.path.abspath(filename)
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            self.path = os.path.join(cache_dir,
+                                     hashlib.md5(path).hexdigest() + '.index')
+
+        if not self._load():
+            self._scan()
+            self._save()
+
+    def _load(self):
+        """ Load a saved index, returning False if there is none for the file as it is
+        now.
+
+        """
+        if self.path is None:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if saved.get('size') != self.size or saved.get('mtime') != self.mtime:
+            return False
+        self.xmlversion = saved['xmlversion']
+        self.groups = saved['groups']
+        return True
+
+    def _save(self):
+        """ Save the index. Failing to do so is not an error, the file just gets
+        scanned again next time.
+
+        """
+        if self.path is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'wb') as f:
+                json.dump({'size': self.size, 'mtime': self.mtime,
+                           'xmlversion': self.xmlversion, 'groups': self.groups}, f)
+        except (IOError, OSError):
+            pass
+
+    def _scan(self):
+        """ Scan the file with expat, recording where each group and region starts and
+        ends and reading their names. The structure recognised is the same as for
+        SPECS: RegionGroup structs in the root's first child, with their RegionData
+        structs in the group's second child.
+
+        """
+
+        parser = expat.ParserCreate('cp1252')
+        stack = []      # [child index, record or None] for each open element
+        name = []       # character data of the name being read
+
+        def start(tag, attrib):
+            if stack:
+                index = stack[-1][2]
+                stack[-1][2] += 1
+            else:
+                index = 0
+                self.xmlversion = attrib.get('version')
+            depth = len(stack)
+            record = None
+            type_name = attrib.get('type_name')
+            if depth == 2 and type_name == "RegionGroup" and stack[1][0] == 0:
+                record = {'name': None, 'start': parser.CurrentByteIndex,
+                          'regions': []}
+                self.groups.append(record)
+            elif (depth == 4 and type_name == "RegionData" and stack[2][1] and
+                    stack[3][0] == 1):
+                record = {'name': None, 'start': parser.CurrentByteIndex}
+                stack[2][1]['regions'].append(record)
+            elif depth in (3, 5) and index == 0 and stack[-1][1]:
+                # The first child holds the name of a group or region
+                del name[:]
+                parser.CharacterDataHandler = name.append
+            stack.append([index, record, 0])
+
+        def end(tag):
+            index, record, children = stack.pop()
+            if record is not None:
+                # The end tag starts here; _scan finds where it finishes afterwards
+                record['end'] = parser.CurrentByteIndex
+            elif len(stack) in (3, 5) and index == 0 and stack[-1][1]:
+                stack[-1][1]['name'] = u''.join(name)
+                # Skip the character data of everything else, which is most of the file
+                parser.CharacterDataHandler = None
+
+        parser.buffer_text = True
+        parser.buffer_size = 1 << 16
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        with open(self.filename, 'rb') as f:
+            parser.ParseFile(f)
+            for group in self.groups:
+                for record in [group] + group['regions']:
+                    f.seek(record['end'])
+                    record['end'] += f.read(256).index('>') + 1
+
+    def _lookup(self, records, key):
+        """ Return the record with index or name key. """
+        if isinstance(key, (int, long)):
+            return records[key]
+        for record in records:
+            if record['name'] == key:
+                return record
+        raise KeyError(key)
+
+    def read_region(self, group, region, lazy=False):
+        """ Seek to and parse just one region, returning it as a SPECSRegion. group and
+        region are each either an index or a name; for a name the first match is used.
+
+        """
+        record = self._lookup(self._lookup(self.groups, group)['regions'], region)
+        return _read_region_range(self.filename, record['start'], record['end'], lazy)
+
+
+class SPECSFollower(object):
+    """ Follow a SPECSLab .xml file that is still being written during acquisition.
+    Construct with:
+
+        follower = specs.SPECSFollower(my_xml_file)
+
+    then call follower.poll() whenever the file may have grown. Each poll parses only
+    the bytes added since the last one, feeding them to an incremental parser, and
+    returns the regions completed by them. follower.groups holds the SPECSGroup objects
+    read so far, with regions appended to them as they complete. Regions are the
+    smallest unit reported: a region being acquired appears once its RegionData struct
+    has been completely written. lazy is as for SPECS.
+
+    If the file is found to have been truncated or rewritten, rather than appended to,
+    the follower starts again from the beginning of the file: follower.restarts is
+    incremented, the groups are replaced and the poll returns every region.
+
+    """
+
+    # Bytes before the parsed position compared at each poll to detect rewrites
+    SIGNATURE_SIZE = 256
+
+    def __init__(self, filename, lazy=False):
+
+        self.filename = filename
+        self.lazy = lazy
+        self.restarts = 0
+        self._start()
+
+    def _start(self):
+        """ Set up to parse the file from the beginning. """
+
+        self.xmlroot = None
+        self.xmlversion = None
+        self.groups = []
+        self.offset = 0             # Bytes of the file parsed so far
+        self._signature = ''
+        self._path = []             # the chain of currently open elements, root first
+        self._builder = ET.TreeBuilder()
+        self._group = None          # the RegionGroup element being read, if any
+        self._new = []
+        self._parser = ET.XMLParser(target=self)
+
+    def poll(self):
+        """ Parse what has been added to the file since the last poll, returning a list
+        of (group, region) pairs for the regions completed, where group is the
+        SPECSGroup in self.groups that region was appended to.
+
+        """
+
+        with open(self.filename, 'rb') as f:
+            f.seek(max(self.offset - self.SIGNATURE_SIZE, 0))
+            if f.read(self.offset - f.tell()) != self._signature:
+                # The file isn't the one we were reading
+                self.restarts += 1
+                self._start()
+                f.seek(0)
+            contents = f.read()
+
+        try:
+            # SPECSLab files are encoded using cp1252 but are not declared as such, and
+            # cp1252 is a single byte encoding, so any chunk of the file can be decoded.
+            self._parser.feed(contents.decode("cp1252").encode("utf-8"))
+        except SyntaxError:
+            if self.offset == 0:
+                raise
+            # The file may have been rewritten in a way the signature didn't reveal, so
+            # try once more from the beginning of the file
+            self.restarts += 1
+            self._start()
+            return self.poll()
+
+        self.offset += len(contents)
+        self._signature = (self._signature + contents)[-self.SIGNATURE_SIZE:]
+        new, self._new = self._new, []
+        return new
+
+    def _group_for(self, elem):
+        """ Return the SPECSGroup for RegionGroup element elem, creating it if elem is
+        not the group currently being read.
+
+        """
+        if elem is not self._group:
+            self._group = elem
+            self.groups.append(SPECSGroup(None, [], name=elem[0].text))
+        return self.groups[-1]
+
+    # The methods below are the parser target. They build elements with a TreeBuilder
+    # and pick out regions and groups as SPECS._iterparse does.
+
+    def start(self, tag, attrib):
+        elem = self._builder.start(tag, attrib)
+        if self.xmlroot is None:
+            self.xmlroot = elem
+            self.xmlversion = elem.get('version')
+        self._path.append(elem)
+        return elem
+
+    def end(self, tag):
+        elem = self._builder.end(tag)
+        path = self._path
+        path.pop()
+        depth = len(path)
+        if depth == 4 and elem.get('type_name') == "RegionData":
+            group = path[2]
+            if (path[1] is self.xmlroot[0] and
+                    group.get('type_name') == "RegionGroup" and
+                    len(group) > 1 and path[3] is group[1]):
+                region = SPECSRegion(elem, lazy=self.lazy)
+                specs_group = self._group_for(group)
+                specs_group.regions.append(region)
+                self._new.append((specs_group, region))
+                elem.clear()
+        elif depth == 2 and path[1] is self.xmlroot[0]:
+            if elem.get('type_name') == "RegionGroup":
+                # Groups without regions appear when they end
+                self._group_for(elem)
+            elem.clear()
+        return elem
+
+    def data(self, data):
+        self._builder.data(data)
+
+    def close(self):
+        return self._builder.close()
+
 
 ################################################################################
 #
@@ -354,6 +980,80 @@ class SPECSRegion(object):
 ################################################################################
 
 
+def read_region(filename, group, region, lazy=False, cache_dir=CACHE_DIR):
+    """ R = specs.read_region(filename, group, region)
+
+    Read a single region from a SPECSLab .xml file using its SPECSIndex, so only the
+    bytes of that region are parsed once the index exists. group and region are each
+    either an index or a name.
+
+    """
+    return SPECSIndex(filename, cache_dir).read_region(group, region, lazy=lazy)
+
+
+def _read_region_range(filename, start, end, lazy=False):
+    """ Parse the RegionData struct occupying bytes start to end of filename. """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        contents = f.read(end - start)
+    # SPECSLab files are encoded using cp1252 but are not declared as such.
+    xmlregion = ET.fromstring(contents.decode("cp1252").encode("utf-8"))
+    return SPECSRegion(xmlregion, lazy=lazy)
+
+
+def _parse_region_range(args):
+    """ Worker for SPECS._parallel_parse; a module-level function so it can be pickled.
+    """
+    return _read_region_range(*args)
+
+
+def _element_text(text):
+    """ Return text as ElementTree would give it for an element: None if empty and a
+    str rather than unicode if plain ascii.
+
+    """
+    if not text:
+        return None
+    try:
+        return text.encode('ascii')
+    except UnicodeEncodeError:
+        return text
+
+
+def _cp1252_stream(f):
+    """ Wrap the binary file object f in a stream that reads it as cp1252 and yields
+    utf-8. SPECSLab files are encoded using cp1252 but are not declared as such, so
+    we reencode the cp1252 as utf-8, the xml default, as the parser consumes it.
+
+    """
+    return codecs.EncodedFile(f, 'utf-8', 'cp1252')
+
+
+def _sequence_text(seq):
+    """ Return the (text, length) pair of a SPECS sequence element: the text of its
+    first child, which holds the values, and its declared length attribute.
+
+    """
+    return seq[0].text, seq.get('length')
+
+
+def _decode_sequence(text, length, dtype):
+    """ Decode the whitespace-separated numbers in text, as returned by
+    _sequence_text, into an array of type dtype (int or float).
+
+    The text is parsed in bulk by numpy. If that does not produce exactly the number
+    of values the sequence declares in its length attribute, the text is decoded one
+    token at a time instead, so malformed data raises ValueError just as it would
+    with int() or float().
+
+    """
+    if text is not None and length is not None:
+        values = fromstring(text, dtype=dtype, sep=' ')
+        if values.size == int(length):
+            return values
+    return array([dtype(x) for x in text.split()])
+
+
 def preedge_calculate(x, y):
     """ P = specs.preedge_calculate(x,y)
 
@@ -385,35 +1085,19 @@ def preedge_calculate(x, y):
     maxidx = abs(y - amax(y)).argmin()
 
     # Find the gradient of every possible linear fit between the lowest binding energy
-    # and the biggest peak.
-    grads = []
-    for i in range(2, len(x) - maxidx):
-        # Best linear fit to the last i values
-        xs = x[-i:]
-        ys = y[-i:]
-        #p = polyfit(xs,ys,1)
-        #grads.append(p[0])
-        # Try a new algorithm that should be faster than polyfit
-        xs = xs - mean(xs)
-        ys = ys - mean(ys)
-        grads.append((xs * ys).sum() / (xs * xs).sum())
-
-    # Differentiate the gradient array.
-    dgrads = []
-    for i in range(len(grads) - 1):
-        dgrads.append(grads[i + 1] - grads[i])
-    dgrads = array(dgrads)
+    # and the biggest peak, i.e. to the last i values for i from 2 to len(x) - maxidx - 1
+    grads = _suffix_gradients(x[newaxis], y[newaxis])[0, :max(len(x) - maxidx - 2, 0)]
+
+    # Find the minimum index of the absolute of the gradient of gradients.
+    mingrad = _preedge_mingrad(x, y, grads)
 
     # We might not have actually accumulated anything if the maximum is near the
     # edge (like in a survey scan - the SE background is very big). So, may have
     # to return a zero background.
-    if not dgrads.any():
+    if mingrad is None:
         print "specs.preedge_calculate: No pre-edge gradients. The spectrum must be very large at the low kinetic energy end. Returning zero background."
         return zeros(x.shape)
 
-    # Find the minimum index of the absolute of the gradient of gradients.
-    mingrad = abs(dgrads).argmin()
-
     # Make a best linear fit from this number of pre-edge points, generate linear
     # pre-edge.
     p = polyfit(x[-mingrad:], y[-mingrad:], 1)
@@ -424,6 +1108,60 @@ def preedge_calculate(x, y):
         return polyval(p, x)
 
 
+def _suffix_gradient(x, y, i):
+    """ The gradient of the best linear fit to the last i values of x and y. """
+    xs = x[-i:] - mean(x[-i:])
+    ys = y[-i:] - mean(y[-i:])
+    return (xs * ys).sum() / (xs * xs).sum()
+
+
+def _suffix_gradients(x, y):
+    """ Return the gradients of the best linear fits to the last 2, 3, ... n values of
+    each row of the 2D (m, n) arrays x and y as an (m, n - 1) array, using running sums
+    so all are found in O(m * n) time rather than the O(m * n^2) of fitting each in
+    turn. Each row is centred on its last point to limit the rounding errors.
+
+    """
+    x = x[:, ::-1] - x[:, -1:]
+    y = y[:, ::-1] - y[:, -1:]
+    i = arange(1, x.shape[1] + 1)
+    sx = x.cumsum(axis=1)
+    sy = y.cumsum(axis=1)
+    sxx = (x * x).cumsum(axis=1)
+    sxy = (x * y).cumsum(axis=1)
+    with errstate(divide='ignore', invalid='ignore'):
+        grads = (sxy - sx * sy / i) / (sxx - sx * sx / i)
+    return grads[:, 1:]
+
+
+def _preedge_mingrad(x, y, grads):
+    """ Return the index of the smallest absolute difference between successive
+    gradients grads of the linear fits to the last 2, 3, ... values of x and y, or None
+    if the gradients don't change at all.
+    grads comes from running sums, so may differ from the gradients of the individual
+    fits by rounding errors. The differences close to the smallest are checked with
+    gradients fitted individually, so the index is the one the individual fits give.
+
+    """
+    dgrads = abs(grads[1:] - grads[:-1])
+    tolerance = PREEDGE_RTOL * abs(grads).max() if grads.size else 0
+    if not (dgrads > tolerance).any():
+        # The gradients may all be the same, which only individual fits can tell
+        grads = array([_suffix_gradient(x, y, i) for i in range(2, grads.size + 2)])
+        dgrads = abs(grads[1:] - grads[:-1])
+        return dgrads.argmin() if dgrads.any() else None
+
+    candidates = (dgrads <= dgrads.min() + 2 * tolerance).nonzero()[0]
+    if candidates.size == 1:
+        return candidates[0]
+    exact = {}
+    for i in candidates:
+        for j in (i, i + 1):
+            if j not in exact:
+                exact[j] = _suffix_gradient(x, y, j + 2)
+    return candidates[array([abs(exact[i + 1] - exact[i]) for i in candidates]).argmin()]
+
+
 def shirley_calculate(x, y, tol=1e-5, maxit=10):
     """ S = specs.shirley_calculate(x,y, tol=1e-5, maxit=10)
 
@@ -480,23 +1218,25 @@ def shirley_calculate(x, y, tol=1e-5, maxit=10):
     B[:lmidx] = yl - yr
     Bnew = B.copy()
 
+    # The parts of the trapezoid terms between lmidx and imax that don't depend on B
+    dx = 0.5 * (x[lmidx:imax] - x[lmidx + 1:imax + 1])
+    ysum = y[lmidx:imax] + y[lmidx + 1:imax + 1] - 2 * yr
+    # tail[i - lmidx] will hold int_(x_i)^(xr) J(x') - yr - B(x') dx', which is zero
+    # for i = imax
+    tail = zeros(imax - lmidx + 1)
+
     it = 0
     while it < maxit:
         if DEBUG:
             print "Shirley iteration: ", it
+        # Integrate from every point to xr at once, as a reverse cumulative sum of the
+        # trapezoid terms
+        terms = dx * (ysum - B[lmidx:imax] - B[lmidx + 1:imax + 1])
+        tail[:-1] = terms[::-1].cumsum()[::-1]
         # Calculate new k = (yl - yr) / (int_(xl)^(xr) J(x') - yr - B(x') dx')
-        ksum = 0.0
-        for i in range(lmidx, imax):
-            ksum += (x[i] - x[i + 1]) * 0.5 * (y[i] + y[i + 1]
-                                               - 2 * yr - B[i] - B[i + 1])
-        k = (yl - yr) / ksum
+        k = (yl - yr) / tail[0]
         # Calculate new B
-        for i in range(lmidx, rmidx):
-            ysum = 0.0
-            for j in range(i, imax):
-                ysum += (x[j] - x[j + 1]) * 0.5 * (y[j] +
-                                                   y[j + 1] - 2 * yr - B[j] - B[j + 1])
-            Bnew[i] = k * ysum
+        Bnew[lmidx:rmidx] = k * tail
         # If Bnew is close to B, exit.
         if norm(Bnew - B) < tol:
             B = Bnew.copy()
@@ -511,3 +1251,239 @@ def shirley_calculate(x, y, tol=1e-5, maxit=10):
         return (yr + B)[::-1]
     else:
         return yr + B
+
+
+# Status of each spectrum returned by the batch background functions.
+BG_OK = 0               # background found (converged, for Shirley backgrounds)
+BG_MAXIT = 1            # Shirley: maximum iterations exceeded before convergence
+BG_EMPTY = 2            # x or y is empty: zero background
+BG_BOUNDARY = 3         # Shirley: biggest peak at the edge: zero background
+BG_NO_PREEDGE = 4       # pre-edge: no pre-edge gradients: zero background
+BG_DEGENERATE = 5       # Shirley: no area between the minima to scale: zero background
+
+# Number of values of the spectra worked on at once by the batch background functions
+BATCH_BLOCK = 1 << 14
+
+
+def preedge_calculate_batch(x, y):
+    """ P, status = specs.preedge_calculate_batch(x, y)
+
+    Calculate the pre-edge background of many spectra at once, as preedge_calculate does
+    for one. y is a 2D array with a spectrum in each row, and x either their shared 1D
+    axis or a 2D array of axes, or y is a list of 1D spectra of any lengths and x a list
+    of their axes. P is a 2D array or list of backgrounds to match y, and status holds
+    BG_OK, BG_EMPTY or BG_NO_PREEDGE for each spectrum instead of printing messages.
+
+    """
+    return _batch(_preedge_rows, x, y)
+
+
+def shirley_calculate_batch(x, y, tol=1e-5, maxit=10):
+    """ S, status = specs.shirley_calculate_batch(x, y, tol=1e-5, maxit=10)
+
+    Calculate the auto-Shirley background of many spectra at once, as shirley_calculate
+    does for one. x and y are as for preedge_calculate_batch. S is a 2D array or list of
+    backgrounds to match y, and status holds BG_OK, BG_MAXIT, BG_EMPTY, BG_BOUNDARY or
+    BG_DEGENERATE for each spectrum instead of printing messages.
+
+    """
+    return _batch(_shirley_rows, x, y, tol=tol, maxit=maxit)
+
+
+def _batch(calculate, x, y, **kwargs):
+    """ Apply calculate(x, y, **kwargs), which works on 2D arrays of spectra with the
+    same length, to the spectra y with axes x as described in preedge_calculate_batch.
+    Lists of spectra are grouped by length, so each length is calculated in one call.
+
+    """
+    if isinstance(y, ndarray) and y.ndim == 2:
+        x = array(x, dtype=float)
+        if x.ndim == 1:
+            x = broadcast_to(x, y.shape)
+        return _in_blocks(calculate, x, array(y, dtype=float), **kwargs)
+
+    backgrounds = [None] * len(y)
+    status = zeros(len(y), dtype=int)
+    rows_of_length = {}
+    for row, ys in enumerate(y):
+        rows_of_length.setdefault(len(ys), []).append(row)
+    for n, rows in rows_of_length.iteritems():
+        xs = array([x[row] for row in rows], dtype=float).reshape(len(rows), n)
+        ys = array([y[row] for row in rows], dtype=float).reshape(len(rows), n)
+        bgs, bgs_status = _in_blocks(calculate, xs, ys, **kwargs)
+        for row, bg, st in zip(rows, bgs, bgs_status):
+            backgrounds[row] = bg
+            status[row] = st
+    return backgrounds, status
+
+
+def _in_blocks(calculate, x, y, **kwargs):
+    """ Apply calculate to blocks of rows of x and y of about BATCH_BLOCK values, which
+    is faster than working on large arrays that don't fit in the processor cache.
+
+    """
+    m, n = y.shape
+    rows = max(BATCH_BLOCK // max(n, 1), 1)
+    if m <= rows:
+        return calculate(x, y, **kwargs)
+    backgrounds = zeros((m, n))
+    status = zeros(m, dtype=int)
+    for i in range(0, m, rows):
+        backgrounds[i:i + rows], status[i:i + rows] = calculate(x[i:i + rows],
+                                                                y[i:i + rows], **kwargs)
+    return backgrounds, status
+
+
+def _prepare_rows(x, y):
+    """ Copy the 2D arrays of axes x and spectra y, with each row reversed if necessary
+    so the energy values are decreasing, and locate the biggest peak of each row.
+    Returns x, y, the rows that were reversed, the rows that are empty and the index of
+    the peak in each row.
+
+    """
+    m, n = y.shape
+    x = x.copy()
+    y = y.copy()
+    empty = ~(x.any(axis=1) & y.any(axis=1))
+    reversed_rows = x[:, 0] < x[:, -1] if n else zeros(m, dtype=bool)
+    x[reversed_rows] = x[reversed_rows, ::-1]
+    y[reversed_rows] = y[reversed_rows, ::-1]
+    if n:
+        maxidx = abs(y - amax(y, axis=1)[:, newaxis]).argmin(axis=1)
+    else:
+        maxidx = zeros(m, dtype=int)
+    return x, y, reversed_rows, empty, maxidx
+
+
+def _preedge_rows(x, y):
+    """ preedge_calculate_batch for 2D arrays x and y of the same shape. """
+    m, n = y.shape
+    status = zeros(m, dtype=int)
+    x, y, reversed_rows, empty, maxidx = _prepare_rows(x, y)
+    rows = arange(m)
+
+    with errstate(divide='ignore', invalid='ignore'):
+        # The gradients of the linear fits to the last i values of every row, for i
+        # from 2 up to the number before the row's biggest peak
+        counts = maximum(n - maxidx - 2, 0)     # the number of gradients in each row
+        grads = _suffix_gradients(x, y) if n else zeros((m, 0))
+        grads[arange(grads.shape[1]) >= counts[:, newaxis]] = 0
+
+        # Differentiate the gradient arrays, ignoring the differences past each row's end
+        dgrads = abs(grads[:, 1:] - grads[:, :-1])
+        valid = arange(dgrads.shape[1]) < (counts - 1)[:, newaxis]
+        dgrads[~valid] = inf
+        no_preedge = counts < 2
+        mingrad = zeros(m, dtype=int)
+        if dgrads.shape[1]:
+            mingrad = dgrads.argmin(axis=1)
+            # As in preedge_calculate, the rows whose gradients may all be the same, or
+            # which have differences close to the smallest, are checked with individual
+            # fits
+            tolerance = (PREEDGE_RTOL * abs(grads).max(axis=1))[:, newaxis]
+            changes = (valid & (dgrads > tolerance)).any(axis=1)
+            near = (dgrads <= dgrads[rows, mingrad][:, newaxis] + 2 * tolerance).sum(axis=1)
+            for row in rows[~no_preedge & ~(changes & (near == 1))]:
+                g = _preedge_mingrad(x[row], y[row], grads[row, :counts[row]])
+                if g is None:
+                    no_preedge[row] = True
+                else:
+                    mingrad[row] = g
+
+        # Make a best linear fit from this number of pre-edge points of each row. As in
+        # preedge_calculate, x[-0:] is all of x.
+        start = where(mingrad == 0, 0, n - mingrad)
+        fit = arange(n) >= start[:, newaxis]
+        npts = fit.sum(axis=1)
+        mx = where(fit, x, 0).sum(axis=1) / npts
+        my = where(fit, y, 0).sum(axis=1) / npts
+        xs = where(fit, x - mx[:, newaxis], 0)
+        ys = where(fit, y - my[:, newaxis], 0)
+        slope = (xs * ys).sum(axis=1) / (xs * xs).sum(axis=1)
+        P = slope[:, newaxis] * (x - mx[:, newaxis]) + my[:, newaxis]
+
+    # A single point has no least squares line, so leave those to polyfit as
+    # preedge_calculate does
+    for row in rows[npts == 1]:
+        P[row] = polyval(polyfit(x[row, start[row]:], y[row, start[row]:], 1), x[row])
+
+    status[no_preedge] = BG_NO_PREEDGE
+    status[empty] = BG_EMPTY
+    P[status != BG_OK] = 0
+    P[reversed_rows] = P[reversed_rows, ::-1]
+    return P, status
+
+
+def _shirley_rows(x, y, tol=1e-5, maxit=10):
+    """ shirley_calculate_batch for 2D arrays x and y of the same shape. """
+    m, n = y.shape
+    S = zeros((m, n))
+    status = zeros(m, dtype=int)
+    x, y, reversed_rows, empty, maxidx = _prepare_rows(x, y)
+    rows = arange(m)
+    boundary = (maxidx == 0) | (maxidx >= n - 1)
+    status[boundary] = BG_BOUNDARY
+    status[empty] = BG_EMPTY
+    active = rows[status == BG_OK]
+    if not active.size:
+        return S, status
+    x = x[active]
+    y = y[active]
+    maxidx = maxidx[active][:, newaxis]
+    rows = arange(active.size)
+
+    # Locate the minima either side of maxidx in each row
+    columns = arange(n)
+    lmidx = where(columns < maxidx, y, inf).argmin(axis=1)
+    rmidx = where(columns >= maxidx, y, inf).argmin(axis=1)
+    yl = y[rows, lmidx][:, newaxis]
+    yr = y[rows, rmidx][:, newaxis]
+    imax = rmidx - 1
+
+    # Initial value of the background shapes B, as in shirley_calculate
+    B = where(columns < lmidx[:, newaxis], yl - yr, 0.0)
+
+    # B only changes between lmidx and rmidx, so only the columns between the smallest
+    # lmidx and largest rmidx take part in the iteration
+    c0, c1 = lmidx.min(), rmidx.max() + 1
+    columns = columns[c0:c1 - 1]
+    x = x[:, c0:c1]
+    y = y[:, c0:c1]
+    b = B[:, c0:c1].copy()
+    # The trapezoid terms are dx * (ysum - B[j] - B[j + 1]) between lmidx and imax and
+    # zero elsewhere, so the reverse cumulative sums of the terms give the integral from
+    # each point to xr
+    terms_mask = ((columns >= lmidx[:, newaxis]) & (columns < imax[:, newaxis]))
+    dx = where(terms_mask, 0.5 * (x[:, :-1] - x[:, 1:]), 0)
+    dx_ysum = dx * (y[:, :-1] + y[:, 1:] - 2 * yr)
+    # B is updated between lmidx and rmidx
+    update = ((arange(c0, c1) >= lmidx[:, newaxis]) &
+              (arange(c0, c1) < rmidx[:, newaxis]))
+    tail = zeros(b.shape)
+    k_index = lmidx - c0
+    dy = (yl - yr)[:, 0]
+
+    with errstate(divide='ignore', invalid='ignore'):
+        for it in range(maxit):
+            terms = dx_ysum - dx * (b[:, :-1] + b[:, 1:])
+            tail[:, :-1] = terms[:, ::-1].cumsum(axis=1)[:, ::-1]
+            k = dy / tail[arange(rows.size), k_index]
+            # A zero integral leaves no k to scale B by
+            degenerate = ~isfinite(k)
+            status[active[rows[degenerate]]] = BG_DEGENERATE
+            Bnew = where(update, k[:, newaxis] * tail, b)
+            converged = norm(Bnew - b, axis=1) < tol
+            B[rows, c0:c1] = Bnew
+            # Carry on with only the rows still iterating
+            keep = ~(converged | degenerate)
+            rows = rows[keep]
+            if not rows.size:
+                break
+            b, tail, update = Bnew[keep], tail[keep], update[keep]
+            dx, dx_ysum, k_index, dy = dx[keep], dx_ysum[keep], k_index[keep], dy[keep]
+
+    status[active[rows]] = BG_MAXIT
+    S[active] = yr + B
+    S[status == BG_DEGENERATE] = 0
+    S[reversed_rows] = S[reversed_rows, ::-1]
+    return S, status
@@ -0,0 +1,343 @@
+################################################################################
+#
+# specs_cache.py
+#
+# A persistent on-disk cache of parsed SPECSLab files.
+#
+################################################################################
+#
+# Each parsed file is stored as one container in the cache directory:
+#
+#   MAGIC
+#   header length, as a little-endian unsigned 64 bit integer
+#   JSON header describing the groups and regions
+#   the region arrays, raw and each aligned to ALIGN bytes
+#
+# Region attributes that are numpy arrays (or lists of them, like raw_counts)
+# are written to the array section and described in the header by their dtype,
+# shape and offset. The axes (specs.LinearAxis) are stored in the header by their
+# start, step, length and origin, as is everything else as JSON. Containers
+# are read back with a copy-on-write memmap, so opening a cached file only
+# touches the pages of the arrays actually used, and the arrays can still be
+# modified in memory without changing the cache.
+#
+# A region whose payload hasn't been decoded yet (see specs.SPECSRegion) has its
+# payload text stored instead, as uint8 arrays, and is read back still pending.
+# A lazily opened file is stored when its first region is decoded and again
+# when its last one is, so the regions that have been used are kept decoded.
+#
+# Containers are named after the path of the source file and are only used
+# while the file's size and modification time match those in the header. The
+# total size of the cache is kept under a limit by evicting the least recently
+# used containers, with each container's modification time refreshed on use.
+#
+################################################################################
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import numpy as np
+import specs
+
+MAGIC = 'SINSPECT-CACHE 3\n'
+ALIGN = 64
+EXTENSION = '.specs'
+CACHE_SIZE = 1024 ** 3      # Default size limit of the cache, in bytes
+
+
+class SPECSCache(object):
+    """ A cache of parsed SPECSLab .xml files. Use in place of specs.SPECS:
+
+        cache = specs_cache.SPECSCache()
+        s = cache.open(my_xml_file)
+
+    The returned object has the same xmlversion and groups attributes as a specs.SPECS
+    object, with groups and regions that are specs.SPECSGroup and specs.SPECSRegion
+    instances. On a miss the file is parsed with specs.SPECS and stored; failing to
+    write the container is not an error. A file opened lazily is only stored once one
+    of its regions has been decoded, so a miss costs no more than specs.SPECS does.
+
+    """
+
+    def __init__(self, cache_dir=specs.CACHE_DIR, max_size=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def entry_path(self, filename):
+        """ Return the path of the container for filename. """
+        path = os.path.abspath(filename)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.md5(path).hexdigest() + EXTENSION)
+
+    def open(self, filename, lazy=False, processes=1):
+        """ Return the parsed file, from the cache if possible. lazy and processes are
+        passed to specs.SPECS on a miss.
+
+        """
+        stat = os.stat(filename)
+        path = self.entry_path(filename)
+        try:
+            s = load(path, stat.st_size, stat.st_mtime)
+        except (IOError, OSError, ValueError, KeyError):
+            s = None
+        if s is not None:
+            try:
+                # Mark the container as recently used
+                os.utime(path, None)
+            except OSError:
+                pass
+            self._store_when_decoded(path, s, stat, stored=True)
+            return s
+
+        s = specs.SPECS(filename, lazy=lazy, processes=processes)
+        self._store_when_decoded(path, s, stat, stored=False)
+        return s
+
+    def _store_when_decoded(self, path, s, stat, stored):
+        """ Store s in the container at path now if it isn't stored and has no pending
+        regions, otherwise when the first (if it isn't stored) and the last of its
+        pending regions are decoded.
+
+        """
+        # Each region's state is taken as soon as it is decoded, before the payload
+        # hooks of the caller can change it
+        region_attrs = {}
+        pending = []
+        for group in s.groups:
+            for region in group.regions:
+                if region._pending_payload is None:
+                    region_attrs[region] = region.parsed_state()
+                else:
+                    pending.append(region)
+        if not pending:
+            if not stored:
+                self._store(path, s, stat, region_attrs)
+            return
+        remaining = [len(pending)]
+
+        def decoded(region):
+            region_attrs[region] = region.parsed_state()
+            remaining[0] -= 1
+            if remaining[0] == 0 or (not stored and remaining[0] == len(pending) - 1):
+                self._store(path, s, stat, region_attrs)
+
+        for region in pending:
+            region.add_payload_hook(decoded)
+
+    def _store(self, path, s, stat, region_attrs):
+        """ Save s to the container at path, ignoring a failure to write it. """
+        try:
+            save(path, s, stat.st_size, stat.st_mtime, region_attrs)
+            self.evict(keep=path)
+        except (IOError, OSError):
+            pass
+
+    def evict(self, keep=None):
+        """ Remove the least recently used containers until the cache is no larger
+        than max_size. The container at keep, if given, is never removed.
+
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(EXTENSION):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                # On Windows a container that is still mapped can't be removed
+                pass
+
+    def clear(self):
+        """ Remove all containers. """
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(EXTENSION):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+
+def open_specs(filename, lazy=False, processes=1, cache_dir=specs.CACHE_DIR,
+               max_size=CACHE_SIZE):
+    """ s = specs_cache.open_specs(filename)
+
+    Open filename through a SPECSCache in cache_dir.
+
+    """
+    return SPECSCache(cache_dir, max_size).open(filename, lazy=lazy, processes=processes)
+
+
+def save(path, s, size, mtime, region_attrs=None):
+    """ Write the parsed specs.SPECS object s, of a source file of size and mtime, to a
+    container at path, taking the states of the regions in region_attrs from there.
+
+    """
+    arrays = []
+    offset = [0]
+
+    def add(arr):
+        arr = np.ascontiguousarray(arr)
+        offset[0] += -offset[0] % ALIGN
+        arrays.append((offset[0], arr))
+        descr = [arr.dtype.str, arr.shape, offset[0]]
+        offset[0] += arr.nbytes
+        return descr
+
+    def add_text(text_length):
+        if text_length is None:
+            return None
+        text, length = text_length
+        if text is not None:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            text = add(np.frombuffer(text, dtype=np.uint8))
+        return [text, length]
+
+    groups = []
+    for group in s.groups:
+        regions = []
+        for region in group.regions:
+            if region_attrs is not None and region in region_attrs:
+                attrs = region_attrs[region]
+            else:
+                attrs = region.parsed_state()
+            state = {}
+            for key, value in attrs.iteritems():
+                if key == '_pending_payload':
+                    counts, extended_channels, transmission = value
+                    state[key] = {'payload': [[add_text(c) for c in counts],
+                                              [add_text(e) for e in extended_channels],
+                                              add_text(transmission)]}
+                elif isinstance(value, np.ndarray):
+                    state[key] = {'array': add(value)}
+                elif isinstance(value, specs.LinearAxis):
+                    state[key] = {'axis': value.__getstate__()}
+                elif (isinstance(value, list) and value and
+                        all(isinstance(v, np.ndarray) for v in value)):
+                    state[key] = {'arrays': [add(v) for v in value]}
+                else:
+                    state[key] = {'value': value}
+            regions.append(state)
+        groups.append({'name': group.name, 'regions': regions})
+
+    header = json.dumps({'size': size, 'mtime': mtime, 'xmlversion': s.xmlversion,
+                         'groups': groups})
+    start = len(MAGIC) + 8 + len(header)
+    start += -start % ALIGN
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Write a temporary file first so an interrupted save leaves no partial container
+    fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for offset, arr in arrays:
+                f.seek(start + offset)
+                arr.tofile(f)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def load(path, size, mtime):
+    """ Read the container at path, returning an object like specs.SPECS whose arrays are
+    memory mapped, or None if the container is not for a source file of this size and
+    mtime.
+
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length), object_hook=_ascii_strings)
+    if header['size'] != size or header['mtime'] != mtime:
+        return None
+    start = len(MAGIC) + 8 + length
+    start += -start % ALIGN
+    buf = np.memmap(path, dtype=np.uint8, mode='c')
+
+    def view(descr):
+        dtype, shape, offset = descr
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.ndarray(shape, dtype=dtype, buffer=buf, offset=start + offset)
+
+    def text(text_length):
+        if text_length is None:
+            return None
+        descr, length = text_length
+        return (view(descr).tostring() if descr is not None else None), length
+
+    s = _restore(specs.SPECS, {'xmlroot': None, 'xmlversion': header['xmlversion'],
+                               'lazy': False, 'groups': []})
+    for group in header['groups']:
+        regions = []
+        for state in group['regions']:
+            attrs = {'_pending_payload': None, '_payload_hooks': []}
+            for key, value in state.iteritems():
+                if 'payload' in value:
+                    counts, extended_channels, transmission = value['payload']
+                    attrs[key] = ([text(c) for c in counts],
+                                  [text(e) for e in extended_channels],
+                                  text(transmission))
+                elif 'array' in value:
+                    attrs[key] = view(value['array'])
+                elif 'axis' in value:
+                    attrs[key] = specs.LinearAxis(*value['axis'])
+                elif 'arrays' in value:
+                    attrs[key] = [view(v) for v in value['arrays']]
+                else:
+                    attrs[key] = value['value']
+            regions.append(_restore(specs.SPECSRegion, attrs))
+        s.groups.append(_restore(specs.SPECSGroup, {'name': group['name'],
+                                                    'regions': regions}))
+    return s
+
+
+def _restore(cls, attrs):
+    """ Create an instance of cls with attributes attrs, without calling __init__. """
+    obj = cls.__new__(cls)
+    obj.__dict__.update(attrs)
+    return obj
+
+
+def _ascii_strings(d):
+    """ json returns unicode for every string, where ElementTree returns str for plain
+    ascii text. Convert back so cached regions match parsed ones.
+
+    """
+    return dict((_ascii(k), [_ascii(x) for x in v] if isinstance(v, list) else _ascii(v))
+                for k, v in d.iteritems())
+
+
+def _ascii(value):
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return value
@@ -0,0 +1,209 @@
+import os
+import sys
+
+PATH_HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
+
+import unittest
+import nose
+from nose.tools import eq_, ok_
+import numpy as np
+import specs
+
+
+TESTDATA_DIR = 'testdata'
+
+
+def shirley_reference(x, y, tol=1e-5, maxit=10):
+    ''' The original O(n^2) loops of specs.shirley_calculate, kept to check the
+    vectorised version against.
+    '''
+    x = np.array(x)
+    y = np.array(y)
+    if not (x.any() and y.any()):
+        return np.zeros(x.shape)
+    is_reversed = x[0] < x[-1]
+    if is_reversed:
+        x = x[::-1]
+        y = y[::-1]
+    maxidx = abs(y - np.amax(y)).argmin()
+    if maxidx == 0 or maxidx >= len(y) - 1:
+        return np.zeros(x.shape)
+    lmidx = abs(y[0:maxidx] - np.amin(y[0:maxidx])).argmin()
+    rmidx = abs(y[maxidx:] - np.amin(y[maxidx:])).argmin() + maxidx
+    yl = y[lmidx]
+    yr = y[rmidx]
+    imax = rmidx - 1
+    B = np.zeros(x.shape)
+    B[:lmidx] = yl - yr
+    Bnew = B.copy()
+    for it in range(maxit):
+        ksum = 0.0
+        for i in range(lmidx, imax):
+            ksum += (x[i] - x[i + 1]) * 0.5 * (y[i] + y[i + 1]
+                                               - 2 * yr - B[i] - B[i + 1])
+        k = (yl - yr) / ksum
+        for i in range(lmidx, rmidx):
+            ysum = 0.0
+            for j in range(i, imax):
+                ysum += (x[j] - x[j + 1]) * 0.5 * (y[j] +
+                                                   y[j + 1] - 2 * yr - B[j] - B[j + 1])
+            Bnew[i] = k * ysum
+        converged = np.linalg.norm(Bnew - B) < tol
+        B = Bnew.copy()
+        if converged:
+            break
+    if is_reversed:
+        return (yr + B)[::-1]
+    return yr + B
+
+
+def preedge_reference(x, y):
+    ''' The original fit of every suffix of specs.preedge_calculate, kept to check the
+    running sums version against.
+    '''
+    x = np.array(x)
+    y = np.array(y)
+    if not (x.any() and y.any()):
+        return np.zeros(x.shape)
+    is_reversed = x[0] < x[-1]
+    if is_reversed:
+        x = x[::-1]
+        y = y[::-1]
+    maxidx = abs(y - np.amax(y)).argmin()
+    grads = []
+    for i in range(2, len(x) - maxidx):
+        xs = x[-i:] - np.mean(x[-i:])
+        ys = y[-i:] - np.mean(y[-i:])
+        grads.append((xs * ys).sum() / (xs * xs).sum())
+    dgrads = np.array([grads[i + 1] - grads[i] for i in range(len(grads) - 1)])
+    if not dgrads.any():
+        return np.zeros(x.shape)
+    mingrad = abs(dgrads).argmin()
+    p = np.polyfit(x[-mingrad:], y[-mingrad:], 1)
+    if is_reversed:
+        return np.polyval(p, x)[::-1]
+    return np.polyval(p, x)
+
+
+def xps_peak(n, increasing=False):
+    ''' A noisy peak on a step, on a binding energy axis of n points. '''
+    rng = np.random.RandomState(n)
+    x = np.linspace(300, 280, n)
+    y = 1000 * np.exp(-(x - 290) ** 2 / 2.) + 200 * (x > 290) + 50 + 5 * rng.rand(n)
+    if increasing:
+        return x[::-1], y[::-1]
+    return x, y
+
+
+class ShirleyTest(unittest.TestCase):
+    def synthetic_peaks_test(self):
+        for n in (5, 50, 300):
+            for increasing in (False, True):
+                for maxit in (1, 3, 10):
+                    x, y = xps_peak(n, increasing)
+                    ok_(np.allclose(specs.shirley_calculate(x, y, maxit=maxit),
+                                    shirley_reference(x, y, maxit=maxit),
+                                    rtol=1e-12, atol=0))
+
+    def region_counts_test(self):
+        s = specs.SPECS(os.path.join(TESTDATA_DIR, 'test_data.xml'))
+        for group in s.groups:
+            for region in group.regions:
+                x, y = region.binding_axis, region.counts
+                ok_(np.allclose(specs.shirley_calculate(x, y), shirley_reference(x, y),
+                                rtol=1e-12, atol=0))
+
+    def zero_background_test(self):
+        x, y = xps_peak(50)
+        # Peak at the end of the data
+        eq_(specs.shirley_calculate(x, x).tolist(), [0] * 50)
+        # No data
+        eq_(specs.shirley_calculate(x, np.zeros(50)).tolist(), [0] * 50)
+
+
+class PreedgeTest(unittest.TestCase):
+    def synthetic_test(self):
+        rng = np.random.RandomState(0)
+        x = np.linspace(320, 280, 400)
+        spectra = [
+            # NEXAFS-like edge, increasing and decreasing
+            1 / (1 + np.exp(x - 300)) + 0.01 * rng.rand(400) + 5 * np.exp(-(x - 318) ** 2),
+            # integer counts, with many equal gradient changes
+            np.round(10 * rng.rand(400)) + 100 * np.exp(-(x - 310) ** 2),
+            # a straight line, whose gradients don't change
+            3 * x + 5,
+        ]
+        for y in spectra:
+            for xs, ys in ((x, y), (x[::-1], y[::-1]), (x[:50], y[:50])):
+                eq_(specs.preedge_calculate(xs, ys).tolist(),
+                    preedge_reference(xs, ys).tolist())
+
+    def region_channels_test(self):
+        s = specs.SPECS(os.path.join(TESTDATA_DIR, 'test_data.xml'))
+        for group in s.groups:
+            for region in group.regions:
+                for y in [region.counts] + list(region.extended_channels.T):
+                    eq_(specs.preedge_calculate(region.binding_axis, y).tolist(),
+                        preedge_reference(region.binding_axis, y).tolist())
+
+
+class BatchBackgroundTest(unittest.TestCase):
+    def setUp(self):
+        self.x = np.linspace(300, 280, 100)
+        rng = np.random.RandomState(0)
+        self.y = np.array([1000 * np.exp(-(self.x - c) ** 2 / 2.) + 200 * (self.x > c) +
+                           50 + 5 * rng.rand(100) for c in np.linspace(282, 298, 20)])
+        # Spectra of many lengths, some on increasing axes
+        self.xs, self.ys = [], []
+        for i, n in enumerate([3, 10, 57, 100, 57, 10, 3, 100]):
+            x, y = xps_peak(n, increasing=i % 2)
+            self.xs.append(x)
+            self.ys.append(y)
+
+    def shirley_shared_axis_test(self):
+        S, status = specs.shirley_calculate_batch(self.x, self.y)
+        eq_(S.shape, self.y.shape)
+        for s, y, st in zip(S, self.y, status):
+            ok_(np.allclose(s, specs.shirley_calculate(self.x, y), rtol=1e-12, atol=0))
+            ok_(st in (specs.BG_OK, specs.BG_MAXIT))
+
+    def shirley_ragged_test(self):
+        S, status = specs.shirley_calculate_batch(self.xs, self.ys, maxit=3)
+        for s, x, y in zip(S, self.xs, self.ys):
+            ok_(np.allclose(s, specs.shirley_calculate(x, y, maxit=3), rtol=1e-12, atol=0))
+
+    def preedge_test(self):
+        P, status = specs.preedge_calculate_batch(self.x, self.y)
+        for p, y in zip(P, self.y):
+            ok_(np.allclose(p, specs.preedge_calculate(self.x, y), rtol=1e-9))
+        P, status = specs.preedge_calculate_batch(self.xs, self.ys)
+        for p, x, y in zip(P, self.xs, self.ys):
+            ok_(np.allclose(p, specs.preedge_calculate(x, y), rtol=1e-9))
+
+    def status_test(self):
+        x = self.x
+        y = np.array([self.y[0], np.zeros(100), x, self.y[1]])
+        S, status = specs.shirley_calculate_batch(x, y)
+        eq_(list(status[1:3]), [specs.BG_EMPTY, specs.BG_BOUNDARY])
+        eq_(S[1:3].tolist(), np.zeros((2, 100)).tolist())
+        S, status = specs.shirley_calculate_batch(x, y, maxit=1)
+        eq_(list(status), [specs.BG_MAXIT, specs.BG_EMPTY, specs.BG_BOUNDARY,
+                           specs.BG_MAXIT])
+        P, status = specs.preedge_calculate_batch(x, y)
+        eq_(list(status), [specs.BG_OK, specs.BG_EMPTY, specs.BG_NO_PREEDGE,
+                           specs.BG_OK])
+
+    def degenerate_test(self):
+        # The minimum left of the peak is next to it and the right one is the peak
+        # itself, so there's nothing to integrate between them
+        y = np.array([self.y[0][:3], [0., 5., 5.], [1., 5., 1.]])
+        S, status = specs.shirley_calculate_batch(self.x[:3], y)
+        eq_(status[1], specs.BG_DEGENERATE)
+        eq_(S[1].tolist(), [0., 0., 0.])
+        ok_(np.isfinite(S).all())
+        ok_(status[2] != specs.BG_DEGENERATE)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
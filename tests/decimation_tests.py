@@ -0,0 +1,58 @@
+import os
+import sys
+
+PATH_HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
+
+import unittest
+import nose
+from nose.tools import eq_, ok_
+import numpy as np
+import decimation
+
+
+class MinMaxPyramidTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.xs = np.linspace(0, 100, 100001)
+        self.ys = np.sin(self.xs) + rng.rand(len(self.xs))
+        self.pyramid = decimation.MinMaxPyramid(self.xs, self.ys)
+
+    def envelope_test(self):
+        xs, ys = self.pyramid.envelope(20, 60, 500)
+        ok_(len(xs) <= 2 * 1000 + 8)
+        ok_((np.diff(xs) > 0).all())
+        # The envelope reaches the extremes of the range
+        inside = (self.xs >= 20) & (self.xs <= 60)
+        shown = (xs >= 20) & (xs <= 60)
+        eq_(ys[shown].max(), self.ys[inside].max())
+        eq_(ys[shown].min(), self.ys[inside].min())
+        # and of the whole series, so the plot's data ranges don't change
+        eq_((xs[0], xs[-1]), (self.xs[0], self.xs[-1]))
+        eq_((ys.min(), ys.max()), (self.ys.min(), self.ys.max()))
+
+    def full_resolution_test(self):
+        xs, ys = self.pyramid.envelope(50, 51, 800)
+        inside = self.xs[(self.xs >= 50) & (self.xs <= 51)]
+        # every sample in range, with at most those either side and the extremes
+        ok_(set(inside) <= set(xs))
+        ok_(len(xs) <= len(inside) + 4)
+
+    def decreasing_axis_test(self):
+        pyramid = decimation.MinMaxPyramid(self.xs[::-1], self.ys[::-1])
+        xs, ys = pyramid.envelope(20, 60, 500)
+        ok_((np.diff(xs) < 0).all())
+        inside = (self.xs >= 20) & (self.xs <= 60)
+        shown = (xs >= 20) & (xs <= 60)
+        eq_(ys[shown].max(), self.ys[inside].max())
+        eq_(ys[shown].min(), self.ys[inside].min())
+        eq_((xs[0], xs[-1]), (self.xs[-1], self.xs[0]))
+
+    def not_monotonic_test(self):
+        xs = np.array([0., 2., 1., 3.])
+        pyramid = decimation.MinMaxPyramid(xs, xs)
+        eq_(pyramid.envelope(0, 1, 1)[0].tolist(), xs.tolist())
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,267 @@
+import os
+import sys
+
+PATH_HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
+
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import nose
+from nose import SkipTest
+from nose.tools import eq_, ok_
+import numpy as np
+import export
+import normalisation
+
+
+TESTDATA_DIR = 'testdata'
+#TESTDATA_DIR = os.path.join('tests', 'testdata')
+
+''' The structure of test_data.xml is specifically built to test functionality of the
+code. Changes to test_data.xml will cause failures in these tests.
+'''
+
+class UniquifyTest(unittest.TestCase):
+    def uniquify_names_test(self):
+        names = list(export.uniquify_names(['a', 'b', 'c', 'a', 'b', 'a']))
+        eq_(names, ['a', 'b', 'c', 'a-1', 'b-1', 'a-2'])
+
+
+class SelectionBitsTest(unittest.TestCase):
+    def selection_bits_test(self):
+        names = (['counts'] +
+                 ['channel_counts_{}'.format(i+1) for i in range(9)] +
+                 ['extended_channels_{}'.format(i+1) for i in range(9)])
+        eq_([export.selection_bit(name) for name in names], [1 << i for i in range(19)])
+        eq_(export.channels_mask('channel_counts', 9), sum(1 << i for i in range(1, 10)))
+        eq_(export.channels_mask('extended_channels', 3), (1 << 10) | (1 << 11) | (1 << 12))
+        eq_(export.channels_mask('extended_channels', 0), 0)
+
+
+class WriteColumnsTest(unittest.TestCase):
+    def same_as_savetxt_test(self):
+        a = np.random.RandomState(0).randn(100, 19) * 1e5
+        a[0, :4] = [np.inf, -np.inf, np.nan, -0.0]
+        for delimiter in export.DELIMITERS.values():
+            expected = StringIO()
+            np.savetxt(expected, a, fmt='%1.8g', delimiter=delimiter)
+            written = StringIO()
+            export.write_columns(written, a, delimiter, rows=7)
+            eq_(written.getvalue(), expected.getvalue())
+
+
+class HeadlessExportTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def no_gui_imports_test(self):
+        for module in sys.modules:
+            ok_(module.split('.')[0] not in ('wx', 'chaco', 'enable'))
+
+    def export_layout_test(self):
+        status = export.main(['-o', self.outdir, '--no-cache', self.filename])
+        eq_(status, 0)
+        path = os.path.join(self.outdir, 'test_data')
+        eq_(sorted(os.listdir(path)), ['Group1', 'Group1-1'])
+        eq_(sorted(os.listdir(os.path.join(path, 'Group1'))),
+            ['Carbon Nexafs Vanil_FI-1.xy', 'Carbon Nexafs Vanil_FI.xy',
+             'Carbon_Nexafs_wrong_E_range Correct no+pts.xy',
+             'Nexafs_double_reference_Photodiode_in_chamber.xy'])
+
+    def header_test(self):
+        export.main(['-o', self.outdir, '--no-cache', '-c', '1,2,4', '-d', 'comma',
+                     '-n', 'self', '-e', '3', self.filename])
+        filename = os.path.join(self.outdir, 'test_data', 'Group1-1',
+                                'Carbon Nexafs Vanil_FI.xy')
+        with open(filename) as f:
+            line1 = f.readline()
+            line2 = f.readline()
+        ok_(line1.startswith('#"Normalised to extended channel 3, '
+                             'Analyzer mode:ConstantFinalState'))
+        ok_(line2.startswith('#"Excitation energy (eV)","Counts 1+2+4",'
+                             '"Channel 1 counts"'))
+
+    def missing_reference_test(self):
+        status = export.main(['-o', self.outdir, '--no-cache', '-n', 'double',
+                              '-r', 'nosuch', self.filename])
+        eq_(status, 1)
+
+
+class ExportFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def _export(self, outdir, processes, writers):
+        return export.export_files(
+            [self.filename, 'nosuch.xml'], os.path.join(self.outdir, outdir),
+            export_options={'mode': 'self', 'normalisation_ref': 2},
+            open_options={'cache': False}, processes=processes, writers=writers)
+
+    def _read_tree(self, outdir):
+        contents = {}
+        for root, dirs, files in os.walk(os.path.join(self.outdir, outdir)):
+            for name in files:
+                with open(os.path.join(root, name)) as f:
+                    contents[os.path.relpath(os.path.join(root, name), self.outdir)
+                             .split(os.sep, 1)[1]] = f.read()
+        return contents
+
+    def deterministic_test(self):
+        errors1 = self._export('serial', 1, 1)
+        errors2 = self._export('parallel', 2, 3)
+        eq_(errors1, errors2)
+        eq_(errors1[-1][0], 'nosuch.xml')
+        serial = self._read_tree('serial')
+        eq_(len(serial), 5)
+        eq_(serial, self._read_tree('parallel'))
+
+    def truncated_payload_test(self):
+        # Cut the first region's counts short
+        with open(self.filename) as f:
+            contents = f.read()
+        start = contents.index('>', contents.index('type_name="CountsSeq"') + 22) + 1
+        end = contents.index('<', start)
+        filename = os.path.join(self.outdir, 'truncated.xml')
+        with open(filename, 'w') as f:
+            f.write(contents[:(start + end) // 2] + contents[end:])
+        for mode in ('none', 'self'):
+            errors = export.export_files(
+                [filename], os.path.join(self.outdir, mode),
+                export_options={'mode': mode, 'normalisation_ref': 2},
+                open_options={'cache': False})
+            # Only the first region isn't exported
+            eq_(errors[0][:2], (filename, 'Nexafs_double_reference_Photodiode_in_chamber'))
+            ok_(errors[0][2].startswith('Error reading the region data'))
+            eq_(len(os.listdir(os.path.join(self.outdir, mode, 'truncated', 'Group1'))), 4)
+
+    def error_state_test(self):
+        # Exporting in this process leaves its numpy error state as it was
+        with np.errstate(divide='raise', invalid='raise'):
+            before = np.geterr()
+            self._export('serial', 1, 1)
+            eq_(np.geterr(), before)
+
+
+class HDF5ExportTest(unittest.TestCase):
+    def setUp(self):
+        if export.h5py is None:
+            raise SkipTest
+        self.filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def same_data_as_xy_test(self):
+        export.main(['-o', self.outdir, '--no-cache', '-n', 'self', '-e', '3',
+                     '-c', '1,2', self.filename])
+        export.main(['-o', self.outdir, '--no-cache', '-n', 'self', '-e', '3',
+                     '-c', '1,2', '-f', 'hdf5', self.filename])
+        xy = np.loadtxt(os.path.join(self.outdir, 'test_data', 'Group1-1',
+                                     'Carbon Nexafs Vanil_FI.xy'))
+        with export.h5py.File(os.path.join(self.outdir, 'test_data.h5'), 'r') as f:
+            region = f['Group1-1/Carbon Nexafs Vanil_FI']
+            eq_(region.attrs['scan_mode'], 'ConstantFinalState')
+            eq_(region.attrs['normalisation'], 'Normalised to extended channel 3')
+            eq_(region.attrs['counts_channels'], '1+2')
+            ok_(np.allclose(region['excitation_axis'][:], xy[:, 0]))
+            ok_(np.allclose(region['counts'][:], xy[:, 1]))
+            ok_(np.allclose(region['channel_counts'][:], xy[:, 2:11]))
+            ok_(np.allclose(region['extended_channels'][:], xy[:, 11:20]))
+            ok_(region['counts'].compression is not None)
+
+    def missing_metadata_test(self):
+        groups, R = export.open_regions(self.filename, cache=False)
+        r = groups[0][1][1]
+        r.region.analyzer_lens = None
+        del r.region.effective_workfunction
+        filename = os.path.join(self.outdir, 'test_data.h5')
+        eq_(export.export_hdf5(filename, groups), [])
+        with export.h5py.File(filename, 'r') as f:
+            region = f['Group1/' + r.name]
+            ok_('analyzer_lens' not in region.attrs)
+            ok_('effective_workfunction' not in region.attrs)
+            eq_(region.attrs['scan_mode'], r.region.scan_mode)
+
+
+class NormalisationCacheTest(unittest.TestCase):
+    def setUp(self):
+        filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        groups, self.R = export.open_regions(
+            filename, reference='Nexafs_double_reference_Photodiode_in_chamber',
+            cache=False)
+        self.r = groups[0][1][1]
+        self.cache = normalisation.NormalisationCache()
+
+    def _series(self, r=None):
+        if r is None:
+            r = self.r
+        yield 'counts', r.region.counts
+        for i in range(r.region.channel_counts.shape[1]):
+            yield 'channel_counts_{}'.format(i+1), r.region.channel_counts[:,i]
+        for i in range(r.region.extended_channels.shape[1]):
+            yield 'extended_channels_{}'.format(i+1), r.region.extended_channels[:,i]
+
+    def same_results_test(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for mode in ['none', 'self', 'double']:
+                for name, ys in self._series():
+                    expected = normalisation.normalise(self.r, ys, name, mode, 3, self.R)
+                    cached = self.cache.normalise(self.r, ys, name, mode, 3, self.R)
+                    np.testing.assert_array_equal(cached, expected)
+
+    def region_matrices_test(self):
+        R = self.R
+        for r in [self.r, R]:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for mode, ref in [('none', 'None'), ('self', 'None'), ('self', 3),
+                                  ('double', 'None')]:
+                    region = normalisation.normalise_region(r, mode, ref, R)
+                    eq_(region[1].shape, r.region.channel_counts.shape)
+                    eq_(region[2].shape, r.region.extended_channels.shape)
+                    for name, ys in self._series(r):
+                        if name == 'counts':
+                            got = region[0]
+                        else:
+                            matrix = region[1 if name.startswith('channel') else 2]
+                            got = matrix[:, normalisation.get_name_num(name)-1]
+                        np.testing.assert_array_equal(
+                            got, normalisation.normalise(r, ys, name, mode, ref, R))
+                    cached = self.cache.normalise_region(r, mode, ref, R)
+                    for got, expected in zip(cached, region):
+                        np.testing.assert_array_equal(got, expected)
+
+    def reuse_test(self):
+        ys = self.r.region.channel_counts[:,0]
+        first = self.cache.normalise(self.r, ys, 'channel_counts_1', 'double', R=self.R)
+        ok_(self.cache.normalise(self.r, ys, 'channel_counts_1', 'double', R=self.R)
+            is first)
+        counts = self.cache.normalise(self.r, self.r.region.counts, 'counts', 'double',
+                                      R=self.R)
+        # Selecting other channels changes the counts but not the channels
+        self.r.selection.channel_counts_states['channel_counts_1'] = False
+        ok_(self.cache.normalise(self.r, ys, 'channel_counts_1', 'double', R=self.R)
+            is first)
+        ok_(not np.array_equal(self.cache.normalise(self.r, self.r.region.counts,
+                                                    'counts', 'double', R=self.R),
+                               counts))
+        # as does changing the reference numerator
+        self.R.selection.dbl_norm_ref_numerator = 4
+        changed = self.cache.normalise(self.r, ys, 'channel_counts_1', 'double', R=self.R)
+        ok_(np.array_equal(changed, normalisation.normalise(self.r, ys, 'channel_counts_1',
+                                                            'double', R=self.R)))
+        ok_(not np.array_equal(changed, first))
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -4,10 +4,15 @@ import sys
 PATH_HERE = os.path.abspath(os.path.dirname(__file__))
 sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
 
+import shutil
+import tempfile
 import unittest
 import nose
 from nose.tools import eq_, ok_
+import numpy as np
 from app import SpFile
+import specs
+import specs_cache
 
 
 TESTDATA_DIR = 'testdata'
@@ -53,5 +58,205 @@ class CorrectLoadingTest(unittest.TestCase):
         eq_(name3, 'Carbon Nexafs Vanil_FI')
 
 
+class RegionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        self.cache_dir = tempfile.mkdtemp()
+        self.index = specs.SPECSIndex(self.filename, self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def count_regions_test(self):
+        eq_(len(self.index.groups), 2)
+        eq_(len(self.index.groups[0]['regions']), 4)
+        eq_(len(self.index.groups[1]['regions']), 1)
+
+    def saved_index_test(self):
+        index = specs.SPECSIndex(self.filename, self.cache_dir)
+        eq_(index.groups, self.index.groups)
+
+    def read_region_test(self):
+        full = specs.SPECS(self.filename)
+        for i, group in enumerate(full.groups):
+            eq_(self.index.groups[i]['name'], group.name)
+            for j, region in enumerate(group.regions):
+                read = self.index.read_region(i, j)
+                eq_(read.name, region.name)
+                ok_(np.array_equal(read.counts, region.counts))
+                ok_(np.array_equal(read.channel_counts, region.channel_counts))
+
+    def parallel_parse_test(self):
+        serial = specs.SPECS(self.filename)
+        parallel = specs.SPECS(self.filename, processes=2)
+        eq_([g.name for g in parallel.groups], [g.name for g in serial.groups])
+        for group, serial_group in zip(parallel.groups, serial.groups):
+            eq_([r.name for r in group.regions], [r.name for r in serial_group.regions])
+            for region, serial_region in zip(group.regions, serial_group.regions):
+                ok_(np.array_equal(region.counts, serial_region.counts))
+
+    def read_region_by_name_test(self):
+        region = specs.read_region(self.filename, 'Group1', 'Carbon Nexafs Vanil_FI',
+                                   cache_dir=self.cache_dir)
+        eq_(region.name, 'Carbon Nexafs Vanil_FI')
+
+
+class LinearAxisTest(unittest.TestCase):
+    def setUp(self):
+        self.regions = [region for group in
+                        specs.SPECS(os.path.join(TESTDATA_DIR, 'test_data.xml')).groups
+                        for region in group.regions]
+
+    def ends_test(self):
+        for region in self.regions:
+            for axis in (region.kinetic_axis, region.binding_axis,
+                         region.excitation_axis, region.time_axis):
+                ends = (axis[0], axis[-1], len(axis))
+                # The ends are known before the values are made
+                ok_(axis._values is None)
+                values = np.asarray(axis)
+                eq_(ends, (values[0], values[-1], len(values)))
+
+    def values_test(self):
+        for region in self.regions:
+            n = region.values_per_curve
+            kinetic = np.linspace(region.kinetic_energy,
+                                  region.kinetic_energy + (n - 1) * region.scan_delta, n)
+            eq_(np.asarray(region.kinetic_axis).tolist(), kinetic.tolist())
+            eq_(np.asarray(region.binding_axis).tolist(),
+                (region.excitation_energy - kinetic).tolist())
+            ok_(np.allclose(region.time_axis, np.arange(n) * region.dwell_time))
+            eq_(region.binding_axis[1:3].tolist(),
+                (region.excitation_energy - kinetic[1:3]).tolist())
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = specs_cache.SPECSCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cached_regions_match_test(self):
+        parsed = specs.SPECS(self.filename)
+        self.cache.open(self.filename)
+        cached = self.cache.open(self.filename)
+        ok_(os.path.exists(self.cache.entry_path(self.filename)))
+        eq_([g.name for g in cached.groups], [g.name for g in parsed.groups])
+        for group, parsed_group in zip(cached.groups, parsed.groups):
+            for region, parsed_region in zip(group.regions, parsed_group.regions):
+                eq_(region.name, parsed_region.name)
+                eq_(region.scan_mode, parsed_region.scan_mode)
+                ok_(np.array_equal(region.counts, parsed_region.counts))
+                ok_(np.array_equal(region.channel_counts, parsed_region.channel_counts))
+                ok_(np.array_equal(region.extended_channels,
+                                   parsed_region.extended_channels))
+                ok_(np.array_equal(region.binding_axis, parsed_region.binding_axis))
+
+    def lazy_miss_test(self):
+        parsed = specs.SPECS(self.filename)
+        path = self.cache.entry_path(self.filename)
+        s = specs_cache.open_specs(self.filename, lazy=True, cache_dir=self.cache_dir)
+        regions = [region for group in s.groups for region in group.regions]
+        # Nothing is decoded to store the file
+        ok_(all(region._pending_payload is not None for region in regions))
+        ok_(not os.path.exists(path))
+        # It is stored once a region has been decoded, as it was decoded
+        regions[0].counts = regions[0].counts * 2
+        ok_(os.path.exists(path))
+        cached = [region for group in self.cache.open(self.filename).groups
+                  for region in group.regions]
+        parsed = [region for group in parsed.groups for region in group.regions]
+        eq_([region._pending_payload is None for region in cached],
+            [True] + [False] * (len(cached) - 1))
+        for region, parsed_region in zip(cached, parsed):
+            ok_(np.array_equal(region.counts, parsed_region.counts))
+            ok_(np.array_equal(region.extended_channels, parsed_region.extended_channels))
+        # and again once they all have been
+        for region in regions[1:]:
+            region.load_payload()
+        cached = self.cache.open(self.filename)
+        ok_(all(region._pending_payload is None
+                for group in cached.groups for region in group.regions))
+
+    def lazy_miss_owner_test(self):
+        # Attributes added to the regions, as app.SpRegion adds owner, aren't stored
+        s = specs_cache.open_specs(self.filename, lazy=True, cache_dir=self.cache_dir)
+        for group in s.groups:
+            for region in group.regions:
+                region.owner = self
+        for group in s.groups:
+            for region in group.regions:
+                region.load_payload()
+        ok_(os.path.exists(self.cache.entry_path(self.filename)))
+        cached = self.cache.open(self.filename)
+        ok_(not any(hasattr(region, 'owner')
+                    for group in cached.groups for region in group.regions))
+
+    def eviction_test(self):
+        self.cache.max_size = 0
+        self.cache.open(self.filename)
+        path = self.cache.entry_path(self.filename)
+        # The entry just stored is kept
+        ok_(os.path.exists(path))
+        self.cache.evict()
+        ok_(not os.path.exists(path))
+
+
+class FollowTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(TESTDATA_DIR, 'test_data.xml')
+        with open(self.filename, 'rb') as f:
+            self.contents = f.read()
+        fd, self.growing = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.growing)
+
+    def _write(self, contents):
+        with open(self.growing, 'wb') as f:
+            f.write(contents)
+
+    def growing_file_test(self):
+        full = specs.SPECS(self.filename)
+        follower = specs.SPECSFollower(self.growing)
+        new = []
+        # Regions appear as the file grows
+        for n in range(1, 8):
+            self._write(self.contents[:len(self.contents) * n // 7])
+            new.extend(follower.poll())
+        eq_(follower.restarts, 0)
+        eq_([g.name for g in follower.groups], [g.name for g in full.groups])
+        eq_([r.name for g, r in new], [r.name for g in full.groups for r in g.regions])
+        for group, full_group in zip(follower.groups, full.groups):
+            for region, full_region in zip(group.regions, full_group.regions):
+                ok_(np.array_equal(region.counts, full_region.counts))
+
+    def rewritten_file_test(self):
+        self._write(self.contents)
+        follower = specs.SPECSFollower(self.growing)
+        eq_(len(follower.poll()), 5)
+        self._write(self.contents[:len(self.contents) // 2])
+        follower.poll()
+        eq_(follower.restarts, 1)
+        self._write(self.contents)
+        follower.poll()
+        eq_([len(g.regions) for g in follower.groups], [4, 1])
+
+    def follow_sp_file_test(self):
+        self._write(self.contents[:len(self.contents) // 2])
+        specs_file = SpFile().open(self.growing, follow=True)
+        regions = [r for g in specs_file.specs_groups for r in g.specs_regions]
+        self._write(self.contents)
+        added = specs_file.update()
+        # Existing nodes are kept and only the new regions added
+        eq_([r for g in specs_file.specs_groups for r in g.specs_regions],
+            regions + added)
+        eq_(len(regions + added), 5)
+
+
 if __name__ == '__main__':
     nose.run(defaultTest=__name__)
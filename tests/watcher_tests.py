@@ -0,0 +1,75 @@
+import os
+import sys
+
+PATH_HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
+
+import shutil
+import tempfile
+import unittest
+import nose
+from nose.tools import eq_, ok_
+import specs_cache
+import watcher
+
+
+TESTDATA_DIR = 'testdata'
+
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TESTDATA_DIR, 'test_data.xml'), 'rb') as f:
+            self.contents = f.read()
+        self.directory = tempfile.mkdtemp()
+        self.outdir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'acquired.xml')
+        self.watcher = watcher.Watcher(self.directory, settle=0, cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        self.watcher.close()
+        for directory in (self.directory, self.outdir, self.cache_dir):
+            shutil.rmtree(directory)
+
+    def _write(self, contents):
+        with open(self.filename, 'wb') as f:
+            f.write(contents)
+
+    def partial_file_test(self):
+        self._write(self.contents[:len(self.contents) // 2])
+        self.watcher.poll()
+        eq_(self.watcher.wait(), [])
+        eq_(self.watcher.queue_depth, 0)
+        ok_(not os.path.exists(
+            specs_cache.SPECSCache(self.cache_dir).entry_path(self.filename)))
+
+    def cache_warmed_test(self):
+        self._write(self.contents)
+        # The first poll sees the file, the next finds it unchanged
+        self.watcher.poll()
+        processed = self.watcher.wait()
+        eq_([p.filename for p in processed], [self.filename])
+        eq_(processed[0].errors, [])
+        ok_(os.path.exists(specs_cache.SPECSCache(self.cache_dir).entry_path(self.filename)))
+        eq_([f for f, latency in self.watcher.latencies()], [self.filename])
+        # Unchanged files aren't processed again
+        self.watcher.poll()
+        eq_(self.watcher.wait(), [])
+
+    def mirror_export_test(self):
+        self.watcher.close()
+        subdirectory = os.path.join(self.directory, 'sample')
+        os.mkdir(subdirectory)
+        self.filename = os.path.join(subdirectory, 'acquired.xml')
+        self._write(self.contents)
+        self.watcher = watcher.Watcher(self.directory, self.outdir,
+                                       open_options={'channels': [1, 2]}, settle=0,
+                                       recursive=True, cache_dir=self.cache_dir)
+        self.watcher.poll()
+        self.watcher.wait()
+        ok_(os.path.isfile(os.path.join(self.outdir, 'sample', 'acquired', 'Group1',
+                                        'Carbon Nexafs Vanil_FI.xy')))
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,263 @@
+'''
+A service that watches an acquisition directory and processes each SPECSLab .xml file
+as soon as it has been completely written, so it is already in the cache of parsed
+files (see specs_cache) by the time it is opened in SinSPECt. Each file can also be
+exported into a mirror of the directory, as export.py would export it:
+
+    python watcher.py [-o OUTDIR] [options] DIRECTORY
+
+Like export.py this doesn't depend on wx, chaco or enable, so it can run without a
+display. Run with --help for the options.
+'''
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from collections import deque, namedtuple
+import specs
+import specs_cache
+import export
+
+# Files are complete once they end with the close of the root element
+END_TAG = '</any>'
+HISTORY = 1000      # Number of processed files remembered for their latencies
+
+# A file the watcher has finished with. errors is as returned by export.export_files(),
+# waited the seconds the file was queued and took the seconds it took to process.
+Processed = namedtuple('Processed', 'filename errors waited took')
+
+
+class Watcher(object):
+    ''' Watch directory for .xml files, and in subdirectories too if recursive is True.
+    Construct with:
+
+        watcher = watcher.Watcher(my_directory)
+
+    then call watcher.poll() regularly, or watcher.run() to do so until interrupted.
+    A file is processed once its size and modification time have not changed for settle
+    seconds and it ends with the close of its root element, so files still being
+    acquired or copied are left until they are complete. A file is processed again if it
+    changes afterwards.
+
+    Processing is done by a pool of workers processes, with the other complete files
+    waiting in a queue. Each file is read into the cache in cache_dir and, if outdir is
+    given, exported into the same place relative to outdir as it is relative to
+    directory, using export_options, open_options and format as export.export_files()
+    does.
+
+    '''
+
+    def __init__(self, directory, outdir=None, export_options=None, open_options=None,
+                 format='xy', workers=1, settle=2.0, recursive=False,
+                 cache_dir=specs.CACHE_DIR):
+        self.directory = directory
+        self.outdir = outdir
+        self.export_options = export_options or {}
+        self.open_options = open_options or {}
+        self.format = format
+        self.settle = settle
+        self.recursive = recursive
+        self.cache_dir = cache_dir
+        # Processed tuples for the latest files finished, in the order they finished
+        self.processed = deque(maxlen=HISTORY)
+
+        self._pool = multiprocessing.Pool(workers)
+        self._workers = workers
+        self._changes = {}          # filename: ((size, mtime), time the change was seen)
+        self._done = {}             # filename: (size, mtime) when it was queued
+        self._queue = deque()       # (filename, time queued)
+        self._running = []          # (filename, time queued, AsyncResult)
+
+    @property
+    def queue_depth(self):
+        ''' The number of complete files waiting for a worker. '''
+        return len(self._queue)
+
+    @property
+    def running(self):
+        ''' The number of files being processed. '''
+        return len(self._running)
+
+    def latencies(self):
+        ''' Return a list of (filename, seconds) with the time from each of the latest
+        processed files being found complete to it being finished with. '''
+        return [(p.filename, p.waited + p.took) for p in self.processed]
+
+    def scan(self):
+        ''' Return the .xml files now in the watched directory. '''
+        if not self.recursive:
+            return export.expand_paths([self.directory])
+        filenames = []
+        for dirpath, dirnames, names in os.walk(self.directory):
+            dirnames.sort()
+            filenames.extend(os.path.join(dirpath, name) for name in sorted(names)
+                             if name.lower().endswith('.xml'))
+        return filenames
+
+    def poll(self, now=None):
+        ''' Queue the files that have become complete, hand queued files to free workers
+        and collect finished ones. Returns the list of Processed tuples for the files
+        finished since the last poll. '''
+        if now is None:
+            now = time.time()
+        for filename in self.scan():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # Removed since the scan
+                continue
+            key = (stat.st_size, stat.st_mtime)
+            if self._done.get(filename) == key:
+                continue
+            change = self._changes.get(filename)
+            if change is None or change[0] != key:
+                self._changes[filename] = (key, now)
+            elif now - change[1] >= self.settle and self._is_complete(filename):
+                del self._changes[filename]
+                self._done[filename] = key
+                self._queue.append((filename, now))
+
+        finished = []
+        for filename, queued, result in self._running[:]:
+            if result.ready():
+                self._running.remove((filename, queued, result))
+                try:
+                    errors, started, took = result.get()
+                except Exception as e:
+                    # e.g. the exported files couldn't be written; keep watching
+                    errors, started, took = [(filename, None, str(e))], queued, now - queued
+                finished.append(Processed(filename, errors, started - queued, took))
+        self.processed.extend(finished)
+
+        while self._queue and len(self._running) < self._workers:
+            filename, queued = self._queue.popleft()
+            args = (filename, self._mirror_dir(filename), self.open_options,
+                    self.export_options, self.format, self.cache_dir)
+            self._running.append((filename, queued,
+                                  self._pool.apply_async(_process_file, (args,))))
+        return finished
+
+    def wait(self, interval=0.1):
+        ''' Poll until no files are queued or being processed. Returns the list of
+        Processed tuples for the files finished meanwhile. '''
+        finished = self.poll()
+        while self._queue or self._running:
+            time.sleep(interval)
+            finished.extend(self.poll())
+        return finished
+
+    def run(self, interval=1.0, report=None):
+        ''' Poll every interval seconds until interrupted, calling report(processed) with
+        each Processed tuple if given. '''
+        while True:
+            for processed in self.poll():
+                if report is not None:
+                    report(processed)
+            time.sleep(interval)
+
+    def close(self):
+        ''' Stop the workers, abandoning any files being processed. '''
+        self._pool.terminate()
+        self._pool.join()
+
+    @staticmethod
+    def _is_complete(filename):
+        try:
+            return is_complete(filename)
+        except IOError:
+            # The acquisition software may briefly have the file locked
+            return False
+
+    def _mirror_dir(self, filename):
+        if self.outdir is None:
+            return None
+        relative = os.path.relpath(os.path.dirname(os.path.abspath(filename)),
+                                   os.path.abspath(self.directory))
+        return os.path.normpath(os.path.join(self.outdir, relative))
+
+
+def is_complete(filename):
+    ''' Return True if filename ends with the close of a SPECSLab file's root element,
+    i.e. it isn't still being written. '''
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 64, 0))
+        return f.read().rstrip().endswith(END_TAG)
+
+
+def _process_file(args):
+    ''' Worker for Watcher: read a file into the cache, exporting it into outdir if that
+    isn't None. Returns (errors, start time, seconds taken), with errors as returned by
+    export.export_files().
+    '''
+    filename, outdir, open_options, export_options, format, cache_dir = args
+    started = time.time()
+    if outdir is None:
+        try:
+            specs_cache.open_specs(filename, cache_dir=cache_dir)
+            errors = []
+        except Exception as e:
+            errors = [(filename, None, 'error reading file: {}'.format(e))]
+    else:
+        # Opening the file for export reads it into the cache too
+        open_options = dict(open_options, cache_dir=cache_dir)
+        errors = export.export_files([filename], outdir, export_options, open_options,
+                                     writers=1, format=format)
+    return errors, started, time.time() - started
+
+
+def main(argv=None):
+    ''' Command line entry point. Runs until interrupted. '''
+    parser = argparse.ArgumentParser(
+        description='Watch a directory for SPECSLab .xml files, reading each into the '
+                    'SinSPECt cache once it is complete and optionally exporting it.')
+    parser.add_argument('directory', help='the directory to watch')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='directory to export into, mirroring the watched '
+                             "directory (default: don't export)")
+    export.add_export_arguments(parser)
+    parser.add_argument('-R', '--recursive', action='store_true',
+                        help='watch subdirectories too')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of processes reading files, 0 for one per CPU '
+                             '(default: 1)')
+    parser.add_argument('-s', '--settle', type=float, default=2.0,
+                        help='seconds a file must be unchanged before it is read '
+                             '(default: 2)')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='seconds between checks of the directory (default: 1)')
+    args = parser.parse_args(argv)
+
+    export_options, open_options = export.export_options_from_args(parser, args)
+    if not os.path.isdir(args.directory):
+        parser.error('{} is not a directory'.format(args.directory))
+
+    watcher = Watcher(args.directory, args.outdir, export_options, open_options,
+                      format=args.format, workers=args.workers or multiprocessing.cpu_count(),
+                      settle=args.settle, recursive=args.recursive)
+
+    def report(processed):
+        print '{}: {:.2f} s, waited {:.2f} s, {} queued'.format(
+            processed.filename, processed.took, processed.waited, watcher.queue_depth)
+        for filename, name, err_msg in processed.errors:
+            if name is None:
+                print >> sys.stderr, '{}: {}'.format(filename, err_msg)
+            else:
+                print >> sys.stderr, '{}: {}: {}'.format(filename, name, err_msg)
+
+    print 'Watching {}'.format(args.directory)
+    try:
+        watcher.run(args.interval, report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+if __name__ == '__main__':
+    # Needed for the process pool in a frozen Windows executable
+    multiprocessing.freeze_support()
+    sys.exit(main())